@@ -2,14 +2,22 @@
 
 from gerber2pdf import *
 from reportlab.pdfgen import canvas
+from reportlab.pdfgen.pathobject import PDFPathObject
 from reportlab.lib import colors
 from reportlab.lib.units import mm
 from reportlab.lib.pagesizes import letter
 from reportlab.platypus import SimpleDocTemplate, Table, TableStyle
+import os
+import re
 import csv
+import time
+import array
+import logging
+
+log = logging.getLogger("assygen")
 
 class PPComponent:
-    def __init__(self,xc, yc, w, h, name, desc, ref):
+    def __init__(self,xc, yc, w, h, name, desc, ref, package=""):
         self.xc = xc
         self.yc = yc
         self.w = w
@@ -23,34 +31,90 @@ class PPComponent:
         self.name = name
         self.desc = desc
         self.ref = ref
+        self.package = package
 
 
 
 class PickAndPlaceFile:
+    # the loaders fill self.parts[layer] with PPComponents in file order and
+    # call build_index, which groups them once for all the pages
+
+    col_map = [colors.Color(1,0,0),
+               colors.Color(1,1,0),
+               colors.Color(0,1,0),
+               colors.Color(0,1,1),
+               colors.Color(1,0,1),
+               colors.Color(0,0,1)]
+
+    group_keys = {
+        "value":         lambda part: part.desc,
+        "value+package": lambda part: (part.desc, part.package),
+        "libref":        lambda part: part.ref,
+    }
+
+    def build_index(self, group_by="value"):
+        key = self.group_keys[group_by]
+        self.layers = {}
+        self.groups = {}
+        self.group_bounds = {}
+        self.group_paths = {}
+        self.group_designators = {}
+        for layer, parts in self.parts.iteritems():
+            by_key = {}
+            for part in parts:
+                k = key(part)
+                if(not k in by_key):
+                    by_key[k] = []
+                by_key[k].append(part)
+            groups = [by_key[k] for k in sorted(by_key.iterkeys())]
+            self.layers[layer] = by_key
+            self.groups[layer] = groups
+            self.group_bounds[layer] = [self.part_bounds(group) for group in groups]
+            self.group_paths[layer] = [self.part_path(group) for group in groups]
+            self.group_designators[layer] = ["".join([" " + part.name for part in group]) for group in groups]
+
+    def part_bounds(self, parts):
+        b = [1e6, 1e6, -1e6, -1e6]
+        for j in parts:
+            b[0] = min(b[0], j.xc - j.w/2)
+            b[1] = min(b[1], j.yc - j.h/2)
+            b[2] = max(b[2], j.xc + j.w/2)
+            b[3] = max(b[3], j.yc + j.h/2)
+        return b
+
+    def part_path(self, parts):
+        # the outlines of a whole group, drawn with one operator
+        path = PDFPathObject()
+        for j in parts:
+            path.rect(j.xc - j.w/2, j.yc-j.h/2, j.w, j.h)
+        return path
+
     def split_parts(self, layer, index, n_comps):
-        parts = [];
-        n=0
-        for i in sorted(self.layers[layer].iterkeys()):
-            if(n >= index and n < index+n_comps):
-                parts.append(self.layers[layer][i])
-            n=n+1
-        return parts
+        return self.groups[layer][index:index+n_comps]
 
     def num_groups(self, layer):
-        return len(self.split_parts(layer, 0, 10000))
+        return len(self.groups[layer])
+
+    def bounds(self, layer, index, n_comps, margin):
+        b = [1e6, 1e6, -1e6, -1e6]
+        for gb in self.group_bounds[layer][index:index+n_comps]:
+            b[0] = min(b[0], gb[0] - margin)
+            b[1] = min(b[1], gb[1] - margin)
+            b[2] = max(b[2], gb[2] + margin)
+            b[3] = max(b[3], gb[3] + margin)
+        return b
 
     def draw(self, layer, index, n_comps, canv):
-        parts = self.split_parts(layer, index, n_comps)
         n=0
-        for i in parts:
+        for path in self.group_paths[layer][index:index+n_comps]:
             canv.setStrokeColor(self.col_map[n])
             canv.setFillColor(self.col_map[n])
             n=n+1
-            for j in i:
-                canv.rect(j.xc - j.w/2, j.yc-j.h/2, j.w, j.h, 1, 1)
+            canv.drawPath(path, 1, 1, fillMode=FILL_NON_ZERO)
     
     def gen_table(self, layer, index, n_comps,canv):
         parts = self.split_parts(layer, index, n_comps)
+        designators = self.group_designators[layer][index:index+n_comps]
 
         yt = 260 * mm
         canv.setFont("Helvetica",10)
@@ -61,15 +125,12 @@ class PickAndPlaceFile:
         canv.drawString(80 * mm, yt, "Comment");
         canv.drawString(120 * mm, yt, "Designators");
         n=0
-        for group in parts:
-            dsgn = ""
+        for group, dsgn in zip(parts, designators):
             yt = yt - 6 * mm
             canv.setFillColor(self.col_map[n])
             canv.rect(20 *mm, yt, 10 * mm, 3 * mm, 1, 1)
             canv.setFillGray(0)
             n=n+1
-            for part in group:
-                dsgn = dsgn + " " + part.name
             canv.drawString(120 * mm, yt, dsgn);
             canv.drawString(40 * mm, yt, group[0].ref[0:20]);
             canv.drawString(80 * mm, yt, group[0].desc[0:20]);
@@ -79,101 +140,147 @@ class PickAndPlaceFile:
    
     
 
-class PickAndPlaceFileKicad(PickAndPlaceFile):
-    def __init__(self, fname):
-	print("Load")
-	f= open(fname,'r')
-	rows=[]
-	for line in f:
-	    rows.append(line.split())
-	    
-
-        self.col_map = [colors.Color(1,0,0), 
-                  colors.Color(1,1,0), 
-                  colors.Color(0,1,0), 
-                  colors.Color(0,1,1), 
-                  colors.Color(1,0,1), 
-                  colors.Color(0,0,1)]
-
-#	Ref    Val                  Package         PosX       PosY        Rot     Side
-
-
-        i_dsg = rows[0].index("Ref")
-        i_desc = rows[0].index("Val")
-        i_cx = rows[0].index("PosX")
-        i_cy = rows[0].index("PosY")
-        i_layer = rows[0].index("Side")
-
-        self.layers = {};
-        self.layers["Top"] = {};        
-        self.layers["Bottom"] = {};
-       
-	print(i_dsg, i_desc, i_cx, i_cy);
-        for i in rows[1:]:
-            if(len(i)>0):
-		print(i[i_dsg], i[i_cx])
-                cx = float(i[i_cx]) * mm
-                cy = float(i[i_cy]) * mm
-
-                w = 1 * mm
-                h = 1 * mm
-                l = i[i_layer]
-		if l == "F.Cu":
-		    layer = "Top"
-		else:
-		    layer = "Bottom"
-                ref = i[i_desc]
-#                print(ref,cy, py)
-                if(not ref in self.layers[layer]):
-                    self.layers[layer][ref] = []
-                self.layers[layer][ref].append(PPComponent(cx, cy, w, h, i[i_dsg], i[i_desc], ref))
-
-
-#class PickAndPlaceFileKicad(PickAndPlaceFile):
-#    def __init__(self, fname):
-#	print("Load")
-#        reader = csv.reader(open(fname,'rb') ,delimiter=' ')
-#        rows = []
-#        for row in reader:
-#            rows.append(row)
-#
-#        self.col_map = [colors.Color(1,0,0), 
-#                  colors.Color(1,1,0), 
-#                  colors.Color(0,1,0), 
-#                  colors.Color(0,1,1), 
-#                  colors.Color(1,0,1), 
-#                  colors.Color(0,0,1)]
-#
-#        i_dsg = rows[0].index("Designator")
-#        i_desc = rows[0].index("Description")
-#        i_cx = rows[0].index("Center-X(mm)")
-#        i_cy = rows[0].index("Center-Y(mm)")
-#        i_px = rows[0].index("Pad-X(mm)")
-#        i_py = rows[0].index("Pad-Y(mm)")
-#        i_layer = rows[0].index("Layer")
-#        i_ref = rows[0].index("LibRef")
-#
-#        self.layers = {};
-#        self.layers["Top"] = {};        
-#        self.layers["Bottom"] = {};
-#       
-#        for i in rows[1:]:
-#            if(len(i)>0):
-#                cx = float(i[i_cx]) * mm
-#                cy = float(i[i_cy]) * mm
-#                px = float(i[i_px]) * mm
-#                py = float(i[i_py]) * mm
-#                w = abs(cx-px) * 2
-#                h = abs(cy-py) * 2
-#                layer = i[i_layer]
-#                ref = i[i_ref]
-#                print(ref,cy, py)
-#                if(not ref in self.layers[layer]):
-#                    self.layers[layer][ref] = []
-#                self.layers[layer][ref].append(PPComponent(cx, cy, w, h, i[i_dsg], i[i_desc], ref))
-
-def renderGerber(base_name, layer, canv):
-    global gerberExtents
+class PickAndPlaceError(Exception):
+    pass
+
+class PickAndPlaceFileCSV(PickAndPlaceFile):
+    # Reads KiCad .pos and CSV files, Altium pick and place files and other
+    # CSV files, telling them apart by the names in the header line.  Rows
+    # are streamed through the csv module and only the columns in use are
+    # kept, the coordinates being converted in bulk into arrays.
+
+    # field -> the lower case column names it goes by
+    column_names = {
+        "name":    ("ref", "designator", "refdes", "reference"),
+        "desc":    ("val", "value", "comment", "description"),
+        "ref":     ("libref", "lib.reference", "lib ref"),
+        "package": ("package", "footprint"),
+        "x":       ("posx", "center-x(mm)", "center-x(mil)", "center-x", "mid x", "x"),
+        "y":       ("posy", "center-y(mm)", "center-y(mil)", "center-y", "mid y", "y"),
+        "px":      ("pad-x(mm)", "pad-x(mil)", "pad-x", "pad x"),
+        "py":      ("pad-y(mm)", "pad-y(mil)", "pad-y", "pad y"),
+        "side":    ("side", "layer", "tb"),
+    }
+    required = ("name", "x", "y")
+
+    units = (("mils", 0.0254), ("mil", 0.0254), ("mm", 1.0), ("inches", 25.4), ("inch", 25.4), ("in", 25.4))
+    unit_line = re.compile(r"#*\s*units?\b[^=:]*[=:]\s*(\w+)", re.I)
+    top_sides = ("f.cu", "top", "t", "toplayer", "top layer", "front", "f")
+
+    def __init__(self, fname, group_by="value"):
+        log.debug("Load %s", fname)
+        f = open(fname, 'rU')
+        lines = (line.strip() for line in f)
+        header, delimiter, unit = self.read_header(lines, fname)
+        fields = self.find_columns(header)
+        log.debug("%s: %s format, columns %s", fname,
+                  "posx" in header and "KiCad" or "designator" in header and "Altium" or "generic", fields)
+
+        names = fields.keys()
+        index = [fields[field] for field in names]
+        last = max(index)
+        columns = [[] for field in names]
+        pairs = zip([column.append for column in columns], index)
+        for row in csv.reader(lines, delimiter=delimiter, skipinitialspace=True):
+            if(len(row) <= last or row[0].startswith("#")):
+                continue
+            for append, i in pairs:
+                append(row[i].strip())
+        f.close()
+        columns = dict(zip(names, columns))
+
+        n = len(columns["name"])
+        xs = self.lengths(columns["x"], self.column_unit(header[fields["x"]], unit))
+        ys = self.lengths(columns["y"], self.column_unit(header[fields["y"]], unit))
+        if "px" in columns and "py" in columns:
+            pxs = self.lengths(columns["px"], self.column_unit(header[fields["px"]], unit))
+            pys = self.lengths(columns["py"], self.column_unit(header[fields["py"]], unit))
+        else:
+            pxs, pys = xs, ys
+        blank = [""] * n
+        descs = columns.get("desc", blank)
+        refs = columns.get("ref", descs)
+        packages = columns.get("package", blank)
+        sides = columns.get("side", ["top"] * n)
+
+        self.parts = {};
+        self.parts["Top"] = [];
+        self.parts["Bottom"] = [];
+        for k in xrange(n):
+            if(sides[k].lower() in self.top_sides):
+                layer = "Top"
+            else:
+                layer = "Bottom"
+            w = abs(xs[k]-pxs[k]) * 2 * mm or 1 * mm
+            h = abs(ys[k]-pys[k]) * 2 * mm or 1 * mm
+            self.parts[layer].append(PPComponent(xs[k] * mm, ys[k] * mm, w, h,
+                                                 columns["name"][k], descs[k], refs[k], packages[k]))
+        self.build_index(group_by)
+
+    def read_header(self, lines, fname):
+        # skips what comes before the header, returning its lower case
+        # column names, the delimiter and the unit in mm
+        unit = 1.0
+        for line in lines:
+            m = self.unit_line.match(line)
+            if(m):
+                unit = self.value_unit(m.group(1).lower(), unit)
+            text = line.lstrip("#").strip()
+            if(not text):
+                continue
+            delimiter = " "
+            for d in (",", "\t", ";"):
+                if d in text:
+                    delimiter = d
+                    break
+            header = [name.strip().lower() for name in
+                      csv.reader([text], delimiter=delimiter, skipinitialspace=True).next()]
+            fields = self.find_columns(header)
+            if(all([field in fields for field in self.required])):
+                return header, delimiter, unit
+        raise PickAndPlaceError("%s: no pick and place header found" % fname)
+
+    def find_columns(self, header):
+        fields = {}
+        for field, names in self.column_names.iteritems():
+            for name in names:
+                if name in header:
+                    fields[field] = header.index(name)
+                    break
+        return fields
+
+    def value_unit(self, text, default):
+        for suffix, scale in self.units:
+            if text.endswith(suffix):
+                return scale
+        return default
+
+    def column_unit(self, name, default):
+        if(name.endswith(")")):
+            return self.value_unit(name[:-1], default)
+        return default
+
+    def lengths(self, values, unit):
+        # the column in mm, values that carry a unit of their own
+        # ("12.5mil") are converted one by one
+        try:
+            column = array.array('d', map(float, values))
+        except ValueError:
+            column = array.array('d', [self.length(value, unit) for value in values])
+            unit = 1.0
+        if(unit != 1.0):
+            column = array.array('d', [value * unit for value in column])
+        return column
+
+    def length(self, value, unit):
+        for suffix, scale in self.units:
+            if value.endswith(suffix):
+                return float(value[:-len(suffix)]) * scale
+        return float(value) * unit
+
+PickAndPlaceFileKicad = PickAndPlaceFileCSV
+
+def gerberLayers(base_name, layer):
     if(layer == "Bottom"):
         f_copper = base_name+".GBL"
         f_overlay = base_name+".GBO"
@@ -181,58 +288,229 @@ def renderGerber(base_name, layer, canv):
         f_copper = base_name+".GTL"
         f_overlay = base_name+".GTO"
 
-    canv.setLineWidth(0.0)
-    gm = GerberMachine( "", canv )
-    gm.Initialize()
-    ResetExtents()
-    gm.setColors(colors.Color(0.85,0.85,0.85), colors.Color(0,0,0))
-    gm.ProcessFile( f_copper )
-    gm.setColors(colors.Color(0.5,0.5,0.5), colors.Color(0,0,0))
-    return gm.ProcessFile( f_overlay )
-
-
-def producePrintoutsForLayer(base_name, layer, canv):
-
-
-    ctmp = canvas.Canvas(base_name + "_assy.pdf")
-    ext = renderGerber(base_name, layer, ctmp);
-
-    scale1 = (gerberPageSize[0]-2*gerberMargin)/((ext[2]-ext[0]))
-    scale2 = (gerberPageSize[1]-2*gerberMargin)/((ext[3]-ext[1]))
+    return [ (f_copper, colors.Color(0.85,0.85,0.85), colors.Color(0,0,0), 0.0),
+             (f_overlay, colors.Color(0.5,0.5,0.5), colors.Color(0,0,0), 0.0) ]
+
+def parseGerbers(base_name, sides, config, stats=None, pool=None):
+    # (artwork, extents) for each side, the files of all of them recorded
+    # in one go so that config.jobs workers, or those of pool, can parse
+    # them side by side
+    files = [gerberLayers(base_name, side) for side in sides]
+    recordings = RecordLayers(sum(files, []), config, stats, pool)
+    boards = []
+    for layers in files:
+        artwork = DisplayList()
+        gm = GerberMachine( "", artwork, config )
+        if stats is not None:
+            stats.Instrument(gm)
+        for layer in layers:
+            fname, fg, bg, width = layer
+            gm.Initialize()
+            gm.setColors(fg, bg)
+            artwork.setLineWidth(width)
+            ext = gm.ReplayRecording( recordings.pop(0) )
+        boards.append((artwork, ext))
+    return boards
+
+def parseGerber(base_name, layer, config, stats=None, pool=None):
+    return parseGerbers(base_name, [layer], config, stats, pool)[0]
+
+
+def produceDetailPage(pf, layer, index, n_comps, canv, board, config):
+    # zoom in on the parts of one printout, replaying only the artwork
+    # that ends up on the page
+    b = pf.bounds(layer, index, n_comps, 5 * mm)
+    width = config.pageSize[0]-2*config.margin
+    height = config.pageSize[1]-2*config.margin
+    scale = min(width/(b[2]-b[0]), height/(b[3]-b[1]))
+    offset = (-b[0]*scale + config.margin, -b[1]*scale + config.margin)
+    visible = ((config.margin - offset[0])/scale, (config.margin - offset[1])/scale,
+               (config.margin + width - offset[0])/scale, (config.margin + height - offset[1])/scale)
+
+    canv.saveState()
+    clip = canv.beginPath()
+    clip.rect(config.margin, config.margin, width, height)
+    canv.clipPath(clip, stroke=0, fill=0)
+    canv.translate( offset[0], offset[1] )
+    canv.scale( scale, scale )
+    board.Replay(canv, visible)
+    pf.draw(layer, index, n_comps, canv);
+    canv.restoreState()
+    pf.gen_table(layer, index, n_comps, canv);
+    canv.showPage()
+
+
+def loadPickAndPlace(base_name, group_by="value", stats=None):
+    start = time.time()
+    pf = PickAndPlaceFileCSV(base_name+".CSV", group_by)
+    if stats is not None:
+        stats.Add("pick and place", time.time() - start)
+    return pf
+
+def producePrintouts(base_name, layers, canvases, use_form=True, config=None, detail=False, stats=None,
+                     group_by="value"):
+    # all the layers ("Top", "Bottom") of a board in one run, layers[k]
+    # drawn on canvases[k]: the placement file is loaded once and the
+    # Gerber files of every side are parsed together
+    if config is None:
+        config = GerberConfig()
+
+    pf = loadPickAndPlace(base_name, group_by, stats)
+    boards = parseGerbers(base_name, layers, config, stats)
+    for layer, canv, parsed in zip(layers, canvases, boards):
+        producePrintoutsForLayer(base_name, layer, canv, use_form, config, detail, stats,
+                                 pf=pf, parsed=parsed)
+
+def producePrintoutsForLayer(base_name, layer, canv, use_form=True, config=None, detail=False, stats=None,
+                             group_by="value", pf=None, parsed=None):
+    if config is None:
+        config = GerberConfig()
+
+    if parsed is None:
+        parsed = parseGerber(base_name, layer, config, stats)
+    artwork, ext = parsed
+    if detail:
+        board = SpatialIndex(artwork)
+
+    # draw the board once into a Form XObject that every page references
+    if use_form:
+        form_name = "artwork" + layer
+        canv.beginForm(form_name, ext[0], ext[1], ext[2], ext[3])
+        artwork.Replay(canv)
+        canv.endForm()
+
+    scale1 = (config.pageSize[0]-2*config.margin)/((ext[2]-ext[0]))
+    scale2 = (config.pageSize[1]-2*config.margin)/((ext[3]-ext[1]))
     scale = min(scale1, scale2)
-    gerberScale = (scale,scale)
-#    print("PS" , gerberPageSize[0], gerberMargin, gerberScale)
-    gerberOffset = (-ext[0]*scale + gerberMargin, -ext[1]*scale + gerberMargin)
-#    print "Offset (in.): (%4.2f, %4.2f)" % (gerberOffset[0]/inch,gerberOffset[1]/inch)
-#    print "Scale (in.):  (%4.2f, %4.2f)" % gerberScale
+    boardScale = (scale,scale)
+#    print("PS" , config.pageSize[0], config.margin, boardScale)
+    boardOffset = (-ext[0]*scale + config.margin, -ext[1]*scale + config.margin)
+#    print "Offset (in.): (%4.2f, %4.2f)" % (boardOffset[0]/inch,boardOffset[1]/inch)
+#    print "Scale (in.):  (%4.2f, %4.2f)" % boardScale
 
 
 
-    pf = PickAndPlaceFileKicad(base_name+".CSV")
+    if pf is None:
+        pf = loadPickAndPlace(base_name, group_by, stats)
     ngrp =  pf.num_groups(layer)
 
     for page in range(0, (ngrp+5)/6):
         n_comps = min(6, ngrp - page*6)
 
         canv.saveState()
-        canv.translate( gerberOffset[0], gerberOffset[1] )
+        canv.translate( boardOffset[0], boardOffset[1] )
         if(layer == "Bottom"):
-            canv.scale( gerberScale[0], gerberScale[1] )
+            canv.scale( boardScale[0], boardScale[1] )
 #            canv.scale( -1, 1 )
-#            canv.translate(-0.5*gerberPageSize[0],0)
+#            canv.translate(-0.5*config.pageSize[0],0)
         else:
-            canv.scale( gerberScale[0], gerberScale[1] )
+            canv.scale( boardScale[0], boardScale[1] )
 
-        renderGerber(base_name, layer, canv);
+        if use_form:
+            canv.doForm(form_name)
+        else:
+            artwork.Replay(canv)
 
+        # the boxes are drawn with the pen the artwork leaves behind, as they
+        # were before the artwork went into a form
+        canv.setLineWidth(artwork._lineWidth)
+        canv.setLineCap(artwork._lineCap)
+        canv.setLineJoin(1)
         pf.draw(layer, page*6, n_comps, canv);
 
         canv.restoreState()
         pf.gen_table(layer, page*6, n_comps, canv);
         canv.showPage()
-
-import sys
-canv = canvas.Canvas(sys.argv[1]+"_assy.pdf")
-#producePrintoutsForLayer(sys.argv[1], "Top", canv)
-producePrintoutsForLayer(sys.argv[1], "Bottom", canv)
-canv.save()
\ No newline at end of file
+        if stats is not None:
+            stats.Count("pages")
+
+        if detail:
+            produceDetailPage(pf, layer, page*6, n_comps, canv, board, config)
+
+if __name__ == "__main__":
+    import sys
+    import getopt
+
+    usage = """usage: %s [options] base_name
+       %s --serve ADDRESS [--root DIR] [--workers N] [--cache-mb N] [options]
+
+    --side SIDE     top, bottom (the default) or both
+    --split         write each side to base_name_assy_<side>.pdf instead of
+                    all of them to base_name_assy.pdf
+    --jobs N        parse the Gerber files in N processes, 0 for one per
+                    CPU; $GERBER2PDF_JOBS or 1 by default
+    --group-by KEY  group parts by value (the default), value+package or
+                    libref
+    --detail        follow each printout with a page zoomed in on its parts
+    --stats FILE    write timings and counts of the run to FILE as JSON
+    --profile NAME  write a per-aperture profile to NAME.tsv and NAME.folded
+    -q, -v          less or more output
+
+    --serve ADDRESS serve drawings over HTTP on host:port or a unix socket,
+                    see assyserver.py
+    --root DIR      the folder whose boards are served, the current one by
+                    default
+    --workers N     serve N requests at a time, 4 by default
+    --cache-mb N    keep up to N MB of parsed boards in memory, 512 by
+                    default""" % (sys.argv[0], sys.argv[0])
+    sides = {"top": ["Top"], "bottom": ["Bottom"], "both": ["Top", "Bottom"]}
+
+    try:
+        options, args = getopt.gnu_getopt(sys.argv[1:], "qv", ["side=", "split", "jobs=", "group-by=",
+                                                               "detail", "stats=", "profile=", "quiet", "verbose",
+                                                               "serve=", "root=", "workers=", "cache-mb="])
+    except getopt.GetoptError, message:
+        sys.exit("%s\n%s" % (message, usage))
+    options = dict(options)
+    group_by = options.get("--group-by", "value")
+    side = options.get("--side", "bottom")
+    jobs = options.get("--jobs", "")
+    workers = options.get("--workers", "4")
+    cache_mb = options.get("--cache-mb", "512")
+    if len(args) != ("--serve" not in options) or not group_by in PickAndPlaceFile.group_keys or \
+       not side in sides or not (jobs == "" or jobs.isdigit()) or not workers.isdigit() or \
+       not cache_mb.isdigit():
+        sys.exit(usage)
+    level = logging.INFO
+    if "-q" in options or "--quiet" in options:
+        level = logging.WARNING
+    if "-v" in options or "--verbose" in options:
+        level = logging.DEBUG
+    logging.basicConfig(level=level, format="%(message)s")
+
+    config = GerberConfig()
+    if jobs:
+        config.jobs = int(jobs)
+    else:
+        config.jobs = EnvironmentJobs()
+    config.stats = options.get("--stats")
+    config.profile = options.get("--profile")
+    if "--serve" in options:
+        import assyserver
+        assyserver.serve(options["--serve"], config, max(int(workers), 1), int(cache_mb)*1024*1024,
+                         options.get("--root", "."))
+        sys.exit(0)
+    stats = GerberStats.ForConfig(config)
+    start = time.time()
+
+    layers = sides[side]
+    if "--split" in options:
+        outputs = [args[0]+"_assy_%s.pdf" % layer.lower() for layer in layers]
+    else:
+        outputs = [args[0]+"_assy.pdf"] * len(layers)
+    canvases = {}
+    for fname in outputs:
+        if not fname in canvases:
+            canvases[fname] = canvas.Canvas(fname)
+            if stats is not None:
+                stats.InstrumentCanvas(canvases[fname])
+    producePrintouts(args[0], layers, [canvases[fname] for fname in outputs], config=config,
+                     detail="--detail" in options, stats=stats, group_by=group_by)
+    for fname, canv in canvases.items():
+        canv.save()
+        log.info("Wrote %s", fname)
+
+    if stats is not None:
+        stats.Add("total", time.time() - start)
+        stats.Count("bytes written", sum([os.path.getsize(fname) for fname in canvases]))
+        stats.WriteFor(config)
@@ -0,0 +1,327 @@
+#!/usr/bin/python
+"""
+assyserver.py - serve assembly drawings from a long running process
+
+Started by "assygen.py --serve ADDRESS".  Listens for HTTP on host:port, or
+on a unix socket when ADDRESS is a path, and answers
+
+    GET /assy?base=BASE_NAME[&side=top|bottom|both][&group_by=KEY][&detail=1]
+
+with the PDF assygen would write for BASE_NAME, relative to the root folder
+the server was started with.  The parsed Gerber layers of each side and
+the placement data are kept in memory, keyed by the paths, modification
+times and sizes of their files, so that only the first drawing of a board
+pays for parsing it; a file that changes is parsed again and the entry it
+replaces dropped.  Once the cache holds more than its budget, the entries
+used least recently are evicted.
+
+    GET /stats
+
+returns the state of the cache as JSON.  Requests are served by a fixed
+pool of worker threads sharing the cache.
+"""
+
+from assygen import *
+import os
+import sys
+import stat
+import time
+import json
+import types
+import array
+import Queue
+import signal
+import urlparse
+import threading
+import multiprocessing
+import collections
+import SocketServer
+import BaseHTTPServer
+import cStringIO
+
+log = logging.getLogger("assygen")
+
+def footprint(root):
+    # a rough count of the bytes held by root and everything it refers to,
+    # each object counted once
+    seen = set()
+    todo = [root]
+    total = 0
+    skip = (types.ModuleType, types.ClassType, type, types.FunctionType, types.MethodType)
+    while todo:
+        obj = todo.pop()
+        if id(obj) in seen or isinstance(obj, skip):
+            continue
+        seen.add(id(obj))
+        total += sys.getsizeof(obj)
+        if isinstance(obj, dict):
+            todo.extend(obj.keys())
+            todo.extend(obj.values())
+        elif isinstance(obj, (list, tuple, set, frozenset)):
+            todo.extend(obj)
+        elif hasattr(obj, "__dict__") and not isinstance(obj, array.array):
+            todo.append(obj.__dict__)
+    return total
+
+def file_stamp(fnames):
+    # what identifies the contents of fnames as far as the cache is concerned
+    stamp = []
+    for fname in fnames:
+        st = os.stat(fname)
+        stamp.append((fname, st.st_mtime, st.st_size))
+    return tuple(stamp)
+
+
+class BoardCache:
+    """
+    Parsed boards and placement files, least recently used first.  Each
+    entry is known by a name, what it was loaded from, and a stamp of the
+    files it was loaded from; an entry whose files changed is replaced
+    rather than kept alongside the new one.  Workers asking for an entry
+    another worker is loading wait for it instead of loading it again.
+    """
+
+    def __init__(self, budget):
+        self.budget = budget
+        self.entries = collections.OrderedDict()  # (name, stamp) -> (value, size)
+        self.current = {}       # name -> the key of its entry
+        self.loading = {}       # key -> Event set when its load is over
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    def get(self, name, stamp, load):
+        key = (name, stamp)
+        while True:
+            with self.lock:
+                if key in self.entries:
+                    entry = self.entries.pop(key)
+                    self.entries[key] = entry
+                    self.hits += 1
+                    return entry[0]
+                pending = self.loading.get(key)
+                if pending is None:
+                    pending = self.loading[key] = threading.Event()
+                    self.misses += 1
+                    break
+            # loaded by another worker, or failed there, look again
+            pending.wait()
+
+        try:
+            value = load()
+            size = footprint(value)
+            with self.lock:
+                old = self.current.get(name)
+                if old in self.entries:
+                    self.drop(old)
+                self.entries[key] = (value, size)
+                self.current[name] = key
+                self.size += size
+                self.evict()
+            return value
+        finally:
+            with self.lock:
+                del self.loading[key]
+            pending.set()
+
+    def drop(self, key):
+        value, size = self.entries.pop(key)
+        self.size -= size
+        if self.current.get(key[0]) == key:
+            del self.current[key[0]]
+
+    def evict(self):
+        # the newest entry stays even when it is over the budget on its own
+        while self.size > self.budget and len(self.entries) > 1:
+            key = next(iter(self.entries))
+            log.debug("Evict %s", key[0])
+            self.drop(key)
+            self.evictions += 1
+
+    def status(self):
+        with self.lock:
+            return {"entries": len(self.entries), "bytes": self.size, "budget": self.budget,
+                    "hits": self.hits, "misses": self.misses, "evictions": self.evictions}
+
+
+class RequestError(Exception):
+    def __init__(self, status, message):
+        Exception.__init__(self, message)
+        self.status = status
+
+
+class AssyService:
+    # what the workers share: the settings, the root folder and the cache
+    sides = {"top": ["Top"], "bottom": ["Bottom"], "both": ["Top", "Bottom"]}
+
+    def __init__(self, root, config, budget, pool=None):
+        self.root = os.path.realpath(root)
+        self.config = config
+        self.cache = BoardCache(budget)
+        self.pool = pool    # parses Gerber files, None to parse them in the worker
+
+    def base_name(self, name):
+        base = os.path.realpath(os.path.join(self.root, name))
+        if not base.startswith(os.path.join(self.root, "")):
+            raise RequestError(403, "%s is outside the served folder" % name)
+        return base
+
+    def render(self, query):
+        if not "base" in query:
+            raise RequestError(400, "No base name given")
+        base = self.base_name(query["base"])
+        side = query.get("side", "both")
+        group_by = query.get("group_by", "value")
+        if not side in self.sides or not group_by in PickAndPlaceFile.group_keys:
+            raise RequestError(400, "Unknown side or grouping")
+        detail = query.get("detail", "0") == "1"
+        layers = self.sides[side]
+
+        config, pool = self.config, self.pool
+        try:
+            pf = self.cache.get(("pick and place", base, group_by), file_stamp([base+".CSV"]),
+                                lambda: loadPickAndPlace(base, group_by))
+            parsed = []
+            for layer in layers:
+                files = [f[0] for f in gerberLayers(base, layer)]
+                parsed.append(self.cache.get(("gerber", base, layer), file_stamp(files),
+                                             lambda: parseGerber(base, layer, config, pool=pool)))
+        except EnvironmentError, e:
+            raise RequestError(404, "%s: %s" % (e.filename, e.strerror))
+        except (GerberError, PickAndPlaceError), message:
+            raise RequestError(422, str(message))
+
+        out = cStringIO.StringIO()
+        canv = canvas.Canvas(out)
+        for layer, board in zip(layers, parsed):
+            producePrintoutsForLayer(base, layer, canv, True, config, detail, pf=pf, parsed=board)
+        canv.save()
+        return out.getvalue()
+
+
+class AssyRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    server_version = "assygen"
+
+    def do_GET(self):
+        url = urlparse.urlparse(self.path)
+        service = self.server.service
+        if url.path == "/stats":
+            self.reply("application/json", json.dumps(service.cache.status()))
+        elif url.path == "/assy":
+            start = time.time()
+            try:
+                pdf = service.render(dict(urlparse.parse_qsl(url.query)))
+            except RequestError, e:
+                self.send_error(e.status, str(e))
+                return
+            except Exception:
+                log.exception("%s failed", self.path)
+                self.send_error(500)
+                return
+            self.reply("application/pdf", pdf)
+            log.info("%s: %d bytes in %.2f s", self.path, len(pdf), time.time() - start)
+        else:
+            self.send_error(404)
+
+    def reply(self, content_type, body):
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def address_string(self):
+        # unix socket peers have no address
+        if isinstance(self.client_address, tuple):
+            return self.client_address[0]
+        return "local"
+
+    def log_message(self, format, *args):
+        log.debug("%s %s", self.address_string(), format % args)
+
+
+class WorkerPoolMixIn:
+    # hands each accepted connection to one of a fixed number of threads,
+    # rather than a thread of its own as SocketServer.ThreadingMixIn does
+    workers = 4
+
+    def start_workers(self):
+        self.queue = Queue.Queue()
+        self.threads = []
+        for i in range(self.workers):
+            thread = threading.Thread(target=self.work)
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def process_request(self, request, client_address):
+        self.queue.put((request, client_address))
+
+    def work(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            request, client_address = item
+            try:
+                self.finish_request(request, client_address)
+            except:
+                self.handle_error(request, client_address)
+            self.shutdown_request(request)
+
+    def stop_workers(self):
+        for thread in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+
+
+class AssyHTTPServer(WorkerPoolMixIn, BaseHTTPServer.HTTPServer):
+    pass
+
+class AssyUnixServer(WorkerPoolMixIn, SocketServer.UnixStreamServer):
+    pass
+
+
+def serve(address, config, workers=4, budget=512*1024*1024, root="."):
+    """
+    Serves drawings of the boards under root on address, host:port or the
+    path of a unix socket, until interrupted.
+    """
+    # the processes that parse Gerber files are forked here, before there
+    # are any threads whose locks they could inherit held
+    pool = None
+    processes = config.jobs or multiprocessing.cpu_count()
+    if processes > 1:
+        pool = multiprocessing.Pool(processes)
+    service = AssyService(root, config, budget, pool)
+    if ":" in address:
+        host, port = address.rsplit(":", 1)
+        server = AssyHTTPServer((host, int(port)), AssyRequestHandler)
+    else:
+        # a socket left behind by an earlier server is in the way
+        if os.path.exists(address) and stat.S_ISSOCK(os.stat(address).st_mode):
+            os.unlink(address)
+        server = AssyUnixServer(address, AssyRequestHandler)
+    server.service = service
+    server.workers = workers
+    server.start_workers()
+    log.info("Serving %s on %s with %d workers, %d MB of cache", service.root, address, workers,
+             budget // (1024*1024))
+    # wind down on SIGTERM as on an interrupt, letting the workers finish
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+    finally:
+        server.server_close()
+        server.stop_workers()
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+        if not ":" in address:
+            os.unlink(address)
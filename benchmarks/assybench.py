@@ -0,0 +1,228 @@
+#!/usr/bin/env python
+# {{{ Top
+"""
+assybench.py - end-to-end scaling benchmark for assygen
+
+Generates synthetic board sets, each a matching GTL/GTO/GBL/GBO file set
+and a KiCad position file, and runs producePrintoutsForLayer for both
+sides of each board into one PDF.  A board is given as
+
+    size:components:groups
+
+that is the width of a square board in mm, the number of components
+(half of them on each side) and the number of distinct values they are
+grouped by; every six groups on a side make one more assembly page.
+
+Each board is measured in a process of its own, so that peak resident
+memory means something: the wall time for each side, the peak RSS and
+the RSS before any work was done, the tracemalloc peak where the Python
+running the benchmark has tracemalloc (None otherwise), and the size of
+the PDF.  The results are printed as a table and can be written as JSON,
+to be kept and compared from release to release.
+
+    python benchmarks/assybench.py
+    python benchmarks/assybench.py --boards 50:100:12,200:2000:120 --json scaling.json
+"""
+# }}}
+# {{{ Imports
+import os
+import sys
+import time
+import json
+import math
+import random
+import shutil
+import resource
+import tempfile
+import argparse
+import subprocess
+
+here = os.path.dirname( os.path.abspath( __file__ ) )
+sys.path.insert( 0, os.path.join( here, os.pardir ) )
+
+from gerberbench import Header, Move
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+benchmarkVersion = 1
+defaultBoards = "50:50:6,100:200:24,200:1000:120,300:4000:480,400:10000:1200"
+# }}}
+# {{{ Generators
+def Components( size, count, groups, rnd ):
+    # (reference, value, x, y, side) for count components spread over a
+    # size mm board, with KiCad's downward y axis
+    parts = []
+    for i in xrange( count ):
+        value = "V%d" % rnd.randrange( groups )
+        side = ( "F.Cu", "B.Cu" )[i % 2]
+        parts.append( ("U%d" % (i+1), value, rnd.uniform( 2, size-2 ), -rnd.uniform( 2, size-2 ), side) )
+    return parts
+
+def WritePositions( fname, parts ):
+    out = open( fname, 'w' )
+    out.write( "Ref    Val                  Package         PosX       PosY        Rot     Side\n" )
+    for ref, value, x, y, side in parts:
+        out.write( "%-8s %-16s %-16s %9.4f %10.4f %8.1f    %s\n" % (ref, value, "Package:p", x, y, 0.0, side) )
+    out.close()
+
+def WriteCopper( fname, size, parts, rnd ):
+    # two pads per component, tracks between neighbouring ones and a
+    # ground pour around the edge
+    out = open( fname, 'w' )
+    Header( out )
+    out.write( "%ADD10R,0.800000X1.000000*%\n%ADD11C,0.250000*%\n" )
+    out.write( "D10*\n" )
+    for ref, value, x, y, side in parts:
+        Move( out, x - 0.9, y, 3 )
+        Move( out, x + 0.9, y, 3 )
+    out.write( "D11*\n" )
+    for (r1, v1, x1, y1, s1), (r2, v2, x2, y2, s2) in zip( parts, parts[1:] ):
+        if math.hypot( x2-x1, y2-y1 ) < size / 4.0:
+            Move( out, x1 + 0.9, y1, 2 )
+            Move( out, x1 + 0.9, y2, 1 )
+            Move( out, x2 - 0.9, y2, 1 )
+    out.write( "G36*\n" )
+    for i, (x, y) in enumerate( [ (0, 0), (size, 0), (size, -size), (0, -size), (0, 0) ] ):
+        Move( out, x, y, 2 if i == 0 else 1 )
+    Move( out, 1, -1, 2 )
+    for x, y in [ (1, 1-size), (size-1, 1-size), (size-1, -1), (1, -1) ]:
+        Move( out, x, y, 1 )
+    out.write( "G37*\nM02*\n" )
+    out.close()
+
+def WriteOverlay( fname, size, parts ):
+    # a component outline for each part and a board outline
+    out = open( fname, 'w' )
+    Header( out )
+    out.write( "%ADD10C,0.150000*%\nD10*\n" )
+    for ref, value, x, y, side in parts:
+        Move( out, x - 1.6, y - 0.9, 2 )
+        for cx, cy in [ (x + 1.6, y - 0.9), (x + 1.6, y + 0.9), (x - 1.6, y + 0.9), (x - 1.6, y - 0.9) ]:
+            Move( out, cx, cy, 1 )
+    for i, (x, y) in enumerate( [ (0, 0), (size, 0), (size, -size), (0, -size), (0, 0) ] ):
+        Move( out, x, y, 2 if i == 0 else 1 )
+    out.write( "M02*\n" )
+    out.close()
+
+def GenerateBoard( folder, size, count, groups, seed ):
+    rnd = random.Random( seed )
+    base = os.path.join( folder, "board" )
+    parts = Components( size, count, groups, rnd )
+    WritePositions( base + ".CSV", parts )
+    for side, letter in ( ("F.Cu", "T"), ("B.Cu", "B") ):
+        onSide = [ p for p in parts if p[4] == side ]
+        WriteCopper( base + ".G%sL" % letter, size, onSide, rnd )
+        WriteOverlay( base + ".G%sO" % letter, size, onSide )
+    return base
+# }}}
+# {{{ Measure
+def PeakRSS():
+    # in kB, which is what Linux reports ru_maxrss in
+    return resource.getrusage( resource.RUSAGE_SELF ).ru_maxrss
+
+def Measure( base, result ):
+    # runs in a process of its own, started by Run
+    rssBefore = PeakRSS()
+    from reportlab.pdfgen import canvas
+    import assygen
+    if tracemalloc is not None:
+        tracemalloc.start()
+    pdf = base + "_assy.pdf"
+    canv = canvas.Canvas( pdf )
+    times = {}
+    for layer in ( "Top", "Bottom" ):
+        start = time.time()
+        assygen.producePrintoutsForLayer( base, layer, canv )
+        times[layer] = time.time() - start
+    start = time.time()
+    canv.save()
+    times['save'] = time.time() - start
+    tracePeak = None
+    if tracemalloc is not None:
+        tracePeak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    out = open( result, 'w' )
+    json.dump( { 'seconds': times,
+                 'total': sum( times.values() ),
+                 'rssBefore': rssBefore,
+                 'rssPeak': PeakRSS(),
+                 'tracemallocPeak': tracePeak,
+                 'pdfBytes': os.path.getsize( pdf ),
+                 'pages': canv.getPageNumber() - 1 }, out )
+    out.close()
+
+def Run( board, seed ):
+    size, count, groups = board
+    folder = tempfile.mkdtemp( prefix="assybench" )
+    try:
+        base = GenerateBoard( folder, size, count, groups, seed )
+        result = os.path.join( folder, "result.json" )
+        devnull = open( os.devnull, 'w' )
+        # assygen talks a lot on stdout, keep it out of the table
+        status = subprocess.call( [ sys.executable, os.path.abspath( __file__ ), "--measure", base, result ],
+                                  stdout=devnull, cwd=folder )
+        devnull.close()
+        if status:
+            raise RuntimeError( "assygen failed on board %d:%d:%d" % board )
+        f = open( result )
+        measured = json.load( f )
+        f.close()
+        measured.update( { 'size': size, 'components': count, 'groups': groups,
+                           'gerberBytes': sum( [ os.path.getsize( base + ext )
+                                                 for ext in ( ".GTL", ".GTO", ".GBL", ".GBO" ) ] ) } )
+        return measured
+    finally:
+        shutil.rmtree( folder )
+# }}}
+# {{{ __MAIN__
+def ParseBoards( text ):
+    boards = []
+    for item in text.split( "," ):
+        size, count, groups = item.split( ":" )
+        boards.append( (int( size ), int( count ), int( groups )) )
+    return boards
+
+def Main( argv ):
+    if argv[:1] == [ "--measure" ]:
+        Measure( argv[1], argv[2] )
+        return 0
+
+    parser = argparse.ArgumentParser( description="Measure how assygen scales with board size, "
+                                                  "component count and page count." )
+    parser.add_argument( "--boards", default=defaultBoards,
+                         help="comma separated size:components:groups boards, size in mm" )
+    parser.add_argument( "--seed", type=int, default=1 )
+    parser.add_argument( "--json", help="write the results to this file" )
+    args = parser.parse_args( argv )
+    try:
+        boards = ParseBoards( args.boards )
+    except ValueError:
+        parser.error( "boards are given as size:components:groups" )
+
+    results = { 'version': benchmarkVersion,
+                'python': sys.version.split()[0],
+                'boards': [] }
+    print "%5s %6s %6s %5s %9s %8s %8s %8s %10s %10s" % ("size", "parts", "groups", "pages", "gerber kB",
+                                                         "top s", "bottom s", "total s", "peak RSS kB",
+                                                         "PDF kB")
+    for board in boards:
+        r = Run( board, args.seed )
+        results['boards'].append( r )
+        print "%5d %6d %6d %5d %9d %8.2f %8.2f %8.2f %10d %10d" % (r['size'], r['components'], r['groups'],
+                                                                   r['pages'], r['gerberBytes'] // 1024,
+                                                                   r['seconds']['Top'], r['seconds']['Bottom'],
+                                                                   r['total'], r['rssPeak'],
+                                                                   r['pdfBytes'] // 1024)
+
+    if args.json:
+        f = open( args.json, 'w' )
+        json.dump( results, f, indent=2, sort_keys=True )
+        f.close()
+    return 0
+
+if __name__ == "__main__":
+    sys.exit( Main( sys.argv[1:] ) )
+# }}}
@@ -0,0 +1,357 @@
+#!/usr/bin/env python
+# {{{ Top
+"""
+gerberbench.py - micro-benchmarks for the gerber2pdf parser
+
+Generates synthetic RS-274X files of a chosen size, one per kind of
+content, and times each stage of getting them onto paper separately:
+
+    tokenize    GerberScanner splitting the file into blocks
+    interpret   the GerberMachine handling every block, with nothing drawn
+                (GerberMachine.MeasureFile)
+    record      interpreting the file into an optimized DisplayList
+    flash       flashing every aperture the file defines a fixed number
+                of times, aperture templates included
+    pdf         replaying the recording onto a reportlab canvas and
+                writing out the PDF
+
+The files are:
+
+    flashes     round, rectangular, obround and polygon pads, some with holes
+    tracks      long runs of connected track segments
+    pours       G36/G37 copper pours with many-sided outlines
+    arcs        multi-quadrant circular interpolation, stroked and in pours
+    macros      aperture macros with thermal, outline, polygon, vector line
+                and circle primitives
+
+Results are written as JSON.  They are compared against a baseline file
+(baseline.json next to this script unless --baseline says otherwise), and
+the exit status is 1 if any stage got slower than the tolerance allows,
+both in seconds and relative to a short fixed pure Python workload that is
+run in turn with the stages of each file.  The second keeps a baseline
+taken on one machine roughly usable on another.
+
+No baseline is shipped, as timings only mean something on the machine
+they were taken on: take one with --save-baseline before changing the
+parser.  A baseline taken with another version of the parser or of this
+script is not compared against, since it did not time the same work.
+
+    python benchmarks/gerberbench.py                 # run and compare
+    python benchmarks/gerberbench.py --save-baseline # run and store as baseline
+    python benchmarks/gerberbench.py --size 20000 --cases tracks,pours --json out.json
+"""
+# }}}
+# {{{ Imports
+import os
+import sys
+import time
+import gc
+import json
+import math
+import random
+import shutil
+import tempfile
+import argparse
+
+sys.path.insert( 0, os.path.join( os.path.dirname( os.path.abspath( __file__ ) ), os.pardir ) )
+
+from gerber2pdf import *
+from reportlab.pdfgen import canvas
+
+benchmarkVersion = 1
+# }}}
+# {{{ Generators
+def Coordinate( value ):
+    # mm in the %FSLAX46Y46*% format every generated file uses
+    return "%d" % int( round( value * 1e6 ) )
+
+def Header( out ):
+    out.write( "%FSLAX46Y46*%\n%MOMM*%\nG01*\n" )
+
+def Move( out, x, y, d ):
+    out.write( "X%sY%sD%02d*\n" % (Coordinate(x), Coordinate(y), d) )
+
+def GenerateFlashes( out, size, rnd ):
+    Header( out )
+    apertures = [ "C,0.600000", "C,1.200000X0.500000", "R,1.000000X0.600000",
+                  "R,1.500000X1.500000X0.800000", "O,1.800000X0.900000",
+                  "O,0.900000X1.800000X0.400000", "P,1.200000X6X15.0", "P,1.500000X8" ]
+    for i, ap in enumerate( apertures ):
+        out.write( "%%ADD%d%s*%%\n" % (10+i, ap) )
+    for i in xrange( size ):
+        if i % 64 == 0:
+            out.write( "D%d*\n" % (10 + rnd.randrange( len(apertures) )) )
+        Move( out, rnd.uniform( 0, 200 ), rnd.uniform( 0, 150 ), 3 )
+    out.write( "M02*\n" )
+
+def GenerateTracks( out, size, rnd ):
+    Header( out )
+    for i, width in enumerate( (0.15, 0.25, 0.4, 1.0) ):
+        out.write( "%%ADD%dC,%f*%%\n" % (10+i, width) )
+    x, y = 100.0, 75.0
+    for i in xrange( size ):
+        if i % 200 == 0:
+            out.write( "D%d*\n" % (10 + rnd.randrange( 4 )) )
+        if i % 20 == 0:
+            x, y = rnd.uniform( 0, 200 ), rnd.uniform( 0, 150 )
+            Move( out, x, y, 2 )
+        # mostly horizontal, vertical and 45 degree segments, as routed boards are
+        angle = rnd.randrange( 8 ) * math.pi / 4
+        step = rnd.uniform( 0.5, 5.0 )
+        x = min( max( x + step*math.cos( angle ), 0.0 ), 200.0 )
+        y = min( max( y + step*math.sin( angle ), 0.0 ), 150.0 )
+        Move( out, x, y, 1 )
+    out.write( "M02*\n" )
+
+def GeneratePours( out, size, rnd ):
+    Header( out )
+    out.write( "%ADD10C,0.200000*%\nD10*\n" )
+    sides = 48
+    for pour in xrange( max( 1, size // sides ) ):
+        cx, cy = rnd.uniform( 10, 190 ), rnd.uniform( 10, 140 )
+        out.write( "G36*\n" )
+        for i in xrange( sides + 1 ):
+            angle = 2.0 * math.pi * (i % sides) / sides
+            r = rnd.uniform( 4.0, 8.0 ) if i % sides else 6.0
+            Move( out, cx + r*math.cos( angle ), cy + r*math.sin( angle ), 2 if i == 0 else 1 )
+        out.write( "G37*\n" )
+    out.write( "M02*\n" )
+
+def GenerateArcs( out, size, rnd ):
+    Header( out )
+    out.write( "%ADD10C,0.250000*%\nD10*\nG75*\n" )
+    for i in xrange( size ):
+        cx, cy = rnd.uniform( 10, 190 ), rnd.uniform( 10, 140 )
+        r = rnd.uniform( 0.5, 6.0 )
+        a1 = rnd.uniform( 0, 2*math.pi )
+        a2 = a1 + rnd.uniform( 0.2, 2*math.pi - 0.2 )
+        pour = i % 16 == 0
+        if pour:
+            out.write( "G36*\n" )
+        Move( out, cx + r*math.cos( a1 ), cy + r*math.sin( a1 ), 2 )
+        out.write( "G03X%sY%sI%sJ%sD01*\n" % (Coordinate( cx + r*math.cos( a2 ) ),
+                                              Coordinate( cy + r*math.sin( a2 ) ),
+                                              Coordinate( -r*math.cos( a1 ) ),
+                                              Coordinate( -r*math.sin( a1 ) )) )
+        if pour:
+            out.write( "G01*\n" )
+            Move( out, cx + r*math.cos( a1 ), cy + r*math.sin( a1 ), 1 )
+            out.write( "G37*\n" )
+        out.write( "G01*\n" )
+    out.write( "M02*\n" )
+
+def GenerateMacros( out, size, rnd ):
+    Header( out )
+    out.write( "%AMTHERMAL*\n7,0,0,$1,$2,$3,45*%\n" )
+    out.write( "%AMOUTLINE*\n4,1,5,-0.6,-0.4,0.6,-0.4,0.8,0.0,0.6,0.4,-0.6,0.4,-0.6,-0.4,$1*\n"
+               "1,0,0.3,0,0*%\n" )
+    out.write( "%AMPADS*\n$2=$1x0.5*\n1,1,$1,0,0*\n20,1,0.2,-$2,0,$2,0,30*\n"
+               "21,1,$1,0.3,0,0,0*\n5,1,6,0,0,$2,0*%\n" )
+    out.write( "%ADD10THERMAL,1.600000X1.000000X0.250000*%\n" )
+    out.write( "%ADD11OUTLINE,30.0*%\n" )
+    out.write( "%ADD12PADS,1.200000*%\n" )
+    for i in xrange( size ):
+        if i % 64 == 0:
+            out.write( "D%d*\n" % (10 + rnd.randrange( 3 )) )
+        Move( out, rnd.uniform( 0, 200 ), rnd.uniform( 0, 150 ), 3 )
+    out.write( "M02*\n" )
+
+generators = [ ('flashes', GenerateFlashes), ('tracks', GenerateTracks), ('pours', GeneratePours),
+               ('arcs', GenerateArcs), ('macros', GenerateMacros) ]
+# }}}
+# {{{ Stages
+def Calibrate():
+    # a fixed amount of pure Python work, what every timing is measured in
+    total = 0.0
+    for i in xrange( 100000 ):
+        total += math.sqrt( i ) * 0.5
+    return total
+
+def Best( function, repeat ):
+    # the fastest of repeat runs, with the garbage collector kept out of
+    # the way as timeit does
+    best = None
+    for i in xrange( repeat ):
+        gc.collect()
+        gc.disable()
+        try:
+            start = time.time()
+            function()
+            elapsed = time.time() - start
+        finally:
+            gc.enable()
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+def Tokenize( fname ):
+    f = open( fname, 'rb' )
+    scanner = GerberScanner( f, fname )
+    try:
+        for kind, text in scanner.Tokens():
+            pass
+    finally:
+        scanner.close()
+        f.close()
+
+def Machine():
+    return GerberMachine( "", DisplayList(), GerberConfig() )
+
+def Interpret( fname ):
+    Machine().MeasureFile( fname )
+
+def Record( fname ):
+    ok, entry = Machine().RecordFile( fname )
+    if not ok:
+        raise GerberError( "Cannot interpret %s" % fname )
+    return entry
+
+def Flash( gm, count ):
+    # flash every aperture count times on a canvas of its own, starting
+    # without templates so that building them is part of the time
+    for num in sorted( gm.apertures ):
+        gm.templates = {}
+        gm.canv = DisplayList()
+        gm.tool = gm.apertures[num]
+        for i in xrange( count ):
+            gm.x = 0.1 * (i % 100)
+            gm.y = 0.1 * (i // 100)
+            gm.FlashAperture()
+
+def Serialize( displayList, fname ):
+    canv = canvas.Canvas( fname, pagesize=GerberConfig.pageSize )
+    displayList.Replay( canv )
+    canv.showPage()
+    canv.save()
+
+stageNames = ( 'tokenize', 'interpret', 'record', 'flash', 'pdf' )
+
+def Measure( fname, repeat, flashes ):
+    entry = Record( fname )
+    gm = Machine()
+    gm.InterpretFile( fname )
+    pdf = fname + ".pdf"
+    # (stage, function, runs per turn)
+    work = [ ('calibration', Calibrate, 5),
+             ('tokenize',    lambda: Tokenize( fname ), 1),
+             ('interpret',   lambda: Interpret( fname ), 1),
+             ('record',      lambda: Record( fname ), 1),
+             ('flash',       lambda: Flash( gm, flashes ), 1),
+             ('pdf',         lambda: Serialize( entry[0], pdf ), 1) ]
+    # take turns between the stages and the calibration run, so that a slow
+    # spell of the machine neither spoils every run of one stage nor goes
+    # unnoticed by the calibration
+    stages = {}
+    for i in xrange( repeat ):
+        for stage, function, runs in work:
+            elapsed = Best( function, runs )
+            if stage not in stages or elapsed < stages[stage]:
+                stages[stage] = elapsed
+    return { 'calibration': stages.pop( 'calibration' ),
+             'bytes': os.path.getsize( fname ),
+             'operations': len( entry[0] ),
+             'apertures': len( gm.apertures ),
+             'stages': stages }
+# }}}
+# {{{ Compare
+def Compare( results, baseline, tolerance ):
+    # the stages that are slower than in baseline by more than tolerance.  A
+    # stage has to be slower both in seconds and relative to its calibration
+    # run: the first alone misleads on a different machine, the second alone
+    # on a busy one
+    regressions = []
+    for key, what in ( ('version', "benchmark"), ('parser', "parser") ):
+        if baseline.get( key ) != results[key]:
+            print "Baseline taken with %s version %s, this is version %s; not comparing," \
+                  " run with --save-baseline to take a new one" % (what, baseline.get( key ), results[key])
+            return regressions
+    for case, result in sorted( results['cases'].items() ):
+        if case not in baseline['cases'] or baseline['cases'][case]['size'] != result['size']:
+            print "%-8s no baseline at size %d" % (case, result['size'])
+            continue
+        before = baseline['cases'][case]
+        for stage, seconds in sorted( result['stages'].items() ):
+            if not before['stages'].get( stage ):
+                continue
+            ratio = seconds / before['stages'][stage]
+            relative = ratio * before['calibration'] / result['calibration']
+            flag = ""
+            if min( ratio, relative ) > 1.0 + tolerance:
+                regressions.append( (case, stage, ratio, relative) )
+                flag = "  REGRESSION"
+            print "%-8s %-10s %8.4fs  %5.2fx baseline, %5.2fx calibrated%s" % (case, stage, seconds,
+                                                                              ratio, relative, flag)
+    return regressions
+# }}}
+# {{{ __MAIN__
+def Main( argv ):
+    here = os.path.dirname( os.path.abspath( __file__ ) )
+    parser = argparse.ArgumentParser( description="Benchmark the gerber2pdf parser on synthetic files." )
+    parser.add_argument( "--size", type=int, default=5000,
+                         help="flashes, segments, arcs or outline vertices per file" )
+    parser.add_argument( "--repeat", type=int, default=5, help="runs per stage, the best is kept" )
+    parser.add_argument( "--flashes", type=int, default=500, help="flashes per aperture in the flash stage" )
+    parser.add_argument( "--cases", default=",".join( [ name for name, g in generators ] ),
+                         help="comma separated files to generate" )
+    parser.add_argument( "--seed", type=int, default=1 )
+    parser.add_argument( "--json", help="write the results to this file" )
+    parser.add_argument( "--baseline", default=os.path.join( here, "baseline.json" ) )
+    parser.add_argument( "--save-baseline", action="store_true",
+                         help="store the results as the new baseline instead of comparing" )
+    parser.add_argument( "--tolerance", type=float, default=0.25,
+                         help="allowed slowdown before a stage counts as a regression" )
+    args = parser.parse_args( argv )
+
+    cases = args.cases.split( "," )
+    unknown = [ c for c in cases if c not in dict( generators ) ]
+    if unknown:
+        parser.error( "unknown cases: %s" % ", ".join( unknown ) )
+
+    results = { 'version': benchmarkVersion,
+                'parser': gerberParserVersion,
+                'python': sys.version.split()[0],
+                'cases': {} }
+    folder = tempfile.mkdtemp( prefix="gerberbench" )
+    try:
+        for name, generate in generators:
+            if name not in cases:
+                continue
+            fname = os.path.join( folder, name + ".gbr" )
+            out = open( fname, 'w' )
+            generate( out, args.size, random.Random( args.seed ) )
+            out.close()
+            result = Measure( fname, args.repeat, args.flashes )
+            result['size'] = args.size
+            results['cases'][name] = result
+            print "%-8s %s" % (name, "  ".join( [ "%s %.4fs" % (stage, result['stages'][stage])
+                                                  for stage in stageNames ] ))
+    finally:
+        shutil.rmtree( folder )
+
+    if args.json:
+        f = open( args.json, 'w' )
+        json.dump( results, f, indent=2, sort_keys=True )
+        f.close()
+
+    if args.save_baseline:
+        f = open( args.baseline, 'w' )
+        json.dump( results, f, indent=2, sort_keys=True )
+        f.close()
+        print "Baseline written to %s" % args.baseline
+        return 0
+
+    if not os.path.exists( args.baseline ):
+        print "No baseline at %s, run with --save-baseline to create one" % args.baseline
+        return 0
+    f = open( args.baseline )
+    baseline = json.load( f )
+    f.close()
+    regressions = Compare( results, baseline, args.tolerance )
+    if regressions:
+        print "%d stage(s) slower than the baseline allows" % len(regressions)
+        return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit( Main( sys.argv[1:] ) )
+# }}}
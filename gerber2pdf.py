@@ -37,7 +37,6 @@ Introduction:
 Dependencies:
 
     Python (Tested with version 2.6)      : http://www.python.org
-    plex (Tested with version 2.0.0)      : http://pypi.python.org/pypi/plex/
     reportlab (Tested with release 2.5)   : http://www.reportlab.org
     
 Usage:
@@ -56,7 +55,7 @@ Usage:
     If command line arguments are provided, they are interpreted as Gerber 
     file path names (wildcards are supported).  The specified files are 
     converted to a single PDF document (one page per file) using the following 
-    module variables:
+    settings:
     
           Variable         Default Value          Comment
         -----------        -------------------    -------
@@ -73,11 +72,65 @@ Usage:
         gerberScale        1.0, 1.0               X scale, Y scale
         
         gerberOffset       0.0*inch, 0.0*inch     X offset, Y offset
+
+        gerberTile         0                      If true, draw the plot at
+                                                  gerberScale across as many
+                                                  pages as it takes, one page
+                                                  sized tile within the
+                                                  margins per page, instead
+                                                  of placing it with
+                                                  gerberOffset
         
+        gerberCacheDir     $GERBER2PDF_CACHE      Directory for the cache of
+                                                  interpreted Gerber files,
+                                                  None disables caching.
+                                                  Entries are unpickled, so
+                                                  no other user may be able
+                                                  to write to it
+
+        gerberCacheSize    64*1024*1024           Cache size limit in bytes,
+                                                  least recently used entries
+                                                  are evicted first
+
+        gerberJobs         $GERBER2PDF_JOBS or 1  Number of worker processes
+                                                  interpreting files in
+                                                  parallel, 0 uses one per CPU.
+                                                  The variable is read by the
+                                                  programs, not on import
+
+        gerberStream       0                      If true, draw each file as it
+                                                  is read, a chunk at a time,
+                                                  instead of interpreting all
+                                                  of them up front; for inputs
+                                                  too large to hold in memory.
+                                                  Only one chunk of recorded
+                                                  operations is held at a time,
+                                                  but reportlab keeps the PDF
+                                                  text of the page until it is
+                                                  saved, and needs about twice
+                                                  its size then, so memory
+                                                  still grows with the output
+
+        gerberChunkSize    65536                  Drawing operations per chunk
+                                                  when gerberStream is set
+
+        gerberStats        None                   File to write timings and
+                                                  counts of the run to as JSON,
+                                                  "-" for standard output
+
+        gerberProfile      None                   If set, the time and drawing
+                                                  operations of every block are
+                                                  attributed to its aperture,
+                                                  G-code mode and D-code and
+                                                  written to <gerberProfile>.tsv,
+                                                  and as collapsed stacks for
+                                                  flame graph tools to
+                                                  <gerberProfile>.folded
+
     If a file named "gerber2pdf.cfg" exists in the same directory as the Gerber 
     files, its contents are executed as Python statements before translation 
     begins.  Therefore, you can use this file as a configuration file to change 
-    the value of any of the above module variables. For example, this file could 
+    the value of any of the above settings. For example, this file could 
     contain something like this:
     
     gerberPageSize = (6.0*inch, 6.0*inch)
@@ -98,12 +151,26 @@ Usage:
     including a command like this:
     
     fileList = [ file1.gbr, file2.gbr, file3.gbr ]
+
+    The command line also takes these options ahead of the file names:
+
+    --stats FILE    write timings and counts of the run to FILE as JSON, "-"
+                    for standard output (overrides gerberStats)
+    --profile NAME  write a per-aperture, per-mode and per-D-code profile to
+                    NAME.tsv and NAME.folded (overrides gerberProfile)
+    -q, --quiet     only report warnings and errors
+    -v, --verbose   report everything
     
-    If you import this program as an external module, you have access to the above 
-    mentioned module variables and to the function Interact(), which launches the 
-    interactive session described above.  You also have access to the function 
-    Translate( gerberFileNameList ), which translates the specified list of Gerber 
-    files into a PDF document using the current values of the module variables.
+    If you import this program as an external module, the above settings are 
+    the attributes of a GerberConfig object (pageSize for gerberPageSize, and so 
+    on), which you can pass to the function Interact( config ), which launches 
+    the interactive session described above, and to the function 
+    Translate( gerberFileNameList, config ), which translates the specified list 
+    of Gerber files into a PDF document using those settings.  Each 
+    GerberMachine keeps its own settings and extents, so several of them can 
+    run side by side in one process.  GerberMachine.MeasureFile( fname ) 
+    returns the extents of a file without drawing anything, for callers that 
+    need to lay out a page before rendering it.
     
 Home Directory:
 
@@ -221,115 +288,237 @@ Version History:
 
 # }}}
 # {{{ Imports
-try:
-    from plex import *
-except:
-    from Plex import *
 import re
 import math
 import exceptions
 import glob
+import os
 import os.path
+import sys
+import mmap
+import hashlib
+import array
+import itertools
+import zlib
+import cPickle
+import multiprocessing
+import thread
+import time
+import json
+import logging
+try:
+    import numpy
+except ImportError:
+    numpy = None
 from reportlab.lib.units import inch, mm
 # }}}
 # {{{ Globals
-gerberScale      = (1.0,1.0)
-gerberOffset     = (0.0*inch,0.0*inch)
-gerberPageSize   = (8.5*inch,11.0*inch)
-gerberOutputFile = "gerber.pdf"
-gerberFitPage = 0
-gerberMargin = 0.75*inch
-gerberExtents = [1e6,1e6,-1e6,-1e6] # xmin, ymin, xmax, ymax
-# if you add things here don't forget to add them to the
-# global lines in ReadConfiguration, Translate and Interact!!!
-
+# the fill rules as reportlab's canvas numbers them, without loading it
+FILL_EVEN_ODD = 0
+FILL_NON_ZERO = 1
+# progress and diagnostics, shown at the level the entry points choose
+log = logging.getLogger( "gerber2pdf" )
+log.addHandler( logging.NullHandler() )
+# bump whenever a change alters what the interpreter records, so that
+# stale cache entries are not replayed
+gerberParserVersion = 8
+# number of consecutive blocks decoded together by HandleBlocks
+gerberBatchSize = 4096
 # }}}
-# {{{ UpdateExtents
-def UpdateCircleExtents(xc, yc, radius, thickness):
-    UpdateExtents(xc-radius-thickness/2, yc-radius-thickness/2,
-                  xc+radius+thickness/2, yc+radius+thickness/2)
-def UpdateLineExtents(x1, y1, x2, y2, thickness):
-    # xxx overcompensates for thickness
-    if x1 > x2:
-        t = x2
-        x2 = x1
-        x1 = t
-    if y1 > y2:
-        t = y2
-        y2 = y1
-        y1 = t
-    UpdateExtents(x1-thickness,y1-thickness,x2+thickness,y2+thickness)
-def UpdateArcExtents( x1, y1, x2, y2, startAngle, extent, thickness):
-    # xxx doesn't do the arc bit right, pretends its a straight line! :-(
-    UpdateLineExtents(x1, y1, x2, y2, thickness)
-def ResetExtents():
-    global gerberExtents
-    gerberExtents = [1e6,1e6,-1e6,-1e6] # xmin, ymin, xmax, ymax
-
-def UpdatePointExtents( x1, y1 ):
-    global gerberExtents
-    if x1 < gerberExtents[0]:
-        gerberExtents[0] = x1
-    if y1 < gerberExtents[1]:
-        gerberExtents[1] = y1
-    if x1 > gerberExtents[2]:
-        gerberExtents[2] = x1
-    if y1 > gerberExtents[3]:
-        gerberExtents[3] = y1
-
-def UpdateExtents(x1, y1, x2, y2):
-    global gerberExtents
-    if x1 > x2:
-        t = x2
-        x2 = x1
-        x1 = t
-    if y1 > y2:
-        t = y2
-        y2 = y1
-        y1 = t
-    if x1 < gerberExtents[0]:
-        gerberExtents[0] = x1
-    if y1 < gerberExtents[1]:
-        gerberExtents[1] = y1
-    if x2 > gerberExtents[2]:
-        gerberExtents[2] = x2
-    if y2 > gerberExtents[3]:
-        gerberExtents[3] = y2
+# {{{ GerberConfig
+class GerberConfig:
+    """
+    The settings of one translation.  The class attributes are the defaults,
+    a gerber2pdf.cfg file overrides them under their "gerber" prefixed names
+    (gerberPageSize for pageSize, and so on).
+    """
+    pageSize   = (8.5*inch,11.0*inch)
+    outputFile = "gerber.pdf"
+    fitPage    = 0
+    margin     = 0.75*inch
+    scale      = (1.0,1.0)
+    offset     = (0.0*inch,0.0*inch)
+    tile       = 0
+    cacheDir   = os.environ.get( "GERBER2PDF_CACHE" )
+    cacheSize  = 64*1024*1024
+    jobs       = 1
+    stream     = 0
+    chunkSize  = 65536
+    stats      = None
+    profile    = None
+
+    settings = ( 'pageSize', 'outputFile', 'fitPage', 'margin', 'scale', 'offset', 'tile',
+                 'cacheDir', 'cacheSize', 'jobs', 'stream', 'chunkSize', 'stats', 'profile' )
+
+    def __init__( self, **settings ):
+        for name, value in settings.items():
+            if name not in GerberConfig.settings:
+                raise GerberError( "Unknown setting: %s" % name )
+            setattr( self, name, value )
+
+    def FileName( self, name ):
+        # the name a setting goes by in gerber2pdf.cfg
+        return "gerber" + name[0].upper() + name[1:]
+
+def EnvironmentJobs( default=1 ):
+    # the worker processes $GERBER2PDF_JOBS asks for; a value that is not a
+    # number of processes is ignored with a warning
+    value = os.environ.get( "GERBER2PDF_JOBS", "" ).strip()
+    if not value:
+        return default
+    if not value.isdigit():
+        log.warning( "Ignoring GERBER2PDF_JOBS=%s, not a number of processes", value )
+        return default
+    return int( value )
+# }}}
+# {{{ Extents
+class Extents:
+    """
+    Accumulates the bounding box of everything drawn by one GerberMachine.
+    bounds is [xmin, ymin, xmax, ymax] and is inverted while nothing has
+    been drawn.
+    """
+
+    def __init__( self ):
+        self.Reset()
+
+    def Reset( self ):
+        self.bounds = [1e6,1e6,-1e6,-1e6] # xmin, ymin, xmax, ymax
+
+    def Valid( self ):
+        return self.bounds[0] <= self.bounds[2]
+
+    def UpdateCircle(self, xc, yc, radius, thickness):
+        self.Update(xc-radius-thickness/2, yc-radius-thickness/2,
+                    xc+radius+thickness/2, yc+radius+thickness/2)
+
+    def UpdateLine(self, x1, y1, x2, y2, thickness):
+        # xxx overcompensates for thickness
+        if x1 > x2:
+            t = x2
+            x2 = x1
+            x1 = t
+        if y1 > y2:
+            t = y2
+            y2 = y1
+            y1 = t
+        self.Update(x1-thickness,y1-thickness,x2+thickness,y2+thickness)
+
+    def UpdateArc( self, x1, y1, x2, y2, startAngle, extent, thickness):
+        # (x1,y1)-(x2,y2) bounds the whole circle, the arc reaches out as far
+        # as its end points and whichever quadrant points it sweeps over
+        xc = 0.5*(x1+x2)
+        yc = 0.5*(y1+y2)
+        radius = 0.5*abs(x2-x1)
+        if extent < 0.0:
+            startAngle, extent = startAngle+extent, -extent
+        angles = [ startAngle, startAngle+extent ]
+        angle = math.ceil( startAngle/90.0 ) * 90.0
+        while angle < startAngle+extent and len(angles) < 6:
+            angles.append( angle )
+            angle += 90.0
+        pad = 0.5*thickness
+        for angle in angles:
+            x = xc + radius*math.cos( math.radians( angle ) )
+            y = yc + radius*math.sin( math.radians( angle ) )
+            self.Update( x-pad, y-pad, x+pad, y+pad )
+
+    def UpdatePoint( self, x1, y1 ):
+        bounds = self.bounds
+        if x1 < bounds[0]:
+            bounds[0] = x1
+        if y1 < bounds[1]:
+            bounds[1] = y1
+        if x1 > bounds[2]:
+            bounds[2] = x1
+        if y1 > bounds[3]:
+            bounds[3] = y1
+
+    def Update(self, x1, y1, x2, y2):
+        bounds = self.bounds
+        if x1 > x2:
+            t = x2
+            x2 = x1
+            x1 = t
+        if y1 > y2:
+            t = y2
+            y2 = y1
+            y1 = t
+        if x1 < bounds[0]:
+            bounds[0] = x1
+        if y1 < bounds[1]:
+            bounds[1] = y1
+        if x2 > bounds[2]:
+            bounds[2] = x2
+        if y2 > bounds[3]:
+            bounds[3] = y2
 # }}}
 # {{{ gerberError
 class GerberError(exceptions.Exception):
     pass
 # }}}
 # {{{ GerberScanner
-class GerberScanner(Scanner):
-
-    macroDelim = Str("%AM")
-    paramDelim = Str("%")
-    comment = Seq( Str("G04") | Str("G4"), Rep(AnyBut("*\n\r")), Any( "*\n\r" ) )
-    block = Seq( Rep(AnyBut("*%\n\r")), Str("*") ) | Str("M02") | Str("M2")
-    mblock = Seq( Rep(AnyBut("*%")), Str("*") )
-    lineEnd = Str("\n\r") | Str("\n") | Str("\r")
-
-    lexicon = Lexicon( [
-        ( comment, IGNORE ),
-        ( macroDelim, Begin('macro') ),
-        ( paramDelim, Begin('param') ),
-        ( block, "block" ),
-        ( lineEnd, IGNORE ),
-        State('macro', [
-            ( paramDelim, Begin( '' ) ),
-            ( mblock, "mblock" ),
-            ( lineEnd, IGNORE )
-        ]),
-        State('param', [
-            ( paramDelim, Begin( '' ) ),
-            ( block, "pblock" ),
-            ( lineEnd, IGNORE )
-        ])
-    ])
+class GerberScanner:
+    """
+    Splits a Gerber file into 'block', 'pblock' (inside %...%) and 'mblock'
+    (inside %AM...%) tokens.  The file is mapped into memory and each run of
+    tokens in one lexical state is matched by a single regular expression,
+    so no lexer library is needed.
+    """
+
+    lexicon = {
+        '': re.compile( r'(?P<comment>G0?4[^*\n\r]*[*\n\r])|(?P<macro>%AM)|(?P<param>%)'
+                        r'|(?P<block>[^*%\n\r]*\*|M02|M2)|(?P<lineEnd>\n\r|\n|\r)' ),
+        'param': re.compile( r'(?P<end>%)|(?P<pblock>[^*%\n\r]*\*|M02|M2)|(?P<lineEnd>\n\r|\n|\r)' ),
+        'macro': re.compile( r'(?P<end>%)|(?P<mblock>[^*%]*\*)|(?P<lineEnd>\n\r|\n|\r)' ),
+    }
+    nextState = { 'macro' : 'macro', 'param' : 'param', 'end' : '' }
 
     def __init__(self, file, name):
-        Scanner.__init__(self, self.lexicon, file, name )
+        self.name = name
+        self.start = 0
+        try:
+            self.data = mmap.mmap( file.fileno(), 0, access=mmap.ACCESS_READ )
+        except (AttributeError, ValueError, EnvironmentError):
+            # empty files cannot be mapped, and not every file object has a descriptor
+            self.data = file.read()
+        self.tokens = self.Tokens()
+
+    def Tokens( self ):
+        data = self.data
+        end = len(data)
+        pos = 0
+        state = ''
+        while pos < end:
+            for m in self.lexicon[state].finditer( data, pos ):
+                self.start = pos
+                if m.start() != pos:
+                    raise GerberError("Unrecognized input: %r" % data[pos:pos+20])
+                pos = m.end()
+                kind = m.lastgroup
+                if kind in self.nextState:
+                    state = self.nextState[kind]
+                    break
+                if kind != 'comment' and kind != 'lineEnd':
+                    yield kind, m.group()
+            else:
+                if pos < end:
+                    self.start = pos
+                    raise GerberError("Unrecognized input: %r" % data[pos:pos+20])
+
+    def read( self ):
+        try:
+            return self.tokens.next()
+        except StopIteration:
+            return (None, '')
+
+    def position( self ):
+        head = self.data[:self.start]
+        return self.name, head.count('\n') + 1, self.start - head.rfind('\n') - 1
+
+    def close( self ):
+        if isinstance( self.data, mmap.mmap ):
+            self.data.close()
 # }}}
 # {{{ Stump
 class Stump:
@@ -343,9 +532,18 @@ class MacroEquation:
         str = str.replace("$","stump._Star_")
         str = str.replace("x","*")
         self.equation = str.replace("X","*")
+        self.code = compile( self.equation.strip(), "<macro equation>", "exec" )
+
+    # code objects cannot be pickled, the cache compiles them again
+    def __getstate__( self ):
+        return self.equation
+
+    def __setstate__( self, equation ):
+        self.equation = equation
+        self.code = compile( self.equation.strip(), "<macro equation>", "exec" )
         
     def Doit( self, stump ):
-        exec( self.equation.strip() )
+        exec self.code in globals(), { 'stump' : stump }
 # }}}
 # {{{ PrimitiveDefinition
 class PrimitiveDefinition:
@@ -361,36 +559,92 @@ class PrimitiveDefinition:
             str = str.replace("$","stump._Star_")
             if str:
                 self.items.append( str )
+        # one code object evaluates the whole modifier list
+        self.code = compile( "[%s]" % ",".join( self.items ), "<macro primitive>", "eval" )
+
+    def __getstate__( self ):
+        return self.items
+
+    def __setstate__( self, items ):
+        self.items = items
+        self.code = compile( "[%s]" % ",".join( self.items ), "<macro primitive>", "eval" )
     
     def Doit( self, stump ):
-        return map( eval, self.items )                
+        return eval( self.code, globals(), { 'stump' : stump } )
 # }}}
 # {{{ MacroDefinition
 class MacroDefinition:
 
     def __init__( self ):
         self.items = []
+        self.instances = {}
         
     def NewMacro( self, params ):
+        values = tuple( [ float(p) for p in params ] )
+        if values in self.instances:
+            return self.instances[values]
+
         stump = Stump()
         macro = Macro()
-        for i in range(len(params)):
+        for i in range(len(values)):
             attr = "_Star_%d" % (i+1)
-            setattr( stump, attr, eval(params[i]) )
+            setattr( stump, attr, values[i] )
             
         for item in self.items:
             result = item.Doit( stump )
             if result:
                 macro.items.append( result )
+        self.instances[values] = macro
         return macro
 # }}}
 # {{{ Macro
 
 class Macro:
+    stamped = True
     # {{{ __INIT__
     def __init__( self ):
         self.items = []
         self.rectangular = False
+        self.shapes = {}
+    # }}}
+    # {{{ Shape
+
+    def Shape( self, n, unit ):
+        # vertices of outline or polygon primitive n relative to the flash
+        # point, rotated and scaled once per unit, plus their bounding box
+        key = (n, unit)
+        if key in self.shapes:
+            return self.shapes[key]
+        
+        parameters = self.items[n][1:]
+        if self.items[n][0] == 4:
+            npoints = int( parameters[1] )
+            points = []
+            for i in range(npoints+1):
+                points.append( (parameters[2*i+2]*unit, parameters[2*i+3]*unit) )
+            rotation = parameters[-1]
+        else:
+            nvertices = int( parameters[1] )
+            cx = parameters[2]*unit
+            cy = parameters[3]*unit
+            diameter = parameters[4]*unit
+            rotation = parameters[5]
+            angleStep = 2.0 * math.pi / nvertices
+            points = []
+            for i in range(nvertices):
+                points.append( (cx + 0.5 * diameter * math.cos( i * angleStep ),
+                                cy + 0.5 * diameter * math.sin( i * angleStep )) )
+        sintheta = math.sin( rotation * math.pi / 180.0 )
+        costheta = math.cos( rotation * math.pi / 180.0 )
+        
+        vertices = [ (xa * costheta - ya * sintheta, xa * sintheta + ya * costheta)
+                     for xa, ya in points ]
+        xs = [ v[0] for v in vertices ]
+        ys = [ v[1] for v in vertices ]
+        shape = ( vertices, (min(xs), min(ys), max(xs), max(ys)) )
+        self.shapes[key] = shape
+        return shape
+
     # }}}
     # {{{ HandleCircle
 
@@ -405,7 +659,7 @@ class Macro:
         cx = x + parameters[2] * unit
         cy = y + parameters[3] * unit
         c.circle( cx, cy, radius, stroke=0, fill=1 )
-        UpdateCircleExtents(cx,cy,radius, 0)
+        gm.extents.UpdateCircle(cx,cy,radius, 0)
         c.restoreState()
 
     # }}}
@@ -432,7 +686,7 @@ class Macro:
         y1 = y + cy + sintheta * (-0.5 * width)
         x2 = x + cx + costheta * (0.5 * width)
         y2 = y + cy + sintheta * (0.5 * width)
-        UpdateLineExtents(x1,y1,x2,y2, c._lineWidth)
+        gm.extents.UpdateLine(x1,y1,x2,y2, c._lineWidth)
         c.line( x1, y1, x2, y2 )
         c.restoreState()
 
@@ -462,7 +716,7 @@ class Macro:
 
         x2 = x + xb * costheta - yb * sintheta
         y2 = y + xb * sintheta + yb * costheta
-        UpdateLineExtents(x1,y1,x2,y2, c._lineWidth)
+        gm.extents.UpdateLine(x1,y1,x2,y2, c._lineWidth)
         c.line( x1, y1, x2, y2 )
         c.restoreState()
 
@@ -496,14 +750,14 @@ class Macro:
         x2 = x + xb * costheta - yb * sintheta
         y2 = y + xb * sintheta + yb * costheta
 
-        UpdateLineExtents(x1,y1,x2,y2, c._lineWidth)
+        gm.extents.UpdateLine(x1,y1,x2,y2, c._lineWidth)
         c.line( x1, y1, x2, y2 )
         c.restoreState()
 
     # }}}
     # {{{ HandleOutline
 
-    def HandleOutline( self, gm, parameters ):
+    def HandleOutline( self, gm, parameters, n ):
         c,x,y,unit = gm.canv, gm.x, gm.y, gm.unit
  
         c.saveState()
@@ -511,32 +765,23 @@ class Macro:
         if expose == 0:
             c.setStrokeColor(gm.curBgColor)
 
-        npoints = parameters[1]
-        points = []
-        for i in range(npoints+1):
-            points.append( (parameters[2*i+2]*unit, parameters[2*i+3]*unit) )
-        rotation = parameters[-1]
-        sintheta = math.sin( rotation * math.pi / 180.0 )
-        costheta = math.cos( rotation * math.pi / 180.0 )
-
+        vertices, bounds = self.Shape( n, unit )
         path = None
-        for xa,ya in points:
-            x1 = x + xa * costheta - ya * sintheta
-            y1 = y + xa * sintheta + ya * costheta
+        for xa,ya in vertices:
             if path is None:
                 path = c.beginPath()
-                path.moveTo(x1,y1)
+                path.moveTo(x+xa,y+ya)
             else:
-                path.lineTo(x1,y1)
+                path.lineTo(x+xa,y+ya)
         if path:
             c.drawPath(path, stroke=0, fill=1 )
-        UpdateLineExtents(x1,y1,x1,y1, 0.0)
+        gm.extents.Update(x+bounds[0],y+bounds[1],x+bounds[2],y+bounds[3])
         c.restoreState()
 
     # }}}
     # {{{ HandlePolygon
 
-    def HandlePolygon( self, gm, parameters ):
+    def HandlePolygon( self, gm, parameters, n ):
         c,x,y,unit = gm.canv, gm.x, gm.y, gm.unit
  
         c.saveState()
@@ -544,30 +789,18 @@ class Macro:
         if expose == 0:
             c.setStrokeColor(gm.curBgColor)
 
-        nvertices = parameters[1]
-        cx = parameters[2]*unit
-        cy = parameters[3]*unit
-        diameter = parameters[4]*unit
-        rotation = parameters[5]
-        sintheta = math.sin( rotation * math.pi / 180.0 )
-        costheta = math.cos( rotation * math.pi / 180.0 )
-
-        angleStep = 2.0 * math.pi / nvertices
+        vertices, bounds = self.Shape( n, unit )
         path = None
-        for i in range(nvertices):
-            xa = cx + 0.5 * diameter * math.cos( i * angleStep )
-            ya = cy + 0.5 * diameter * math.sin( i * angleStep )
-            x1 = x + xa * costheta - ya * sintheta
-            y1 = y + xa * sintheta + ya * costheta
+        for xa,ya in vertices:
             if path is None:
                 path = c.beginPath()
-                path.moveTo(x1,y1)
+                path.moveTo(x+xa,y+ya)
             else:
-                path.lineTo(x1,y1)
+                path.lineTo(x+xa,y+ya)
         if path:
             path.close()
             c.drawPath(path, stroke=0, fill=1 )
-        UpdateExtents(x1,y1,x1,y1)
+        gm.extents.Update(x+bounds[0],y+bounds[1],x+bounds[2],y+bounds[3])
         c.restoreState()
 
     # }}}
@@ -582,7 +815,7 @@ class Macro:
         outsideDiameter = parameters[2]*unit
         lineThickness = parameters[3]*unit
         gap = parameters[4]*unit
-        nCircles = parameters[5]
+        nCircles = int( parameters[5] )
         crossHairThickness = parameters[6]*unit
         crossHairLength = parameters[7]*unit
         rotation = parameters[8]
@@ -592,7 +825,7 @@ class Macro:
         c.setLineWidth( lineThickness )
         for i in range(nCircles):
             radius = 0.5 * outsideDiameter - 0.5 * lineThickness - i * ( gap + lineThickness )
-            UpdateCircleExtents(x+cx,y+cy,radius, lineThickness)
+            gm.extents.UpdateCircle(x+cx,y+cy,radius, lineThickness)
             c.circle(x+cx,y+cy,radius,stroke=1,fill=0)
 
         c.setLineCap(0)
@@ -607,7 +840,7 @@ class Macro:
         y1 = y + xa * sintheta + ya * costheta
         x2 = x + xb * costheta - yb * sintheta
         y2 = y + xb * sintheta + yb * costheta
-        UpdateLineExtents(x1,y1,x2,y2,c._lineWidth)
+        gm.extents.UpdateLine(x1,y1,x2,y2,c._lineWidth)
         c.line(x1,y1,x2,y2)        
         
         xa = cx
@@ -619,7 +852,7 @@ class Macro:
         y1 = y + xa * sintheta + ya * costheta
         x2 = x + xb * costheta - yb * sintheta
         y2 = y + xb * sintheta + yb * costheta
-        UpdateLineExtents(x1,y1,x2,y2,c._lineWidth)
+        gm.extents.UpdateLine(x1,y1,x2,y2,c._lineWidth)
         c.line(x1,y1,x2,y2)        
 
         c.restoreState()
@@ -643,7 +876,7 @@ class Macro:
 
         radius = 0.25 * (outsideDiameter + insideDiameter)
         c.setLineWidth( 0.5 * (outsideDiameter - insideDiameter) )
-        UpdateCircleExtents(x+cx,y+cy,radius, c._lineWidth)
+        gm.extents.UpdateCircle(x+cx,y+cy,radius, c._lineWidth)
         c.circle(x+cx,y+cy,radius,stroke=1,fill=0)
 
         c.setLineCap(2)
@@ -659,7 +892,7 @@ class Macro:
         y1 = y + xa * sintheta + ya * costheta
         x2 = x + xb * costheta - yb * sintheta
         y2 = y + xb * sintheta + yb * costheta
-        UpdateLineExtents(x1,y1,x2,y2, c._lineWidth)
+        gm.extents.UpdateLine(x1,y1,x2,y2, c._lineWidth)
         c.line(x1,y1,x2,y2)        
         
         xa = cx
@@ -671,14 +904,14 @@ class Macro:
         y1 = y + xa * sintheta + ya * costheta
         x2 = x + xb * costheta - yb * sintheta
         y2 = y + xb * sintheta + yb * costheta
-        UpdateLineExtents(x1,y1,x2,y2, c._lineWidth)
+        gm.extents.UpdateLine(x1,y1,x2,y2, c._lineWidth)
         c.line(x1,y1,x2,y2)        
         c.restoreState()        
 
     # }}}
     # {{{ Flash
     def Flash( self, gm ):
-        for primitive in self.items:
+        for n, primitive in enumerate( self.items ):
             id = primitive[0]
             if id == 1:
                 self.HandleCircle( gm, primitive[1:] )
@@ -689,9 +922,9 @@ class Macro:
             elif id == 22:
                 self.HandleLineLowerLeft( gm, primitive[1:] )
             elif id == 4:
-                self.HandleOutline( gm, primitive[1:] )
+                self.HandleOutline( gm, primitive[1:], n )
             elif id == 5:
-                self.HandlePolygon( gm, primitive[1:] )
+                self.HandlePolygon( gm, primitive[1:], n )
             elif id == 6:
                 self.HandleMoire( gm, primitive[1:] )
             elif id == 7:
@@ -702,6 +935,7 @@ class Macro:
 # {{{ CircleAperture
 
 class CircleAperture:
+    stamped = True
 
     def __init__( self, parameters ):
         self.od = float(parameters[0])
@@ -722,25 +956,19 @@ class CircleAperture:
             
     def Flash( self, gm ):
         c = gm.canv
-        UpdateCircleExtents(gm.x, gm.y, 0.5*self.od*gm.unit,0)
-        c.circle( gm.x, gm.y, 0.5*self.od*gm.unit, stroke=0, fill=1 )
-        if self.hole == 'round':
-            c.setFillColor( gm.curBgColor )
-            c.circle( gm.x, gm.y, 0.5*self.holeDiam*gm.unit, stroke=0, fill=1)
-            c.setFillColor (gm.curFgColor)
-        elif self.hole == 'rect':
-            c.setFillColor( gm.curBgColor )
-            width  = self.holeDiamX*gm.unit
-            height = self.holeDiamY*gm.unit
-            x = gm.x - 0.5*width
-            y = gm.y - 0.5*height
-            c.rect( x, y, width, height, stroke=0, fill=1 )
-            c.setFillColor (gm.curFgColor)
+        gm.extents.UpdateCircle(gm.x, gm.y, 0.5*self.od*gm.unit,0)
+        if self.hole is None:
+            c.circle( gm.x, gm.y, 0.5*self.od*gm.unit, stroke=0, fill=1 )
+        else:
+            path = c.beginPath()
+            path.circle( gm.x, gm.y, 0.5*self.od*gm.unit )
+            FlashHole( gm, self, path )
 
 # }}}        
 # {{{ RectAperture
 
 class RectAperture:
+    stamped = False
 
     def __init__( self, parameters ):
         if len(parameters) < 2:
@@ -763,6 +991,7 @@ class RectAperture:
             self.holeDiamY = float(parameters[3])
         else:
             raise GerberError("Malformed rectangle aperture definition")    
+        self.stamped = self.hole is not None
 
     def Flash( self, gm ):
         c = gm.canv
@@ -770,25 +999,19 @@ class RectAperture:
         height = self.ydimension*gm.unit
         x = gm.x - 0.5*width
         y = gm.y - 0.5*height
-        UpdateExtents(x,y,x+width,y+height)
-        c.rect( x, y, width, height, stroke=0, fill=1 )
-        if self.hole == 'round':
-            c.setFillColor( gm.curBgColor )
-            c.circle( gm.x, gm.y, 0.5*self.holeDiam*gm.unit, stroke=0, fill=1)
-            c.setFillColor (gm.curFgColor)
-        elif self.hole == 'rect':
-            c.setFillColor( gm.curBgColor )
-            width  = self.holeDiamX*gm.unit
-            height = self.holeDiamY*gm.unit
-            x = gm.x - 0.5*width
-            y = gm.y - 0.5*height
+        gm.extents.Update(x,y,x+width,y+height)
+        if self.hole is None:
             c.rect( x, y, width, height, stroke=0, fill=1 )
-            c.setFillColor (gm.curFgColor)
+        else:
+            path = c.beginPath()
+            path.rect( x, y, width, height )
+            FlashHole( gm, self, path )
 
 # }}}
 # {{{ OvalAperture
 
 class OvalAperture:
+    stamped = True
 
     def __init__( self, parameters ):
         if len(parameters) < 2:
@@ -817,24 +1040,18 @@ class OvalAperture:
         radius = 0.5*min(width,height)
         x = gm.x - 0.5*width
         y = gm.y - 0.5*height
-        UpdateExtents(x,y,x+width,y+height)
-        c.roundRect( x, y, width, height, radius, stroke=0, fill=1 )
-        if self.hole == 'round':
-            c.setFillColor( gm.curBgColor )
-            c.circle( gm.x, gm.y, 0.5*self.holeDiam*gm.unit, stroke=0, fill=1)
-            c.setFillColor (gm.curFgColor)
-        elif self.hole == 'rect':
-            c.setFillColor( gm.curBgColor )
-            width  = self.holeDiamX*gm.unit
-            height = self.holeDiamY*gm.unit
-            x = gm.x - 0.5*width
-            y = gm.y - 0.5*height
-            c.rect( x, y, width, height, stroke=0, fill=1 )
-            c.setFillColor (gm.curFgColor)
+        gm.extents.Update(x,y,x+width,y+height)
+        if self.hole is None:
+            c.roundRect( x, y, width, height, radius, stroke=0, fill=1 )
+        else:
+            path = c.beginPath()
+            path.roundRect( x, y, width, height, radius )
+            FlashHole( gm, self, path )
 
 # }}}
 # {{{ PolyAperture
 class PolyAperture:
+    stamped = True
 
     def __init__( self, parameters ):
         if len(parameters) < 2:
@@ -866,30 +1083,1261 @@ class PolyAperture:
         c = gm.canv
         angleStep = 2.0 * math.pi / self.nSides
 
+        radius = 0.5 * self.diameter * gm.unit
         path = None
         for i in range(self.nSides):
-            x = 0.5 * self.diameter * math.cos( i * angleStep + self.rotation )
-            y = 0.5 * self.diameter * math.sin( i * angleStep + self.rotation )
-            UpdatePointExtents(x,y)
+            x = gm.x + radius * math.cos( i * angleStep + self.rotation )
+            y = gm.y + radius * math.sin( i * angleStep + self.rotation )
+            gm.extents.UpdatePoint(x,y)
             if path is None:
                 path = c.beginPath()
                 path.moveTo( x, y )
             else:
                 path.lineTo( x, y )
         path.close()
-        c.drawPath( path, stroke=0, fill=1 )
-        if self.hole == 'round':
-            c.setFillColor( gm.curBgColor )
-            c.circle( gm.x, gm.y, 0.5*self.holeDiam*gm.unit, stroke=0, fill=1)
-            c.setFillColor (gm.curFgColor)
-        elif self.hole == 'rect':
-            c.setFillColor( gm.curBgColor )
-            width  = self.holeDiamX*gm.unit
-            height = self.holeDiamY*gm.unit
-            x = gm.x - 0.5*width
-            y = gm.y - 0.5*height
-            c.rect( x, y, width, height, stroke=0, fill=1 )
-            c.setFillColor (gm.curFgColor)
+        if self.hole is None:
+            c.drawPath( path, stroke=0, fill=1 )
+        else:
+            FlashHole( gm, self, path )
+# }}}
+# {{{ FlashHole
+def FlashHole( gm, aperture, path ):
+    # cut the hole out of the pad outline in path with the even-odd rule, so
+    # that whatever lies underneath shows through instead of being painted
+    # over in the background color
+    if aperture.hole == 'round':
+        path.circle( gm.x, gm.y, 0.5*aperture.holeDiam*gm.unit )
+    elif aperture.hole == 'rect':
+        width  = aperture.holeDiamX*gm.unit
+        height = aperture.holeDiamY*gm.unit
+        path.rect( gm.x - 0.5*width, gm.y - 0.5*height, width, height )
+    gm.canv.drawPath( path, stroke=0, fill=1, fillMode=FILL_EVEN_ODD )
+# }}}
+# {{{ RecordedPath
+class RecordedPath:
+    """
+    A path recorded column-wise: the opcode of each operation, its position
+    in names, in the codes byte array and the arguments of all of them, which
+    are plain numbers, in the values array.
+    """
+
+    names = ( 'moveTo', 'lineTo', 'arcTo', 'close', 'circle', 'rect', 'roundRect' )
+    arity = ( 2, 2, 6, 0, 3, 4, 5 )
+
+    def __init__( self ):
+        self.codes = array.array( 'B' )
+        self.values = array.array( 'd' )
+
+    def __len__( self ):
+        return len(self.codes)
+
+    def moveTo( self, x, y ):
+        self.codes.append( 0 )
+        self.values.extend( (x, y) )
+
+    def lineTo( self, x, y ):
+        self.codes.append( 1 )
+        self.values.extend( (x, y) )
+
+    def arcTo( self, x1, y1, x2, y2, startAng=0, extent=90 ):
+        self.codes.append( 2 )
+        self.values.extend( (x1, y1, x2, y2, startAng, extent) )
+
+    def close( self ):
+        self.codes.append( 3 )
+
+    def circle( self, x, y, r ):
+        self.codes.append( 4 )
+        self.values.extend( (x, y, r) )
+
+    def rect( self, x, y, width, height ):
+        self.codes.append( 5 )
+        self.values.extend( (x, y, width, height) )
+
+    def roundRect( self, x, y, width, height, radius ):
+        self.codes.append( 6 )
+        self.values.extend( (x, y, width, height, radius) )
+
+    def Extend( self, path, start=(0, 0), end=None ):
+        # append the operations of path between two (operation, value) offsets
+        if end is None:
+            end = ( len(path.codes), len(path.values) )
+        self.codes.extend( path.codes[start[0]:end[0]] )
+        self.values.extend( path.values[start[1]:end[1]] )
+
+    def __iter__( self ):
+        names, arity, values = RecordedPath.names, RecordedPath.arity, self.values
+        v = 0
+        for code in self.codes:
+            yield names[code], tuple( values[v:v+arity[code]] )
+            v += arity[code]
+
+    def Build( self, canv ):
+        if isinstance( canv, RenderTarget ):
+            # our own targets draw recorded paths as they are
+            return self
+        path = canv.beginPath()
+        calls = [ getattr( path, name ) for name in RecordedPath.names ]
+        arity, values = RecordedPath.arity, self.values
+        v = 0
+        for code in self.codes:
+            calls[code]( *values[v:v+arity[code]] )
+            v += arity[code]
+        return path
+# }}}
+# {{{ RenderTarget
+class RenderTarget:
+    """
+    What a GerberMachine draws on and a DisplayList replays onto.  A reportlab
+    canvas is one such target as it is; the other backends derive from this
+    class, which gives the pen bookkeeping the interpreter relies on
+    (_lineWidth and _lineCap), paths that are RecordedPaths, the shapes drawn
+    as paths and stamps replayed in place.  A backend has to provide
+    drawPath, the colors and the graphics state, and may draw stamps in a
+    better way of its own, as a PDF canvas does with forms.
+    """
+
+    _lineWidth = 1
+    _lineCap = 0
+
+    def setLineWidth( self, width ):
+        self._lineWidth = width
+
+    def setLineCap( self, mode ):
+        self._lineCap = mode
+
+    def setLineJoin( self, mode ):
+        pass
+
+    def setStrokeColor( self, color ):
+        raise NotImplementedError
+
+    def setFillColor( self, color ):
+        raise NotImplementedError
+
+    def saveState( self ):
+        raise NotImplementedError
+
+    def restoreState( self ):
+        raise NotImplementedError
+
+    def translate( self, dx, dy ):
+        raise NotImplementedError
+
+    def scale( self, x, y ):
+        raise NotImplementedError
+
+    def beginPath( self ):
+        return RecordedPath()
+
+    def drawPath( self, path, stroke=1, fill=0, fillMode=None ):
+        raise NotImplementedError
+
+    def line( self, x1, y1, x2, y2 ):
+        path = RecordedPath()
+        path.moveTo( x1, y1 )
+        path.lineTo( x2, y2 )
+        self.drawPath( path, stroke=1, fill=0 )
+
+    def circle( self, x, y, r, stroke=1, fill=0 ):
+        path = RecordedPath()
+        path.circle( x, y, r )
+        self.drawPath( path, stroke=stroke, fill=fill, fillMode=FILL_NON_ZERO )
+
+    def rect( self, x, y, width, height, stroke=1, fill=0 ):
+        path = RecordedPath()
+        path.rect( x, y, width, height )
+        self.drawPath( path, stroke=stroke, fill=fill, fillMode=FILL_NON_ZERO )
+
+    def roundRect( self, x, y, width, height, radius, stroke=1, fill=0 ):
+        path = RecordedPath()
+        path.roundRect( x, y, width, height, radius )
+        self.drawPath( path, stroke=stroke, fill=fill, fillMode=FILL_NON_ZERO )
+
+    def stamp( self, template, x, y ):
+        self.saveState()
+        self.translate( x, y )
+        template.displayList.Replay( self )
+        self.restoreState()
+# }}}
+# {{{ DisplayList
+class DisplayList( RenderTarget ):
+    """
+    Stands in for a reportlab canvas while a GerberMachine interprets a file,
+    recording every drawing operation so that it can be replayed onto any
+    number of real canvases without parsing the Gerber data again.
+
+    Operations are stored column-wise rather than as one Python object each,
+    so that large files stay small in memory: an opcode byte per operation
+    in codes, the numeric arguments in values, and the indices of any other
+    arguments in refs.  Paths are copied into pathCodes and pathValues when
+    they are drawn, everything else (colors, flags, templates) is kept once
+    in the objects side table.
+    """
+
+    # the operations and the kinds of their arguments: 'd' for a number kept
+    # in values, 'p' for a path, whose start and end offsets into pathCodes
+    # and pathValues are kept in refs, and 'o' for an object kept in the side
+    # table.  The opcode of an operation is its position here
+    signatures = ( ('setLineWidth', 'd'), ('setLineCap', 'o'), ('setLineJoin', 'o'),
+                   ('setStrokeColor', 'o'), ('setFillColor', 'o'),
+                   ('saveState', ''), ('restoreState', ''),
+                   ('translate', 'dd'), ('scale', 'dd'), ('line', 'dddd'),
+                   ('circle', 'dddoo'), ('rect', 'ddddoo'), ('roundRect', 'dddddoo'),
+                   ('drawPath', 'pooo'), ('stamp', 'odd') )
+    opcodes = dict( [ (name, code) for code, (name, kinds) in enumerate( signatures ) ] )
+    columns = { 'codes': 'B', 'values': 'd', 'refs': 'i', 'pathCodes': 'B', 'pathValues': 'd' }
+
+    def __init__( self ):
+        self.codes = array.array( 'B' )
+        self.values = array.array( 'd' )
+        self.refs = array.array( 'i' )
+        self.pathCodes = array.array( 'B' )
+        self.pathValues = array.array( 'd' )
+        self.objects = []
+        self.objectIndex = {}   # id of each object -> its index in objects
+        self._lineWidth = 1
+        self._lineCap = 0
+        self._stateStack = []
+
+    def __len__( self ):
+        return len(self.codes)
+
+    def __getstate__( self ):
+        state = self.__dict__.copy()
+        del state['objectIndex']
+        for name in DisplayList.columns:
+            state[name] = state[name].tostring()
+        return state
+
+    def __setstate__( self, state ):
+        self.__dict__.update( state )
+        for name, typecode in DisplayList.columns.items():
+            setattr( self, name, array.array( typecode, state[name] ) )
+        self.objectIndex = dict( [ (id(obj), i) for i, obj in enumerate( self.objects ) ] )
+
+    # {{{ Append
+    def Append( self, name, args ):
+        code = DisplayList.opcodes[name]
+        self.codes.append( code )
+        for kind, arg in zip( DisplayList.signatures[code][1], args ):
+            if kind == 'd':
+                self.values.append( arg )
+            elif kind == 'p':
+                self.refs.extend( (len(self.pathCodes), len(self.pathValues)) )
+                self.pathCodes.extend( arg.codes )
+                self.pathValues.extend( arg.values )
+                self.refs.extend( (len(self.pathCodes), len(self.pathValues)) )
+            else:
+                self.refs.append( self.Intern( arg ) )
+
+    def Intern( self, obj ):
+        # the index of obj in the side table, adding it if it is not there yet
+        key = id( obj )
+        if key not in self.objectIndex:
+            self.objectIndex[key] = len(self.objects)
+            self.objects.append( obj )
+        return self.objectIndex[key]
+    # }}}
+    # {{{ Walk
+    def Walk( self, start=(0, 0, 0) ):
+        """
+        Yields (position, name, args) for each operation from start on, where
+        position holds the offsets of the operation into codes, values and
+        refs.
+        """
+        signatures, codes, values = DisplayList.signatures, self.codes, self.values
+        refs, objects = self.refs, self.objects
+        pathCodes, pathValues = self.pathCodes, self.pathValues
+        i, v, r = start
+        for i in xrange( i, len(codes) ):
+            name, kinds = signatures[codes[i]]
+            position = (i, v, r)
+            args = []
+            for kind in kinds:
+                if kind == 'd':
+                    args.append( values[v] )
+                    v += 1
+                elif kind == 'p':
+                    path = RecordedPath()
+                    path.codes = pathCodes[refs[r]:refs[r+2]]
+                    path.values = pathValues[refs[r+1]:refs[r+3]]
+                    args.append( path )
+                    r += 4
+                else:
+                    args.append( objects[refs[r]] )
+                    r += 1
+            yield position, name, tuple( args )
+
+    def __iter__( self ):
+        for position, name, args in self.Walk():
+            yield name, args
+
+    def Decode( self, position ):
+        # the name and arguments of the operation at position
+        for position, name, args in self.Walk( position ):
+            return name, args
+    # }}}
+
+    def setLineWidth( self, width ):
+        self._lineWidth = width
+        self.Append( 'setLineWidth', (width,) )
+
+    def setLineCap( self, mode ):
+        self._lineCap = mode
+        self.Append( 'setLineCap', (mode,) )
+
+    def setLineJoin( self, mode ):
+        self.Append( 'setLineJoin', (mode,) )
+
+    def setStrokeColor( self, color ):
+        self.Append( 'setStrokeColor', (color,) )
+
+    def setFillColor( self, color ):
+        self.Append( 'setFillColor', (color,) )
+
+    def saveState( self ):
+        self._stateStack.append( (self._lineWidth, self._lineCap) )
+        self.Append( 'saveState', () )
+
+    def restoreState( self ):
+        self._lineWidth, self._lineCap = self._stateStack.pop()
+        self.Append( 'restoreState', () )
+
+    def translate( self, dx, dy ):
+        self.Append( 'translate', (dx, dy) )
+
+    def scale( self, x, y ):
+        self.Append( 'scale', (x, y) )
+
+    def line( self, x1, y1, x2, y2 ):
+        self.Append( 'line', (x1, y1, x2, y2) )
+
+    def circle( self, x, y, r, stroke=1, fill=0 ):
+        self.Append( 'circle', (x, y, r, stroke, fill) )
+
+    def rect( self, x, y, width, height, stroke=1, fill=0 ):
+        self.Append( 'rect', (x, y, width, height, stroke, fill) )
+
+    def roundRect( self, x, y, width, height, radius, stroke=1, fill=0 ):
+        self.Append( 'roundRect', (x, y, width, height, radius, stroke, fill) )
+
+    def beginPath( self ):
+        return RecordedPath()
+
+    def drawPath( self, path, stroke=1, fill=0, fillMode=None ):
+        self.Append( 'drawPath', (path, stroke, fill, fillMode) )
+
+    def stamp( self, template, x, y ):
+        self.Append( 'stamp', (template, x, y) )
+
+    def Replay( self, canv ):
+        for name, args in self:
+            if name == 'drawPath':
+                path, stroke, fill, fillMode = args
+                canv.drawPath( path.Build( canv ), stroke=stroke, fill=fill, fillMode=fillMode )
+            elif name == 'stamp':
+                StampTemplate( canv, *args )
+            else:
+                getattr( canv, name )( *args )
+
+    def Digest( self ):
+        h = hashlib.sha1()
+        for name, args in self:
+            if name == 'drawPath':
+                args = (args[0].codes.tostring(), args[0].values.tostring()) + args[1:]
+            elif name == 'stamp':
+                args = (args[0].name,) + args[1:]
+            h.update( repr( (name, args) ) )
+        return h.hexdigest()
+
+    # {{{ Optimize
+    graphicsState = ( 'setLineWidth', 'setLineCap', 'setLineJoin',
+                      'setStrokeColor', 'setFillColor' )
+    strokeState = ( 'setLineWidth', 'setLineCap', 'setLineJoin', 'setStrokeColor' )
+    fillState = ( 'setFillColor', )
+
+    def Optimize( self ):
+        """
+        Rewrites the recorded operations into fewer equivalent ones.  Runs of
+        strokes drawn with the same pen become one path, runs of plain fills
+        in the same color become nonzero winding fills, and graphics state
+        changes that are overridden or repeated before anything is drawn are
+        dropped.  A path filled by the even-odd rule only joins a run if it
+        is a contour that does not cross itself, which both rules fill alike.
+        """
+        out = DisplayList()
+        current = {}
+        stack = []
+        pending = {}
+        batch = {}  # sense -> RecordedPath, for the run in batchKind
+        batchKind = None
+
+        for name, args in itertools.chain( self, [ (None, None) ] ):
+            if name in DisplayList.graphicsState:
+                if current.get( name ) == args:
+                    pending.pop( name, None )
+                else:
+                    pending[name] = args
+                continue
+
+            outline = StrokeOutline( name, args )
+            if outline is not None:
+                kind, needs = 'stroke', DisplayList.strokeState
+            else:
+                outline = FillOutline( name, args )
+                kind, needs = 'fill', DisplayList.fillState
+
+            if outline is not None:
+                path, sense = outline
+                if kind == batchKind and not [ n for n in needs if n in pending ]:
+                    if sense not in batch:
+                        batch[sense] = RecordedPath()
+                    batch[sense].Extend( path )
+                    continue
+
+            # the run ends here: draw it, then catch up with the state changes
+            # it did not depend on
+            for sense in sorted( batch ):
+                if batchKind == 'stroke':
+                    out.Append( 'drawPath', (batch[sense], 1, 0, None) )
+                else:
+                    out.Append( 'drawPath', (batch[sense], 0, 1, FILL_NON_ZERO) )
+            batch = {}
+            batchKind = None
+            for state in DisplayList.graphicsState:
+                if state in pending:
+                    current[state] = pending.pop( state )
+                    out.Append( state, current[state] )
+
+            if outline is not None:
+                batchKind = kind
+                batch[sense] = RecordedPath()
+                batch[sense].Extend( path )
+            elif name is not None:
+                out.Append( name, args )
+                if name == 'saveState':
+                    stack.append( current.copy() )
+                elif name == 'restoreState':
+                    current = stack.pop()
+        for name in DisplayList.columns.keys() + [ 'objects', 'objectIndex' ]:
+            setattr( self, name, getattr( out, name ) )
+    # }}}
+# }}}
+# {{{ StrokeOutline
+def StrokeOutline( name, args ):
+    # the path of a stroke-only drawing operation, or None
+    if name == 'line':
+        x1, y1, x2, y2 = args
+        path = RecordedPath()
+        path.moveTo( x1, y1 )
+        path.lineTo( x2, y2 )
+        return path, 0
+    if name == 'drawPath' and args[1] and not args[2]:
+        return args[0], 0
+    return None
+
+def FillOutline( name, args ):
+    # the path of a fill-only drawing operation that can share a nonzero
+    # winding fill with others, with the sense it turns in (1 for
+    # counterclockwise, -1 for clockwise), or None.  Outlines turning in
+    # opposite senses must not share a fill or they cancel where they overlap
+    path = RecordedPath()
+    if name == 'circle':
+        x, y, r, stroke, fill = args
+        if fill and not stroke:
+            path.circle( x, y, r )
+            return path, 1
+    elif name == 'rect':
+        x, y, width, height, stroke, fill = args
+        if fill and not stroke:
+            if width < 0:
+                x, width = x + width, -width
+            if height < 0:
+                y, height = y + height, -height
+            path.rect( x, y, width, height )
+            return path, 1
+    elif name == 'roundRect':
+        x, y, width, height, radius, stroke, fill = args
+        if fill and not stroke:
+            path.roundRect( x, y, width, height, radius )
+            return path, 1
+    elif name == 'drawPath':
+        # None fills by the canvas default, even-odd
+        path, stroke, fill, fillMode = args
+        if fill and not stroke:
+            outline = PolygonOutline( path )
+            if outline is not None and (fillMode == FILL_NON_ZERO or SimpleContour( path )):
+                return outline
+    return None
+
+def PolygonOutline( path ):
+    # path if it is a single straight-edged contour, with its sense, or None
+    codes = path.codes
+    n = len(codes)
+    if n and codes[-1] == 3:    # close
+        n -= 1
+    if not n or codes[0] != 0 or codes[1:n].count( 1 ) != n - 1:  # moveTo, lineTo...
+        return None
+    points = zip( path.values[0::2], path.values[1::2] )
+    area = 0.0
+    for (x1, y1), (x2, y2) in zip( points, points[1:] + points[:1] ):
+        area += x1*y2 - x2*y1
+    if area < 0.0:
+        return path, -1
+    return path, 1
+
+def SimpleContour( path ):
+    # whether the single straight-edged contour path never meets itself but
+    # at the shared ends of consecutive edges.  The edges are swept from left
+    # to right, each one checked against those still overlapping it in x
+    points = zip( path.values[0::2], path.values[1::2] )
+    points = [ p for p, q in zip( points, points[1:] + points[:1] ) if p != q ]
+    n = len(points)
+    if n < 3:
+        return True
+    edges = []
+    for i, (p, q) in enumerate( zip( points, points[1:] + points[:1] ) ):
+        edges.append( (min( p[0], q[0] ), max( p[0], q[0] ), min( p[1], q[1] ), max( p[1], q[1] ), i, p, q) )
+    edges.sort()
+    active = []
+    for edge in edges:
+        xmin, xmax, ymin, ymax, i, p, q = edge
+        active = [ other for other in active if other[1] >= xmin ]
+        for other in active:
+            if other[2] > ymax or other[3] < ymin or (i - other[4]) % n in ( 1, n-1 ):
+                continue
+            if SegmentsMeet( p, q, other[5], other[6] ):
+                return False
+        active.append( edge )
+    return True
+
+def Side( a, b, c ):
+    # 1 if c is left of the line from a to b, -1 if right of it, 0 if on it
+    d = (b[0]-a[0])*(c[1]-a[1]) - (b[1]-a[1])*(c[0]-a[0])
+    return (d > 0.0) - (d < 0.0)
+
+def SegmentsMeet( p1, p2, p3, p4 ):
+    # whether segments p1-p2 and p3-p4 cross or touch; their bounding
+    # boxes are known to overlap, so a point on the line through the other
+    # segment is on that segment when it lies within its box
+    s1, s2 = Side( p1, p2, p3 ), Side( p1, p2, p4 )
+    s3, s4 = Side( p3, p4, p1 ), Side( p3, p4, p2 )
+    if s1 * s2 < 0 and s3 * s4 < 0:
+        return True
+    for s, a, b, c in ( (s1, p1, p2, p3), (s2, p1, p2, p4), (s3, p3, p4, p1), (s4, p3, p4, p2) ):
+        if s == 0 and min( a[0], b[0] ) <= c[0] <= max( a[0], b[0] ) and \
+                      min( a[1], b[1] ) <= c[1] <= max( a[1], b[1] ):
+            return True
+    return False
+# }}}
+# {{{ ExtentsCanvas
+class Discard:
+    # a sink for recorded operations nobody is going to replay
+    def append( self, op ):
+        pass
+
+    def extend( self, ops ):
+        pass
+
+    def __len__( self ):
+        return 0
+
+class ExtentsCanvas( DisplayList ):
+    """
+    Stands in for a canvas when only the extents of a file are wanted.  It
+    keeps track of the pen like a DisplayList, which the interpreter relies
+    on, but throws away every drawing operation and path it is given.
+    """
+
+    def __init__( self ):
+        DisplayList.__init__( self )
+        self.codes = Discard()
+
+    def Append( self, name, args ):
+        pass
+
+    def beginPath( self ):
+        path = RecordedPath()
+        path.codes = path.values = Discard()
+        return path
+# }}}
+# {{{ SpatialIndex
+class SpatialIndex:
+    """
+    A uniform grid over the drawing operations of a DisplayList, so that a
+    page or tile showing part of a layer only replays what falls inside its
+    clip rectangle.  Paths merged by DisplayList.Optimize are indexed one
+    subpath at a time and merged again for each page.  Operations only need
+    to touch the clip rectangle to be included, clipping them at its edges
+    is up to the caller.
+    """
+
+    # grid cells per indexed item
+    density = 0.25
+
+    def __init__( self, displayList ):
+        self.displayList = displayList
+        # seven offsets per item: the position of its operation in the display
+        # list, then the (operation, value) offsets its subpath starts and ends
+        # at in the path the operation draws, or -1 if it is not split up
+        self.items = array.array( 'l' )
+        self.boxes = array.array( 'd' )     # xmin, ymin, xmax, ymax of each item
+        self.states = []    # the graphics state each item is drawn in
+        self.blocks = []    # (position, end op) ranges replayed on every page, with their
+                            # state: saveState/restoreState groups and operations that
+                            # cannot be bounded
+        self.Collect()
+        self.Grid()
+
+    # {{{ Collect
+    def Collect( self ):
+        state = dict.fromkeys( DisplayList.graphicsState )
+        current = None
+        blockStart = None
+        depth = 0
+        for position, name, args in self.displayList.Walk():
+            i = position[0]
+            if depth:
+                if name == 'saveState':
+                    depth += 1
+                elif name == 'restoreState':
+                    depth -= 1
+                    if not depth:
+                        self.blocks.append( (blockStart, i+1, current) )
+                continue
+            if name in DisplayList.graphicsState:
+                state[name] = args
+                current = None
+                continue
+            if current is None:
+                current = tuple( [ state[n] for n in DisplayList.graphicsState ] )
+            if name == 'saveState':
+                blockStart = position
+                depth = 1
+                continue
+            if name in ( 'translate', 'scale', 'restoreState' ):
+                raise GerberError( "Cannot index a display list that transforms the canvas" )
+
+            pad = 0.0
+            if state['setLineWidth'] is not None:
+                pad = 0.5*state['setLineWidth'][0]
+            pieces = OperationBoxes( name, args, pad )
+            if pieces is None:
+                self.blocks.append( (position, i+1, current) )
+                continue
+            for start, end, box in pieces:
+                self.items.extend( position + (start or (-1, -1)) + (end or (-1, -1)) )
+                self.boxes.extend( box )
+                self.states.append( current )
+    # }}}
+    # {{{ Grid
+    def Grid( self ):
+        self.cells = {}
+        self.large = []
+        if not self.states:
+            return
+        boxes = self.boxes
+        self.x0 = min( boxes[0::4] )
+        self.y0 = min( boxes[1::4] )
+        x1 = max( boxes[2::4] )
+        y1 = max( boxes[3::4] )
+        n = max( 1, int( math.sqrt( len(self.states) * SpatialIndex.density ) ) )
+        self.cellWidth = max( (x1-self.x0)/n, 1e-9 )
+        self.cellHeight = max( (y1-self.y0)/n, 1e-9 )
+        # anything spanning more than a few cells is cheaper to test directly
+        limit = 16
+        for item in xrange( len(self.states) ):
+            cx0, cy0, cx1, cy1 = self.Cells( boxes[4*item:4*item+4] )
+            if (cx1-cx0+1) * (cy1-cy0+1) > limit:
+                self.large.append( item )
+                continue
+            for cx in range( cx0, cx1+1 ):
+                for cy in range( cy0, cy1+1 ):
+                    self.cells.setdefault( (cx, cy), [] ).append( item )
+
+    def Cells( self, box ):
+        return ( int( math.floor( (box[0]-self.x0)/self.cellWidth ) ),
+                 int( math.floor( (box[1]-self.y0)/self.cellHeight ) ),
+                 int( math.floor( (box[2]-self.x0)/self.cellWidth ) ),
+                 int( math.floor( (box[3]-self.y0)/self.cellHeight ) ) )
+    # }}}
+    # {{{ Query
+    def Query( self, clip ):
+        # the items touching the clip rectangle, in drawing order
+        found = set()
+        if self.states:
+            cx0, cy0, cx1, cy1 = self.Cells( clip )
+            cells = self.cells
+            for cx in range( cx0, cx1+1 ):
+                for cy in range( cy0, cy1+1 ):
+                    if (cx, cy) in cells:
+                        found.update( cells[(cx, cy)] )
+            found.update( self.large )
+        boxes = self.boxes
+        hits = [ item for item in found
+                 if boxes[4*item] <= clip[2] and boxes[4*item+2] >= clip[0] and
+                    boxes[4*item+1] <= clip[3] and boxes[4*item+3] >= clip[1] ]
+        hits.sort()
+        return hits
+    # }}}
+    # {{{ Cull
+    def Cull( self, clip ):
+        """
+        Returns a DisplayList holding only the operations that touch clip,
+        (xmin, ymin, xmax, ymax), each preceded by the graphics state it was
+        recorded in.
+        """
+        displayList = self.displayList
+        items = self.items
+        result = DisplayList()
+        shown = dict.fromkeys( DisplayList.graphicsState )
+        pieces = [ (items[7*item], item) for item in self.Query( clip ) ]
+        pieces += [ (start[0], -1-block) for block, (start, end, state) in enumerate( self.blocks ) ]
+        pieces.sort()
+
+        def Show( state ):
+            for name, args in zip( DisplayList.graphicsState, state ):
+                if args is not None and shown[name] != args:
+                    shown[name] = args
+                    getattr( result, name )( *args )
+
+        # the subpaths of one drawPath operation are gathered up in path and
+        # drawn together once the next piece belongs to something else
+        path = None
+        for index, item in pieces + [ (None, None) ]:
+            if path is not None and path[0] != index:
+                result.Append( 'drawPath', path[1] )
+                path = None
+            if item is None:
+                break
+
+            if item < 0:
+                start, end, state = self.blocks[-1-item]
+                if state is not None:
+                    Show( state )
+                for position, name, args in displayList.Walk( start ):
+                    if position[0] == end:
+                        break
+                    result.Append( name, args )
+                continue
+
+            fields = tuple( items[7*item:7*item+7] )
+            Show( self.states[item] )
+            name, args = displayList.Decode( fields[0:3] )
+            first, last = fields[3:5], fields[5:7]
+            if first[0] < 0:
+                result.Append( name, args )
+            else:
+                if path is None:
+                    path = ( index, (RecordedPath(),) + args[1:] )
+                path[1][0].Extend( args[0], first, last )
+        return result
+
+    def Replay( self, canv, clip ):
+        self.Cull( clip ).Replay( canv )
+    # }}}
+# }}}
+# {{{ OperationBoxes
+def OperationBoxes( name, args, pad ):
+    """
+    The (path start, path end, bounding box) pieces a drawing operation is
+    indexed by, or None if it cannot be bounded.  Strokes and nonzero winding
+    fills split into their subpaths, which start and end at (operation,
+    value) offsets into the path.  Anything else is a single piece with None
+    for the path range.  pad is half the line width, which strokes reach out
+    by.
+    """
+    if name == 'drawPath':
+        path, stroke, fill, fillMode = args
+        if not stroke:
+            pad = 0.0
+        pieces = PathBoxes( path, pad )
+        if stroke or fillMode == FILL_NON_ZERO or len(pieces) == 1:
+            return pieces
+        box = [ min( [ b[0] for s, e, b in pieces ] ), min( [ b[1] for s, e, b in pieces ] ),
+                max( [ b[2] for s, e, b in pieces ] ), max( [ b[3] for s, e, b in pieces ] ) ]
+        return [ (None, None, box) ]
+    if name == 'stamp':
+        template, x, y = args
+        b = template.bounds
+        if b is None:
+            return []
+        return [ (None, None, (x+b[0], y+b[1], x+b[2], y+b[3])) ]
+    if name == 'line':
+        x1, y1, x2, y2 = args
+        return [ (None, None, (min(x1,x2)-pad, min(y1,y2)-pad, max(x1,x2)+pad, max(y1,y2)+pad)) ]
+    if name in ( 'circle', 'rect', 'roundRect' ):
+        if not args[-2]:
+            pad = 0.0
+        path = RecordedPath()
+        getattr( path, name )( *args[:-2] )
+        start, end, box = PathBoxes( path, pad )[0]
+        return [ (None, None, box) ]
+    return None
+
+def PathBoxes( path, pad ):
+    # split a recorded path into subpaths and bound each one
+    pieces = []
+    box = None
+    start = (0, 0)
+    v = 0
+    for i, (name, args) in enumerate( path ):
+        if name in ( 'moveTo', 'circle', 'rect', 'roundRect' ) and box is not None:
+            pieces.append( (start, (i, v), box) )
+            box = None
+        if box is None:
+            start = (i, v)
+            box = [ 1e300, 1e300, -1e300, -1e300 ]
+        v += len(args)
+        if name in ( 'moveTo', 'lineTo' ):
+            x1, y1 = x2, y2 = args
+        elif name == 'arcTo':
+            # the bounding box of the whole circle, it is good enough here
+            x1, y1, x2, y2 = args[:4]
+        elif name == 'circle':
+            x, y, r = args
+            x1, y1, x2, y2 = x-r, y-r, x+r, y+r
+        elif name in ( 'rect', 'roundRect' ):
+            x1, y1 = args[0], args[1]
+            x2, y2 = x1+args[2], y1+args[3]
+        else:
+            continue
+        box[0] = min( box[0], x1, x2 )
+        box[1] = min( box[1], y1, y2 )
+        box[2] = max( box[2], x1, x2 )
+        box[3] = max( box[3], y1, y2 )
+    if box is not None:
+        pieces.append( (start, (len(path), v), box) )
+    return [ (s, e, (b[0]-pad, b[1]-pad, b[2]+pad, b[3]+pad)) for s, e, b in pieces ]
+# }}}
+# {{{ ApertureTemplate
+class ApertureTemplate:
+    """
+    The drawing operations of one aperture flashed at the origin, or of one
+    step and repeat block.  Flashes of the aperture are drawn by stamping
+    the template at the flash point, and the copies of a block at each step;
+    on a PDF canvas the template becomes a Form XObject, named after its
+    contents so that identical templates share one form.
+    """
+
+    def __init__( self, displayList, bounds, prefix="Ap" ):
+        self.displayList = displayList
+        self.bounds = None
+        if bounds[0] <= bounds[2]:
+            self.bounds = tuple(bounds)
+        self.name = prefix + displayList.Digest()[:20]
+
+def StampTemplate( canv, template, x, y ):
+    if hasattr( canv, 'stamp' ):
+        canv.stamp( template, x, y )
+        return
+    
+    canv.saveState()
+    canv.translate( x, y )
+    if hasattr( canv, 'doForm' ):
+        if not canv.hasForm( template.name ):
+            # the extents of line primitives leave room for the line caps, pad
+            # a little more so that nothing is clipped by the bounding box
+            b = template.bounds
+            canv.beginForm( template.name, b[0]-1, b[1]-1, b[2]+1, b[3]+1 )
+            template.displayList.Replay( canv )
+            canv.endForm()
+        canv.doForm( template.name )
+    else:
+        template.displayList.Replay( canv )
+    canv.restoreState()
+
+class FlashContext:
+    # the part of a GerberMachine an aperture looks at while it is flashed
+    def __init__( self, canv, unit, fgColor, bgColor ):
+        self.canv = canv
+        self.x = 0.0
+        self.y = 0.0
+        self.unit = unit
+        self.curFgColor = fgColor
+        self.curBgColor = bgColor
+        self.extents = Extents()
+# }}}
+# {{{ GerberCache
+class GerberCache:
+    """
+    On-disk cache of interpreted Gerber files.  An entry holds the recorded
+    DisplayList, the aperture table, the extents, the final machine state,
+    the aperture macros and the number of the selected aperture of one file,
+    pickled and compressed.  Entries are keyed on the contents of the file
+    and of any %IF include files it pulls in, the parser version and the
+    machine state the file was interpreted in.  Only whole files are cached:
+    an include depends on the apertures and macros of the file including it,
+    which the key does not cover, so it is interpreted as part of that file.
+
+    Entries are read back with cPickle, which runs whatever a crafted entry
+    tells it to: the folder must not be writable by anyone but its owner.
+    """
+
+    rif = re.compile( r'%IF([^*%]*)\*' )
+
+    def __init__( self, folder, maxSize ):
+        self.folder = folder
+        self.maxSize = maxSize
+        if not os.path.isdir( folder ):
+            os.makedirs( folder )
+
+    def Key( self, fname, context ):
+        h = hashlib.sha1()
+        h.update( "%s\0%s\0" % (gerberParserVersion, context) )
+        self.HashFile( h, fname, [] )
+        return h.hexdigest()
+
+    def HashFile( self, h, fname, parents ):
+        try:
+            f = open( fname, 'rb' )
+            data = f.read()
+            f.close()
+        except IOError:
+            h.update( "missing:%s\0" % fname )
+            return
+        h.update( "%d\0" % len(data) )
+        h.update( data )
+        if fname in parents:
+            return
+        for include in GerberCache.rif.findall( data ):
+            self.HashFile( h, include.strip(), parents + [fname] )
+
+    def Load( self, key ):
+        path = os.path.join( self.folder, key )
+        try:
+            f = open( path, 'rb' )
+            data = f.read()
+            f.close()
+            os.utime( path, None )
+        except EnvironmentError:
+            return None
+        try:
+            entry = cPickle.loads( zlib.decompress( data ) )
+            # (displayList, apertures, extents, state, macroDefinitions, tool)
+            if not isinstance( entry, tuple ) or len(entry) != 6:
+                raise ValueError( "not a cache entry" )
+        except Exception, e:
+            # a truncated or corrupt entry, unpickling it can fail in most
+            # ways; it is a miss, and it is dropped for the next run
+            log.warning( "Dropping unreadable cache entry %s: %s", key, e )
+            try:
+                os.remove( path )
+            except OSError:
+                pass
+            return None
+        return entry
+
+    def Store( self, key, entry ):
+        path = os.path.join( self.folder, key )
+        tmp = "%s.%d.%d.tmp" % (path, os.getpid(), thread.get_ident())
+        try:
+            f = open( tmp, 'wb' )
+            try:
+                f.write( zlib.compress( cPickle.dumps( entry, 2 ) ) )
+            finally:
+                f.close()
+            os.rename( tmp, path )
+        except EnvironmentError:
+            if os.path.exists( tmp ):
+                os.remove( tmp )
+            raise
+        self.Evict()
+
+    def Evict( self ):
+        entries = []
+        total = 0
+        for name in os.listdir( self.folder ):
+            if name.endswith( ".tmp" ):
+                # being written, by this process or another one
+                continue
+            path = os.path.join( self.folder, name )
+            try:
+                st = os.stat( path )
+            except OSError:
+                continue
+            entries.append( (st.st_mtime, st.st_size, path) )
+            total += st.st_size
+        entries.sort()
+        while total > self.maxSize and entries:
+            mtime, size, path = entries.pop(0)
+            try:
+                os.remove( path )
+            except OSError:
+                continue
+            total -= size
+# }}}
+# {{{ GerberStats
+class GerberStats:
+    """
+    Timings and counts of the phases of a run, for the --stats report.
+    Instrument wraps the phase methods of one GerberMachine, and
+    InstrumentCanvas those of the canvas the output is drawn on, in timers
+    on the instance, so that nothing pays for statistics nobody asked for.
+    Times are inclusive: the time spent on blocks covers the flashes, area
+    fills and arcs they draw.  A GerberProfile given as profile instruments
+    the same machines and travels with the report.
+    """
+
+    def __init__( self, profile=None ):
+        self.timers = {}    # name -> [calls, seconds]
+        self.counters = {}
+        self.profile = profile
+
+    def Add( self, name, seconds, calls=1 ):
+        timer = self.timers.setdefault( name, [0, 0.0] )
+        timer[0] += calls
+        timer[1] += seconds
+
+    def Count( self, name, n=1 ):
+        self.counters[name] = self.counters.get( name, 0 ) + n
+
+    def Timed( self, name, function ):
+        # function, timing every call under name, or under name() if it is
+        # callable
+        def Call( *args, **kw ):
+            key = name
+            if callable( name ):
+                key = name()
+            start = time.time()
+            try:
+                return function( *args, **kw )
+            finally:
+                self.Add( key, time.time() - start )
+        return Call
+
+    def Tokens( self, tokens ):
+        # the tokens of a GerberScanner, timing how long each one takes
+        start = time.time()
+        for kind, text in tokens:
+            self.Add( 'tokenize', time.time() - start )
+            self.Count( kind )
+            yield kind, text
+            start = time.time()
+        self.Add( 'tokenize', time.time() - start, 0 )
+
+    def Instrument( self, gm ):
+        if self.profile is not None:
+            self.profile.Instrument( gm )
+        gm.stats = self
+        gm.HandleBlocks = self.Timed( 'blocks', gm.HandleBlocks )
+        gm.FlashAperture = self.Timed( lambda: 'flash ' + gm.tool.__class__.__name__, gm.FlashAperture )
+        gm.ExecuteAreaFill = self.Timed( 'area fill', gm.ExecuteAreaFill )
+        gm.ArcPath = self.Timed( 'arc', gm.ArcPath )
+        gm.RecordFile = self.Timed( 'record', gm.RecordFile )
+        gm.ReplayRecording = self.Timed( 'replay', gm.ReplayRecording )
+
+    def InstrumentCanvas( self, canv ):
+        canv.drawPath = self.Timed( 'drawPath', canv.drawPath )
+        canv.save = self.Timed( 'save', canv.save )
+
+    def Report( self ):
+        timers = dict( [ (name, { 'calls': calls, 'seconds': seconds })
+                         for name, (calls, seconds) in self.timers.items() ] )
+        report = { 'timers': timers, 'counters': dict( self.counters ) }
+        if self.profile is not None:
+            report['profile'] = self.profile.Report()
+        return report
+
+    def Merge( self, report ):
+        # add in the Report of another GerberStats, from a worker process
+        for name, timer in report['timers'].items():
+            self.Add( name, timer['seconds'], timer['calls'] )
+        for name, n in report['counters'].items():
+            self.Count( name, n )
+        if self.profile is not None and 'profile' in report:
+            self.profile.Merge( report['profile'] )
+
+    def Write( self, fname ):
+        report = self.Report()
+        report.pop( 'profile', None )
+        if fname == "-":
+            json.dump( report, sys.stdout, indent=2, sort_keys=True )
+            print
+            return
+        f = open( fname, 'w' )
+        json.dump( report, f, indent=2, sort_keys=True )
+        f.close()
+
+    def ForConfig( config ):
+        # the statistics a run with config collects, or None
+        if config.profile:
+            return GerberStats( GerberProfile() )
+        if config.stats:
+            return GerberStats()
+        return None
+    ForConfig = staticmethod( ForConfig )
+
+    def WriteFor( self, config ):
+        if config.stats:
+            self.Write( config.stats )
+        if config.profile:
+            self.profile.Write( config.profile )
+# }}}
+# {{{ GerberProfile
+class GerberProfile:
+    """
+    Attributes the time spent on each block, and the number of drawing
+    operations it emits, to the file, G-code mode, aperture and D-code it
+    runs with, for tracking down what makes a board slow.  Parameter
+    blocks are attributed to their two letter code, and the batch
+    decoding of coordinates that HandleBlocks does up front to 'decode'.
+    Operations are counted before DisplayList.Optimize merges them, and
+    only when the machine draws on a DisplayList.
+
+    Write produces a tab separated table of the totals per aperture, mode,
+    D-code and full stack, slowest first, and a collapsed stack file (one
+    "frame;frame;... microseconds" line per stack) that flame graph tools
+    read.
+    """
+
+    def __init__( self ):
+        self.samples = {}   # stack -> [calls, seconds, operations]
+        self.labels = {}    # (file, D-code) -> aperture shape or macro name
+        self.file = None
+        self.aperture = None
+        self.dispatched = 0.0
+
+    def Add( self, stack, calls, seconds, operations ):
+        sample = self.samples.setdefault( stack, [0, 0.0, 0] )
+        sample[0] += calls
+        sample[1] += seconds
+        sample[2] += operations
+
+    # {{{ Instrument
+    def Instrument( self, gm ):
+        interpret = gm.Interpret
+        handleBlocks = gm.HandleBlocks
+        dispatchBlock = gm.DispatchBlock
+        handleParameterBlock = gm.HandleParameterBlock
+        handleMacro = gm.HandleMacro
+
+        def Interpret( fname ):
+            self.file = os.path.basename( fname )
+            self.aperture = None
+            for ok in interpret( fname ):
+                yield ok
+
+        def HandleBlocks( blocks ):
+            self.dispatched = 0.0
+            start = time.time()
+            try:
+                handleBlocks( blocks )
+            finally:
+                decode = time.time() - start - self.dispatched
+                self.Add( (self.file, 'decode'), len(blocks), decode, 0 )
+
+        def DispatchBlock( gCode, dCode, mCode ):
+            # all of this wrapper, the profiler's own bookkeeping included,
+            # is taken out of the decode time of HandleBlocks
+            outer = time.time()
+            stack = self.BlockStack( gm, gCode, dCode, mCode )
+            before = Operations( gm.canv )
+            start = time.time()
+            try:
+                dispatchBlock( gCode, dCode, mCode )
+            finally:
+                elapsed = time.time() - start
+                self.Add( stack, 1, elapsed, Operations( gm.canv ) - before )
+                self.dispatched += time.time() - outer
+
+        def HandleParameterBlock( str ):
+            if str[:2] == "AD":
+                m = GerberMachine.rad1.match( str ) or GerberMachine.rad0.match( str )
+                if m is not None:
+                    self.labels[(self.file, m.group(2))] = m.group(3)
+            start = time.time()
+            try:
+                handleParameterBlock( str )
+            finally:
+                self.Add( (self.file, 'parameters', str[:2]), 1, time.time() - start, 0 )
+
+        def HandleMacro( str ):
+            start = time.time()
+            try:
+                handleMacro( str )
+            finally:
+                self.Add( (self.file, 'parameters', 'AM'), 1, time.time() - start, 0 )
+
+        gm.Interpret = Interpret
+        gm.HandleBlocks = HandleBlocks
+        gm.DispatchBlock = DispatchBlock
+        gm.HandleParameterBlock = HandleParameterBlock
+        gm.HandleMacro = HandleMacro
+
+    def BlockStack( self, gm, gCode, dCode, mCode ):
+        # the block about to run as (file, mode, aperture, operation), or
+        # (file, 'G36', operation) inside an area fill
+        if dCode and int( dCode[1:] ) >= 10:
+            self.aperture = "D%d" % int( dCode[1:] )
+            operation = "select"
+        elif dCode:
+            operation = "D%02d" % int( dCode[1:] )
+        elif mCode:
+            operation = mCode
+        else:
+            operation = "D%02d" % gm.dnumber
+        if gm.areaFill or gCode == "G36":
+            return ( self.file, 'G36', operation )
+        if gm.linearInterpolation:
+            mode = 'G01'
+        elif gm.clockWise:
+            mode = 'G02'
+        else:
+            mode = 'G03'
+        aperture = self.aperture
+        if (self.file, aperture) in self.labels:
+            aperture = "%s %s" % (aperture, self.labels[(self.file, aperture)])
+        return ( self.file, mode, aperture or "none", operation )
+    # }}}
+    # {{{ Report
+    def Report( self ):
+        return [ [ list( stack ) ] + sample for stack, sample in self.samples.items() ]
+
+    def Merge( self, report ):
+        for stack, calls, seconds, operations in report:
+            self.Add( tuple( stack ), calls, seconds, operations )
+
+    def Totals( self ):
+        # (kind, key, calls, seconds, operations) rows, slowest first
+        totals = {}
+        for stack, (calls, seconds, operations) in self.samples.items():
+            keys = [ ('stack', ";".join( stack )) ]
+            if len(stack) == 4:
+                keys += [ ('aperture', "%s %s" % (stack[0], stack[2])),
+                          ('mode', stack[1]), ('dcode', stack[3]) ]
+            elif stack[1] == 'G36':
+                keys += [ ('mode', 'G36'), ('dcode', stack[2]) ]
+            else:
+                keys += [ (stack[1], stack[-1]) ]
+            for key in keys:
+                total = totals.setdefault( key, [0, 0.0, 0] )
+                total[0] += calls
+                total[1] += seconds
+                total[2] += operations
+        rows = [ key + tuple( total ) for key, total in totals.items() ]
+        rows.sort( key=lambda row: -row[3] )
+        return rows
+
+    def Write( self, prefix ):
+        f = open( prefix + ".tsv", 'w' )
+        f.write( "kind\tkey\tcalls\tseconds\toperations\tus per call\n" )
+        for kind, key, calls, seconds, operations in self.Totals():
+            f.write( "%s\t%s\t%d\t%.6f\t%d\t%.2f\n" % (kind, key, calls, seconds, operations,
+                                                       1e6 * seconds / max( calls, 1 )) )
+        f.close()
+        f = open( prefix + ".folded", 'w' )
+        for stack, (calls, seconds, operations) in sorted( self.samples.items() ):
+            f.write( "%s %d\n" % (";".join( [ frame.replace( ";", "," ).replace( " ", "_" )
+                                               for frame in stack ] ),
+                                  int( round( seconds * 1e6 ) )) )
+        f.close()
+    # }}}
+
+def Operations( canv ):
+    # drawing operations recorded so far on a DisplayList, paths included
+    return len( getattr( canv, 'codes', () ) ) + len( getattr( canv, 'pathCodes', () ) )
 # }}}
 # {{{ GerberMachine
 class GerberMachine: 
@@ -899,15 +2347,21 @@ class GerberMachine:
     rad0 = re.compile( r'(AD)(D\d\d\d?)([^,]+)\*' )
     rad1 = re.compile( r'(AD)(D\d\d\d?)([^,]+),([. 0-9]+)' )
     rad2 = re.compile( r'X(-?[. 0-9]+)' )
+    rsr = re.compile( r'SR(?:X(\d+))?(?:Y(\d+))?(?:I(-?[.0-9]+))?(?:J(-?[.0-9]+))?\*' )
     # {{{ __init__
 
-    def __init__(self, fileName, canv=None):
+    def __init__(self, fileName, canv=None, config=None):
         from reportlab.pdfgen import canvas
+        if config is None:
+            config = GerberConfig()
+        self.config = config
         if(canv == None):
-            self.canv = canvas.Canvas(fileName, pagesize=gerberPageSize, pageCompression = 1 )
+            self.canv = canvas.Canvas(fileName, pagesize=config.pageSize, pageCompression = 1 )
         else:
             self.canv = canv
 
+        self.extents = Extents()
+        self.stats = None   # a GerberStats once instrumented
         self.Initialize()
 
     # }}}
@@ -919,6 +2373,7 @@ class GerberMachine:
         self.canv.setLineJoin( 1 )
         self.unit = inch
         self.apertures = {}
+        self.templates = {}
         self.macroDefinitions = {}
         self.px = 0.0
         self.py = 0.0
@@ -945,6 +2400,8 @@ class GerberMachine:
         self.singleQuadrant = 1
         self.interpolationScale = 1.0
         self.areaFill = 0
+        self.stepRepeat = None
+        self.batchIndex = 0
         self.fgColor = colors.Color(0.8,0.8,0.8)
         self.bgColor = colors.Color(1,1,1)
         self.curFgColor = self.fgColor
@@ -977,7 +2434,7 @@ class GerberMachine:
                 # print "moveto %s %s" % (self.px, self.py)
             if self.linearInterpolation:
                 if self.x != self.px or self.y != self.py:
-                    UpdateLineExtents(self.px,self.py, self.x, self.y, c._lineWidth)
+                    self.extents.UpdateLine(self.px,self.py, self.x, self.y, c._lineWidth)
                     self.polyPath.lineTo( self.x, self.y )
                     # print "lineto %s %s" % (self.x, self.y )
             else:
@@ -1035,7 +2492,7 @@ class GerberMachine:
             x2 = centerx + radius
             y1 = centery - radius
             y2 = centery + radius
-            UpdateArcExtents( x1, y1, x2, y2, startAngle, extent, c._lineWidth )
+            self.extents.UpdateArc( x1, y1, x2, y2, startAngle, extent, c._lineWidth )
             path.arcTo( x1, y1, x2, y2, startAngle, extent )
             # print "arc %s %s %s %s %s %s" % ( x1, y1, x2, y2, startAngle, extent )
         else:
@@ -1057,7 +2514,7 @@ class GerberMachine:
             y1 = centery - radius
             y2 = centery + radius
 
-            UpdateArcExtents( x1, y1, x2, y2, startAngle, extent, c._lineWidth )
+            self.extents.UpdateArc( x1, y1, x2, y2, startAngle, extent, c._lineWidth )
             path.arcTo( x1, y1, x2, y2, startAngle, extent )
             # print "arc %s %s %s %s %s %s" % ( x1, y1, x2, y2, startAngle, extent )
 
@@ -1075,6 +2532,35 @@ class GerberMachine:
             c.drawPath( self.path, stroke=1, fill=0 )
             self.path = None
 
+    # }}}
+    # {{{ FlashAperture
+
+    def FlashAperture( self ):
+        tool = self.tool
+        if not tool.stamped:
+            tool.Flash( self )
+            return
+        
+        template = self.Template( tool )
+        if template.bounds:
+            b = template.bounds
+            self.extents.Update( self.x+b[0], self.y+b[1], self.x+b[2], self.y+b[3] )
+            StampTemplate( self.canv, template, self.x, self.y )
+
+    def Template( self, tool ):
+        key = ( id(tool), self.unit, id(self.curFgColor), id(self.curBgColor) )
+        if key in self.templates:
+            return self.templates[key][-1]
+
+        record = DisplayList()
+        context = FlashContext( record, self.unit, self.curFgColor, self.curBgColor )
+        tool.Flash( context )
+        record.Optimize()
+        template = ApertureTemplate( record, context.extents.bounds )
+        # keep the key objects alive so that their ids are not reused
+        self.templates[key] = ( tool, self.curFgColor, self.curBgColor, template )
+        return template
+
     # }}}
     
     def DoRectangularPath( self ):
@@ -1150,7 +2636,7 @@ class GerberMachine:
                 self.path.moveTo( self.px, self.py )
             
             if self.linearInterpolation:
-                UpdateLineExtents(self.px,self.py, self.x, self.y, c._lineWidth)
+                self.extents.UpdateLine(self.px,self.py, self.x, self.y, c._lineWidth)
                 self.path.lineTo( self.x, self.y )
             else:
                 self.ArcPath( self.path )
@@ -1165,7 +2651,7 @@ class GerberMachine:
                 
             if self.tool is None:
                 raise GerberError("No aperture selected for flash")
-            self.tool.Flash(self)
+            self.FlashAperture()
             self.dnumber = 0
             
         self.px, self.py = self.x, self.y
@@ -1261,6 +2747,8 @@ class GerberMachine:
     def HandleMCode(self, mCode):
         if mCode in ["M0","M1","M2","M00","M01","M02"]:
             self.Flush()
+            if self.stepRepeat is not None:
+                self.EndStepRepeat()
 #            self.canv.showPage()
         else:
             raise GerberError("Invalid M-Code: %s" % mCode)
@@ -1300,6 +2788,9 @@ class GerberMachine:
         if jCode:
             self.j = self.Value( jCode[1:], self.yFormat )
             
+        self.DispatchBlock( gCode, dCode, mCode )
+
+    def DispatchBlock( self, gCode, dCode, mCode ):
         if dCode:
             self.HandleDCode( dCode )
            
@@ -1320,10 +2811,138 @@ class GerberMachine:
         self.px, self.py = self.x, self.y
 
     # }}}
+    # {{{ HandleBlocks
+
+    def HandleBlocks( self, blocks ):
+        """
+        Same as calling HandleBlock on each block in turn, but the blocks are
+        split into fields with one regular expression pass and the X/Y/I/J
+        fields of the whole batch are decoded column by column.  The index of
+        the block being executed is kept in self.batchIndex for error reports.
+        """
+        self.batchIndex = 0
+        joined = ''.join( blocks )
+        groups = GerberMachine.rb.findall( joined )
+        n = len(groups)
+        if len( ''.join( map( ''.join, groups ) ) ) + n != len(joined):
+            # some block did not match completely, run up to the first bad one
+            n = 0
+            while len( ''.join( groups[n] ) ) + 1 == len( blocks[n] ):
+                n += 1
+            groups = groups[:n]
+        
+        if n:
+            nCodes, gCodes, xCodes, yCodes, iCodes, jCodes, dCodes, mCodes = zip( *groups )
+            modes = None
+            for gCode in set( gCodes ):
+                if gCode and int(gCode[1:]) in (90, 91):
+                    modes = self.BlockModes( gCodes )
+                    break
+            xs = self.DecodeAxis( xCodes, self.xFormat, self.x, modes )
+            ys = self.DecodeAxis( yCodes, self.yFormat, self.y, modes )
+            iv = self.DecodeOffsets( iCodes, self.xFormat )
+            jv = self.DecodeOffsets( jCodes, self.yFormat )
+        
+            for k in xrange( n ):
+                self.batchIndex = k
+                gCode = gCodes[k]
+                if gCode:
+                    self.HandleGCode( gCode )
+                self.x = xs[k]
+                self.y = ys[k]
+                self.i = iv[k]
+                self.j = jv[k]
+                self.DispatchBlock( gCode, dCodes[k], mCodes[k] )
+
+        if n < len(blocks):
+            self.batchIndex = n
+            raise GerberError("Invalid Block: %s" % blocks[n])
+
+    def BlockModes( self, gCodes ):
+        # absolute flag in effect for each block of a batch with G90/G91 switches
+        modes = []
+        absolute = self.absolute
+        for gCode in gCodes:
+            if gCode:
+                num = int(gCode[1:])
+                if num == 90:
+                    absolute = 1
+                elif num == 91:
+                    absolute = 0
+            modes.append( absolute )
+        return modes
+
+    def DecodeFields( self, codes, format ):
+        # values of the non-empty fields of one column, and their block indices
+        left, right = format
+        index = [ k for k, code in enumerate( codes ) if code ]
+        digits = [ codes[k][1:] for k in index ]
+        try:
+            ints = map( int, digits )
+        except ValueError:
+            ints = [ d.strip('+-') and int(d) or 0 for d in digits ]
+
+        if not self.leadingZeroSuppression:
+            # the decimal point sits after the first 'left' digits
+            values = []
+            for d, v in zip( digits, ints ):
+                shift = len(d.lstrip('+-')) - left
+                if shift >= 0:
+                    values.append( v / 10.0**shift * self.unit )
+                else:
+                    values.append( v * 10.0**-shift * self.unit )
+            return index, values
+        
+        divisor = 10.0**right
+        if numpy is not None and ints:
+            return index, numpy.array( ints, dtype=numpy.float64 ) / divisor * self.unit
+        unit = self.unit
+        return index, [ v / divisor * unit for v in ints ]
+
+    def DecodeAxis( self, codes, format, start, modes ):
+        # position on one axis after each block of a batch
+        n = len(codes)
+        index, values = self.DecodeFields( codes, format )
+        if not index:
+            return [ start ] * n
+        
+        if numpy is not None and modes is None:
+            if self.absolute:
+                last = numpy.zeros( n, dtype=numpy.intp )
+                last[index] = numpy.arange( 1, len(index)+1 )
+                table = numpy.concatenate( ( [start], values ) )
+                return table[ numpy.maximum.accumulate( last ) ].tolist()
+            deltas = numpy.zeros( n+1 )
+            deltas[0] = start
+            deltas[numpy.array( index ) + 1] = values
+            return numpy.cumsum( deltas )[1:].tolist()
+
+        if modes is None:
+            modes = [ self.absolute ] * n
+        result = []
+        value = start
+        fields = dict( zip( index, values ) )
+        for k in xrange( n ):
+            if k in fields:
+                if modes[k]:
+                    value = fields[k]
+                else:
+                    value += fields[k]
+            result.append( value )
+        return result
+
+    def DecodeOffsets( self, codes, format ):
+        # I/J values of each block of a batch, zero where absent
+        result = [ 0.0 ] * len(codes)
+        index, values = self.DecodeFields( codes, format )
+        for k, value in zip( index, values ):
+            result[k] = float( value )
+        return result
+    # }}}
     # {{{ Handle AD
     def HandleAD( self, str ):
         if str == "AD*":
-            print "Warning: AD parameter block has no parameters."
+            log.warning( "AD parameter block has no parameters." )
             return
         
         m = GerberMachine.rad1.match( str ) or GerberMachine.rad0.match( str )
@@ -1386,8 +3005,11 @@ class GerberMachine:
     # }}}
     # {{{ HandleIF
     def HandleIF( self, str ):
-        fileName = str[2:]
-        self.ProcessFile( fileName )
+        # interpreted in the apertures and macros of this file, so it is never
+        # cached on its own; the entry of the top level file covers it
+        fileName = str[2:].replace("*","").strip()
+        log.info( "Processing file: %s", fileName )
+        self.ReplayRecording( self.RecordFile( fileName )[1] )
     # }}}
     # {{{ HandleMO
     def HandleMO( self, str ):
@@ -1411,10 +3033,63 @@ class GerberMachine:
             self.canv.setFillColor( self.fgColor )
             self.canv.setStrokeColor(self.fgColor )
 
+    # }}}
+    # {{{ HandleSR
+
+    def HandleSR( self, str ):
+        # a block is drawn into a display list of its own and stamped at
+        # every step once it ends, which is at the next SR or at M02
+        m = GerberMachine.rsr.match( str )
+        if m is None:
+            raise GerberError( "Malformed step and repeat block: %s" % str )
+        if self.stepRepeat is not None:
+            self.EndStepRepeat()
+        nx, ny, i, j = m.groups()
+        nx = int( nx or 1 )
+        ny = int( ny or 1 )
+        if nx * ny <= 1:
+            return
+        self.Flush()
+        target = self.canv
+        if isinstance( target, ExtentsCanvas ):
+            self.canv = ExtentsCanvas()
+        else:
+            self.canv = DisplayList()
+        self.canv._lineWidth = target._lineWidth
+        self.canv._lineCap = target._lineCap
+        self.stepRepeat = ( target, self.extents, nx, ny,
+                            float( i or 0 ) * self.unit, float( j or 0 ) * self.unit )
+        self.extents = Extents()
+
+    def EndStepRepeat( self ):
+        self.Flush()
+        block = self.canv
+        bounds = self.extents.bounds
+        self.canv, self.extents, nx, ny, dx, dy = self.stepRepeat
+        self.stepRepeat = None
+        if bounds[0] > bounds[2]:
+            return
+        template = None
+        if not isinstance( block, ExtentsCanvas ):
+            block.Optimize()
+            template = ApertureTemplate( block, bounds, "SR" )
+        for row in xrange( ny ):
+            for column in xrange( nx ):
+                x, y = column * dx, row * dy
+                self.extents.Update( x+bounds[0], y+bounds[1], x+bounds[2], y+bounds[3] )
+                if template is not None:
+                    StampTemplate( self.canv, template, x, y )
+        # the block may have changed the polarity
+        self.canv.setFillColor( self.curFgColor )
+        self.canv.setStrokeColor( self.curFgColor )
+
     # }}}
     # {{{ HandleMacro
     def HandleMacro( self, str ):
-        if str.find("=") != -1:
+        stripped = str.strip()
+        if stripped[:1] == "0" and stripped[1:2] in (" ", "*"):
+            pass # comment primitive
+        elif str.find("=") != -1:
             self.currentMacro.items.append( MacroEquation( str ) )
         elif str.find(",") != -1:
             self.currentMacro.items.append( PrimitiveDefinition( str ) )
@@ -1440,95 +3115,379 @@ class GerberMachine:
             pass
         elif first2 == "LN":
             pass
+        elif first2 == "SR":
+            self.HandleSR( str )
         else:
-            print "Unimplemented data block: %s" % str
+            log.warning( "Unimplemented data block: %s", str )
     # }}}
     # {{{ ProcessFile
+    cacheState = ( 'unit', 'xFormat', 'yFormat', 'leadingZeroSuppression', 'absolute',
+                   'x', 'y', 'px', 'py', 'linearInterpolation', 'clockWise',
+                   'singleQuadrant', 'interpolationScale', 'dnumber',
+                   'curFgColor', 'curBgColor' )
+
     def ProcessFile( self, fname ):
-        f = open( fname )
-        print "Processing file: %s" % fname
+        log.info( "Processing file: %s", fname )
+        return self.ReplayRecording( self.Record( fname ) )
+
+    def Record( self, fname ):
+        if self.config.cacheDir:
+            return self.ProcessCachedFile( fname )
+        return self.RecordFile( fname )[1]
+
+    def InterpretFile( self, fname ):
+        ok = 1
+        for ok in self.Interpret( fname ):
+            pass
+        return ok
+
+    def Interpret( self, fname ):
+        # interprets fname, yielding after every batch of blocks so that the
+        # caller can take away what has been drawn so far.  The last value
+        # yielded tells whether the file was read without errors
+        f = open( fname, 'rb' )
         scanner = GerberScanner( f, fname )
+        handlers = { 'pblock' : self.HandleParameterBlock,
+                     'mblock' : self.HandleMacro }
+        blocks = []
+        starts = []
+        ok = 1
+        tokens = scanner.Tokens()
+        if self.stats is not None:
+            tokens = self.stats.Tokens( tokens )
         try:
-            while 1:
-                token = scanner.read()
-                if token[0] is None:
-                    break
-                
-                if token[0] == 'block':
-                    if token[1] == "M02" or token[1] == "M2":
-                        self.HandleBlock( "M02*" )
-                    else:
-                        self.HandleBlock( token[1] )
-                elif token[0] == 'pblock':
-                    self.HandleParameterBlock( token[1] )
-                elif token[0] == 'mblock':
-                    self.HandleMacro( token[1] )
-        except GerberError, message:
-            name, line, col = scanner.position()
-            print "Error in file %s, line %s, column %s" % (name,line,col)
-            print message
-        print "Finished: Extents are (%4.2f, %4.2f) - (%4.2f, %4.2f) (in.)" %(gerberExtents[0] / inch,
-                                                                              gerberExtents[1] / inch,
-                                                                              gerberExtents[2] / inch,
-                                                                              gerberExtents[3] / inch)
-        
-        f.close()
-        return gerberExtents
+            try:
+                for kind, text in tokens:
+                    if kind == 'block':
+                        if text == "M02" or text == "M2":
+                            text = "M02*"
+                        blocks.append( text )
+                        starts.append( scanner.start )
+                        if len(blocks) < gerberBatchSize:
+                            continue
+                    if blocks:
+                        self.HandleBlocks( blocks )
+                        blocks = []
+                        starts = []
+                        yield 1
+                    if kind != 'block':
+                        handlers[kind]( text )
+                if blocks:
+                    self.HandleBlocks( blocks )
+            except GerberError, message:
+                if blocks:
+                    scanner.start = starts[self.batchIndex]
+                name, line, col = scanner.position()
+                log.error( "Error in file %s, line %s, column %s", name, line, col )
+                log.error( "%s", message )
+                ok = 0
+            self.Flush()
+        finally:
+            scanner.close()
+            f.close()
+        yield ok
+    # }}}
+    # {{{ ProcessCachedFile
+    def CacheContext( self ):
+        state = [ getattr( self, name ) for name in GerberMachine.cacheState ]
+        state += [ self.fgColor, self.bgColor, self.canv._lineWidth, self.canv._lineCap ]
+        return repr( state )
+
+    def ProcessCachedFile( self, fname ):
+        # a cache that cannot be used only costs the time it would have saved
+        try:
+            cache = GerberCache( self.config.cacheDir, self.config.cacheSize )
+        except EnvironmentError, e:
+            log.warning( "Not caching %s: %s", fname, e )
+            return self.RecordFile( fname )[1]
+        key = cache.Key( fname, self.CacheContext() )
+        entry = cache.Load( key )
+        if entry is None:
+            ok, entry = self.RecordFile( fname )
+            if ok:
+                try:
+                    cache.Store( key, entry )
+                except EnvironmentError, e:
+                    log.warning( "Could not cache %s: %s", fname, e )
+        else:
+            log.info( "Using cached interpretation" )
+            if self.stats is not None:
+                self.stats.Count( 'cache hits' )
+        return entry
+    # }}}
+    # {{{ RecordFile
+    def RecordFile( self, fname ):
+        # interpret fname into an optimized display list, leaving the canvas
+        # and the extents alone until the recording is replayed
+        target = self.canv
+        outerExtents = self.extents
+        self.extents = Extents()
+        self.canv = DisplayList()
+        self.canv._lineWidth = target._lineWidth
+        self.canv._lineCap = target._lineCap
+        try:
+            ok = self.InterpretFile( fname )
+            self.canv.Optimize()
+            state = [ getattr( self, name ) for name in GerberMachine.cacheState ]
+            tools = [ num for num, aperture in self.apertures.items() if aperture is self.tool ]
+            entry = ( self.canv, self.apertures, self.extents.bounds, state, self.macroDefinitions,
+                      (tools or [ None ])[0] )
+        finally:
+            self.canv = target
+            self.extents = outerExtents
+        return ok, entry
+
+    def StreamFile( self, fname, chunkSize=None ):
+        """
+        Interprets fname into a sequence of optimized DisplayLists of roughly
+        chunkSize operations (config.chunkSize by default), handing each one
+        out as soon as it fills up.  A chunk is never cut inside an SR block,
+        which is stamped as a whole, so a file that is one large SR block
+        comes out as one chunk.  Replaying the chunks in order draws the file;
+        while a chunk is handed out the machine is drawing into the next one,
+        so they are replayed onto the canvas it had before.
+        """
+        if chunkSize is None:
+            chunkSize = self.config.chunkSize
+        target = self.canv
+        self.canv = DisplayList()
+        self.canv._lineWidth = target._lineWidth
+        self.canv._lineCap = target._lineCap
+        try:
+            for ok in self.Interpret( fname ):
+                if len(self.canv) >= chunkSize and self.stepRepeat is None:
+                    chunk = self.canv
+                    self.canv = DisplayList()
+                    self.canv._lineWidth = chunk._lineWidth
+                    self.canv._lineCap = chunk._lineCap
+                    chunk.Optimize()
+                    yield chunk
+            chunk = self.canv
+        finally:
+            self.canv = target
+        chunk.Optimize()
+        yield chunk
+
+    def MeasureFile( self, fname ):
+        # the extents of fname on its own, found without drawing anything
+        target = self.canv
+        outerExtents = self.extents
+        self.extents = Extents()
+        self.canv = ExtentsCanvas()
+        self.canv._lineWidth = target._lineWidth
+        self.canv._lineCap = target._lineCap
+        try:
+            self.InterpretFile( fname )
+            bounds = self.extents.bounds
+        finally:
+            self.canv = target
+            self.extents = outerExtents
+        return bounds
+
+    def ReplayRecording( self, entry ):
+        displayList, apertures, extents, state, macroDefinitions, tool = entry
+        displayList.Replay( self.canv )
+        self.apertures.update( apertures )
+        self.macroDefinitions.update( macroDefinitions )
+        if tool is not None:
+            self.tool = self.apertures[ tool ]
+        for name, value in zip( GerberMachine.cacheState, state ):
+            setattr( self, name, value )
+        if extents[0] <= extents[2]:
+            self.extents.Update( *extents )
+        bounds = self.extents.bounds
+        log.info( "Finished: Extents are (%4.2f, %4.2f) - (%4.2f, %4.2f) (in.)", bounds[0] / inch,
+                                                                                 bounds[1] / inch,
+                                                                                 bounds[2] / inch,
+                                                                                 bounds[3] / inch )
+        return list( bounds )
     # }}}
 # }}}
+# {{{ RecordLayers
+def RecordLayer( job ):
+    # runs in the worker processes
+    fname, fgColor, bgColor, lineWidth, config = job
+    gm = GerberMachine( "", DisplayList(), config )
+    if fgColor is not None:
+        gm.setColors( fgColor, bgColor )
+    gm.canv.setLineWidth( lineWidth )
+    stats = GerberStats.ForConfig( config )
+    if stats is not None:
+        stats.Instrument( gm )
+    log.info( "Processing file: %s", fname )
+    recording = gm.Record( fname )
+    if stats is not None:
+        return recording, stats.Report()
+    return recording, None
+
+def RecordLayers( layers, config=None, stats=None, pool=None ):
+    """
+    Interprets each (fname, fgColor, bgColor, lineWidth) layer in a freshly
+    initialized GerberMachine and returns their recordings in the same order,
+    ready for GerberMachine.ReplayRecording.  A fgColor of None keeps the
+    default colors.  The layers are spread over config.jobs worker processes,
+    or over the processes of pool when one is given; a long running program
+    with threads creates its pool before starting them, as processes forked
+    from a thread can inherit locks held by the others.  If config.stats or
+    config.profile is set, what the workers measured is added to stats.
+    """
+    if config is None:
+        config = GerberConfig()
+    jobs = [ tuple(layer) + (config,) for layer in layers ]
+    processes = min( config.jobs or multiprocessing.cpu_count(), len(jobs) )
+    if pool is not None:
+        results = pool.map( RecordLayer, jobs, 1 )
+    elif processes <= 1:
+        results = map( RecordLayer, jobs )
+    else:
+        pool = multiprocessing.Pool( processes )
+        try:
+            results = pool.map( RecordLayer, jobs, 1 )
+        finally:
+            pool.terminate()
+            pool.join()
+    for recording, report in results:
+        if report is not None and stats is not None:
+            stats.Merge( report )
+    return [ recording for recording, report in results ]
+# }}}
 # {{{ Translate (filelist)
 
-def Translate( fileList ):
-    global gerberOutputFile, gerberScale, gerberOffset, gerberPageSize, gerberFitPage, gerberExtents, gerberMargin
-
+def Translate( fileList, config=None ):
+    if config is None:
+        config = GerberConfig()
 
     folder = os.path.dirname( fileList[0] )
-    gerberOutputPath = os.path.join( folder, gerberOutputFile )
-
-    pagesizes = []
-    if gerberFitPage:
-        print "Prereading for page sizes"
-        print " ----------------------- "
-        # find out how big pages are
-        gm = GerberMachine( gerberOutputPath )
-        for f in fileList:
-            gm.Initialize()
-            gm.canv.translate( gerberOffset[0], gerberOffset[1] )
-            gm.canv.scale( gerberScale[0], gerberScale[1] )
-            gm.canv.setLineWidth( 0.0 )
-            gm.ProcessFile( f )
-            pagesizes.append(gerberExtents)
-            ResetExtents()
-            print "----"
-        gm.canv.save()
-        print "--------------------------"
-    
-    gm = GerberMachine( gerberOutputPath )
-    for f in fileList:
+    gerberOutputPath = os.path.join( folder, config.outputFile )
+    stats = GerberStats.ForConfig( config )
+    start = time.time()
+
+    # every file is interpreted from a freshly initialized machine, so they
+    # can all be recorded up front, in parallel, and their extents are known
+    # before anything is drawn.  Streamed files are read as they are drawn
+    # instead, after a separate pass for their extents if the page is fitted.
+    # Tiles need every file at hand, so they are not streamed
+    if config.stream and not config.tile:
+        recordings = [ None ] * len(fileList)
+    else:
+        recordings = RecordLayers( [ (f, None, None, 0.0) for f in fileList ], config, stats )
+        log.info( "----" )
+
+    if config.tile:
+        TranslateTiled( fileList, recordings, gerberOutputPath, config, stats )
+        if stats is not None:
+            stats.Add( 'total', time.time() - start )
+            stats.Count( 'bytes written', os.path.getsize( gerberOutputPath ) )
+            stats.WriteFor( config )
+        return
+
+    gm = GerberMachine( gerberOutputPath, config=config )
+    if stats is not None:
+        stats.Instrument( gm )
+        stats.InstrumentCanvas( gm.canv )
+    scale = config.scale
+    offset = config.offset
+    for f, recording in zip( fileList, recordings ):
         gm.Initialize()
-        if gerberFitPage:
-            print "Reoffsetting: " + f
-            extents = pagesizes[0]
-            pagesizes = pagesizes[1:]
-            # print gerberPageSize[0], gerberMargin
-            scale1 = (gerberPageSize[0]-2*gerberMargin)/((extents[2]-extents[0]))
-            scale2 = (gerberPageSize[1]-2*gerberMargin)/((extents[3]-extents[1]))
-            scale = min(scale1, scale2)
-            gerberScale = (scale,scale)
-            gerberOffset = (-extents[0]*scale + gerberMargin, -extents[1]*scale + gerberMargin)
-        print "Offset (in.): (%4.2f, %4.2f)" % (gerberOffset[0]/inch,gerberOffset[1]/inch)
-        print "Scale (in.):  (%4.2f, %4.2f)" % gerberScale
-        gm.canv.translate( gerberOffset[0], gerberOffset[1] )
-        gm.canv.scale( gerberScale[0], gerberScale[1] )
+        if config.fitPage:
+            log.info( "Reoffsetting: %s", f )
+            if recording is None:
+                measure = GerberMachine( "", ExtentsCanvas(), config )
+                if stats is not None:
+                    stats.Instrument( measure )
+                measure.canv.setLineWidth( 0.0 )
+                extents = measure.MeasureFile( f )
+            else:
+                extents = recording[2]
+            pageSize, margin = config.pageSize, config.margin
+            scale1 = (pageSize[0]-2*margin)/((extents[2]-extents[0]))
+            scale2 = (pageSize[1]-2*margin)/((extents[3]-extents[1]))
+            factor = min(scale1, scale2)
+            scale = (factor,factor)
+            offset = (-extents[0]*factor + margin, -extents[1]*factor + margin)
+        log.info( "Offset (in.): (%4.2f, %4.2f)", offset[0]/inch, offset[1]/inch )
+        log.info( "Scale (in.):  (%4.2f, %4.2f)", scale[0], scale[1] )
+        gm.canv.translate( offset[0], offset[1] )
+        gm.canv.scale( scale[0], scale[1] )
         gm.canv.setLineWidth( 0.0 )
-        gm.ProcessFile( f )
-        print "----"
+        if recording is None:
+            log.info( "Streaming file: %s", f )
+            # the machine draws into the next chunk while it is handing one
+            # out, so the chunks go to the canvas it had before
+            canv = gm.canv
+            for chunk in gm.StreamFile( f ):
+                # reportlab keeps the page as a list of operator strings until
+                # it is written; joining what each chunk added into one string
+                # brings what it holds down to the size of the output
+                start = len(canv._code)
+                chunk.Replay( canv )
+                canv._code[start:] = [ "\n".join( canv._code[start:] ) ]
+        else:
+            gm.ReplayRecording( recording )
+        log.info( "----" )
     gm.canv.save()
 
+    if stats is not None:
+        stats.Add( 'total', time.time() - start )
+        stats.Count( 'bytes written', os.path.getsize( gerberOutputPath ) )
+        stats.WriteFor( config )
+
+# }}}
+# {{{ TranslateTiled
+def TranslateTiled( fileList, recordings, gerberOutputPath, config, stats=None ):
+    # the files are gathered into one display list, which every tile
+    # replays the part it shows of
+    from reportlab.pdfgen import canvas
+    artwork = DisplayList()
+    gm = GerberMachine( "", artwork, config )
+    if stats is not None:
+        stats.Instrument( gm )
+    extents = None
+    for f, recording in zip( fileList, recordings ):
+        gm.Initialize()
+        artwork.setLineWidth( 0.0 )
+        extents = gm.ReplayRecording( recording )
+        log.info( "----" )
+    canv = canvas.Canvas( gerberOutputPath, pagesize=config.pageSize, pageCompression = 1 )
+    if stats is not None:
+        stats.InstrumentCanvas( canv )
+    pages = DrawTiles( canv, SpatialIndex( artwork ), extents, config )
+    log.info( "Tiled over %d pages", pages )
+    canv.save()
+
+def DrawTiles( canv, index, extents, config ):
+    """
+    Draws what index holds within extents at config.scale, one page sized
+    tile within the margins per page, left to right and then top to bottom
+    from the top left corner of extents.  Each tile only replays what
+    reaches into it.  Returns the number of pages.
+    """
+    pageSize, margin = config.pageSize, config.margin
+    scale = config.scale
+    width = (pageSize[0]-2*margin)/scale[0]
+    height = (pageSize[1]-2*margin)/scale[1]
+    # a drawing that fits a whole number of tiles does not spill onto
+    # another row or column of them by a rounding error
+    columns = max( 1, int( math.ceil( (extents[2]-extents[0])/width - 1e-6 ) ) )
+    rows = max( 1, int( math.ceil( (extents[3]-extents[1])/height - 1e-6 ) ) )
+    for row in xrange( rows ):
+        for column in xrange( columns ):
+            x = extents[0] + column*width
+            y = extents[3] - (row+1)*height
+            log.debug( "Tile %d, %d at (%4.2f, %4.2f) (in.)", row, column, x/inch, y/inch )
+            canv.saveState()
+            clip = canv.beginPath()
+            clip.rect( margin, margin, pageSize[0]-2*margin, pageSize[1]-2*margin )
+            canv.clipPath( clip, stroke=0, fill=0 )
+            canv.translate( margin - x*scale[0], margin - y*scale[1] )
+            canv.scale( scale[0], scale[1] )
+            index.Replay( canv, (x, y, x+width, y+height) )
+            canv.restoreState()
+            canv.showPage()
+    return rows*columns
 # }}}
 # {{{ ReadConfiguration
-def ReadConfiguration( fileList ):
-    global gerberScale, gerberOffset, gerberPageSize, gerberOutputFile, gerberFitPage, gerberMargin
+def ReadConfiguration( fileList, config ):
     if not fileList:
         return
         
@@ -1540,12 +3499,9 @@ def ReadConfiguration( fileList ):
         glo = {}
         loc = { "inch" : inch }
         execfile( figFile, glo, loc )
-        gerberScale = loc.get( "gerberScale", gerberScale )
-        gerberOffset = loc.get( "gerberOffset", gerberOffset )
-        gerberPageSize = loc.get( "gerberPageSize", gerberPageSize )
-        gerberOutputFile = loc.get( "gerberOutputFile", gerberOutputFile )
-        gerberFitPage = loc.get( "gerberFitPage", gerberFitPage )
-        gerberMargin = loc.get( "gerberMargin", gerberMargin )
+        for name in GerberConfig.settings:
+            value = loc.get( config.FileName( name ), getattr( config, name ) )
+            setattr( config, name, value )
         fileList = loc.get("fileList", fileList)
         
     return fileList
@@ -1561,8 +3517,9 @@ def InputDefault( message, default ):
     return value
 # }}}
 # {{{ Interact
-def Interact():
-    global gerberScale, gerberOffset, gerberPageSize, gerberOutputFile, gerberFitPage, gerberMargin
+def Interact( config=None ):
+    if config is None:
+        config = GerberConfig()
     
     fileList = []
     str = raw_input( "Gerber files (wildcards OK): " )
@@ -1572,48 +3529,65 @@ def Interact():
     if len(fileList) == 0:
         return
 
-    ReadConfiguration( fileList )       
+    ReadConfiguration( fileList, config )       
      
-    width, height = gerberPageSize
+    width, height = config.pageSize
     width = InputDefault( "Page width (inches) [%3.1f]: ", width/inch ) * inch
     height = InputDefault( "Page height (inches) [%3.1f]: ", height/inch ) * inch
-    gerberPageSize = (width,height)
+    config.pageSize = (width,height)
     
-    str = raw_input( "Fit to page? (1=yes,0=no) [%s]: " % gerberFitPage )
+    str = raw_input( "Fit to page? (1=yes,0=no) [%s]: " % config.fitPage )
     try:
-        gerberFitPage = int(str)
+        config.fitPage = int(str)
     except:
         pass
 
-    if gerberFitPage:
-        gerberMargin = InputDefault( "Margin (inches) [%4.2f]: ", gerberMargin/inch ) * inch
+    if config.fitPage:
+        config.margin = InputDefault( "Margin (inches) [%4.2f]: ", config.margin/inch ) * inch
     else: 
-        xoff, yoff = gerberOffset
+        xoff, yoff = config.offset
         xoff = InputDefault( "X Offset (inches) [%3.1f]: ", xoff/inch ) * inch
         yoff = InputDefault( "Y Offset (inches) [%3.1f]: ", yoff/inch ) * inch        
-        gerberOffset = (xoff,yoff)
+        config.offset = (xoff,yoff)
 
-        xscale, yscale = gerberScale
+        xscale, yscale = config.scale
         xscale = InputDefault( "X Scale [%3.1f]: ", xscale )
         yscale = InputDefault( "Y Scale [%3.1f]: ", yscale )
-        gerberScale = (xscale,yscale)
+        config.scale = (xscale,yscale)
     
-    response = raw_input( "Output file [%s]: " % gerberOutputFile )
+    response = raw_input( "Output file [%s]: " % config.outputFile )
     if response:
-        gerberOutputFile = response
+        config.outputFile = response
     
-    Translate( fileList )
+    Translate( fileList, config )
 # }}}
 # {{{ __MAIN__
 if __name__ == "__main__":
-    import sys
+    import getopt
 
-    fileList = sys.argv[1:]    
+    try:
+        options, fileList = getopt.gnu_getopt( sys.argv[1:], "qv", [ "stats=", "profile=", "quiet", "verbose" ] )
+    except getopt.GetoptError, message:
+        sys.exit( "%s\nusage: %s [--stats FILE] [--profile NAME] [-q|-v] [file ...]" % (message, sys.argv[0]) )
+    options = dict( options )
+    level = logging.INFO
+    if "-q" in options or "--quiet" in options:
+        level = logging.WARNING
+    if "-v" in options or "--verbose" in options:
+        level = logging.DEBUG
+    logging.basicConfig( level=level, format="%(message)s" )
+
+    config = GerberConfig()
+    config.jobs = EnvironmentJobs()
     if fileList:
-        fileList = ReadConfiguration( fileList )
-        Translate( fileList )
+        fileList = ReadConfiguration( fileList, config )
+        config.stats = options.get( "--stats", config.stats )
+        config.profile = options.get( "--profile", config.profile )
+        Translate( fileList, config )
     else:
-        Interact()
+        config.stats = options.get( "--stats", config.stats )
+        config.profile = options.get( "--profile", config.profile )
+        Interact( config )
 # }}}
 
 # }}}
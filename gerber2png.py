@@ -0,0 +1,556 @@
+#!/usr/bin/env python
+# {{{ Top
+"""
+gerber2png.py - render Gerber layers straight to a PNG image
+
+Interprets Gerber files with gerber2pdf's GerberMachine and draws them into
+a NumPy coverage buffer at the chosen resolution, without going through a
+PDF document and an external rasterizer, for thumbnails and previews.
+Strokes, flashes and G36/G37 regions are scan converted with anti-aliased
+edges, and clear polarity (%LPC*%) paints the background color over what
+is below it, as it does on a gerber2pdf page.  The image covers the
+extents of all the layers, and is written as an RGB PNG using only zlib.
+
+Large images are cut into tiles, which are rendered on config.jobs worker
+processes, each tile only replaying the parts of the layers that touch it.
+
+Usage:
+
+    python gerber2png.py [options] file[:RRGGBB] ...
+
+    --dpi N         resolution, 150 by default
+    --output FILE   the PNG to write, preview.png by default
+    --tile N        size of the tiles in pixels, 1024 by default
+    --jobs N        render tiles in N processes, 0 for one per CPU
+    --samples N     scanlines per pixel row for anti-aliasing, 4 by default
+    -q, -v          less or more output
+
+Each layer is drawn in its RRGGBB color (0.8 grey by default) on a white
+background, the first file at the bottom.  Settings in gerber2pdf.cfg next
+to the first file (gerberCacheDir, gerberJobs, ...) apply as they do for
+gerber2pdf.
+
+Depends on NumPy and on gerber2pdf's own dependencies.
+"""
+# }}}
+# {{{ Imports
+import sys
+import math
+import zlib
+import struct
+import logging
+import multiprocessing
+
+import numpy
+
+from gerber2pdf import GerberConfig, GerberError, RecordLayers, SpatialIndex, ReadConfiguration, \
+                       RenderTarget, EnvironmentJobs, FILL_EVEN_ODD
+from reportlab.lib import colors
+
+log = logging.getLogger( "gerber2png" )
+# }}}
+# {{{ Coverage
+def Coverage( polygons, evenOdd, width, height, samples ):
+    """
+    Scan converts polygons, a list of (count, corners, 2) arrays of pixel
+    coordinates with y pointing down, with the nonzero winding rule or the
+    even-odd rule.  Returns (left, top, coverage) for the part of the width
+    x height image the polygons touch, coverage holding the fraction of
+    each pixel that is inside, or None if they touch no pixel.
+
+    The edges are cut by samples scanlines per pixel row.  The spans between
+    crossings are exact across the row, so edges are anti-aliased to a
+    fraction of a pixel horizontally and to 1/samples vertically.
+    """
+    x0 = numpy.concatenate( [ p[:,:,0].ravel() for p in polygons ] )
+    y0 = numpy.concatenate( [ p[:,:,1].ravel() for p in polygons ] )
+    x1 = numpy.concatenate( [ numpy.roll( p[:,:,0], -1, axis=1 ).ravel() for p in polygons ] )
+    y1 = numpy.concatenate( [ numpy.roll( p[:,:,1], -1, axis=1 ).ravel() for p in polygons ] )
+    left = max( 0, int( math.floor( min( x0.min(), x1.min() ) ) ) )
+    right = min( width, int( math.ceil( max( x0.max(), x1.max() ) ) ) )
+    top = max( 0, int( math.floor( y0.min() ) ) )
+    bottom = min( height, int( math.ceil( y0.max() ) ) )
+    if left >= right or top >= bottom:
+        return None
+    columns = right - left
+    rows = (bottom - top) * samples
+
+    # scanline k runs through y = top + (k + 0.5) / samples; an edge crosses
+    # the scanlines from its upper end up to but not including its lower end
+    horizontal = y0 == y1
+    if horizontal.any():
+        keep = ~horizontal
+        x0, y0, x1, y1 = x0[keep], y0[keep], x1[keep], y1[keep]
+    k0 = numpy.clip( numpy.ceil( (numpy.minimum( y0, y1 ) - top) * samples - 0.5 ), 0, rows ).astype( numpy.intp )
+    k1 = numpy.clip( numpy.ceil( (numpy.maximum( y0, y1 ) - top) * samples - 0.5 ), 0, rows ).astype( numpy.intp )
+    counts = k1 - k0
+    n = counts.sum()
+    if n == 0:
+        return None
+    edge = numpy.repeat( numpy.arange( len(counts) ), counts )
+    k = numpy.arange( n ) - numpy.repeat( numpy.cumsum( counts ) - counts - k0, counts )
+    y = top + (k + 0.5) / samples
+    x = x0[edge] + (y - y0[edge]) * ((x1 - x0) / (y1 - y0))[edge]
+
+    order = numpy.lexsort( (x, k) )
+    x = x[order]
+    k = k[order]
+    # every scanline is crossed an even number of times and its winding
+    # number goes back to 0, so one running count serves all of them
+    if evenOdd:
+        inside = (numpy.arange( n ) & 1) == 0
+    else:
+        winding = numpy.where( y1 > y0, 1, -1 )[edge][order]
+        inside = numpy.cumsum( winding ) != 0
+    spans = numpy.nonzero( inside[:-1] )[0]
+    a = numpy.clip( x[spans] - left, 0, columns )
+    b = numpy.clip( x[spans+1] - left, 0, columns )
+    row = k[spans] * (columns + 2)
+
+    # each span adds its length to the pixels it covers through a running
+    # sum along the scanline: the pixels its ends fall in get the fraction
+    # they cover and the difference to it goes to the next one
+    ia = numpy.floor( a ).astype( numpy.intp )
+    ib = numpy.floor( b ).astype( numpy.intp )
+    fa = a - ia
+    fb = b - ib
+    index = numpy.concatenate( ( row + ia, row + ia + 1, row + ib, row + ib + 1 ) )
+    weight = numpy.concatenate( ( 1.0 - fa, fa, fb - 1.0, -fb ) )
+    steps = numpy.bincount( index, weight, rows * (columns + 2) ).reshape( rows, columns + 2 )
+    coverage = numpy.cumsum( steps, axis=1 )[:,:columns]
+    coverage = coverage.reshape( bottom - top, samples, columns ).sum( axis=1 ) * (1.0 / samples)
+    return left, top, numpy.clip( coverage, 0.0, 1.0, coverage )
+
+def Disc( radius, tolerance=0.2 ):
+    # the corners of a polygon within tolerance of a circle, clockwise on
+    # the page like the strokes StrokePolygons makes
+    if radius > tolerance:
+        count = int( math.ceil( math.pi / math.acos( 1.0 - tolerance / radius ) ) )
+        count = min( max( count, 8 ), 128 )
+    else:
+        count = 8
+    t = numpy.linspace( 0.0, -2.0 * math.pi, count, endpoint=False )
+    return numpy.column_stack( ( numpy.cos( t ), numpy.sin( t ) ) ) * radius
+
+def StrokePolygons( points, closed, half, cap ):
+    """
+    The outline of a stroke through points, an (n, 2) array of pixel
+    coordinates, half pixels to either side, as polygons for Coverage:
+    a quadrilateral for each segment and a disc for each round join and
+    cap.  They all wind the same way so that the nonzero rule fills their
+    union.  cap is the PDF line cap, 0 butt, 1 round or 2 projecting.
+    """
+    if closed and len(points) > 2:
+        points = numpy.vstack( ( points, points[:1] ) )
+    d = numpy.diff( points, axis=0 )
+    length = numpy.hypot( d[:,0], d[:,1] )
+    keep = length > 1e-9
+    p, q, d, length = points[:-1][keep], points[1:][keep], d[keep], length[keep]
+    polygons = []
+    if len(length):
+        unit = d / length[:,None]
+        if cap == 2 and not closed:
+            p = p.copy()
+            q = q.copy()
+            p[0] -= unit[0] * half
+            q[-1] += unit[-1] * half
+        normal = numpy.column_stack( ( -unit[:,1], unit[:,0] ) ) * half
+        polygons.append( numpy.stack( ( p+normal, q+normal, q-normal, p-normal ), axis=1 ) )
+        if cap == 1:
+            joints = numpy.vstack( ( p, q[-1:] ) )
+        elif closed:
+            joints = p
+        else:
+            joints = p[1:]
+    elif cap == 1:
+        joints = points[:1]
+    else:
+        joints = points[:0]
+    if len(joints):
+        polygons.append( joints[:,None,:] + Disc( half )[None,:,:] )
+    return polygons
+# }}}
+# {{{ RasterCanvas
+class RasterCanvas( RenderTarget ):
+    """
+    Draws what a DisplayList replays into an RGB image, a (height, width, 3)
+    float array, through a scale and translation from page points to pixels.
+    Joins are always round.
+
+    Flashes are stamped from a cache of their coverage, rendered once per
+    template, color and quarter pixel offset.
+    """
+
+    def __init__( self, width, height, transform, background=(1.0, 1.0, 1.0), samples=4 ):
+        self.width = width
+        self.height = height
+        self.samples = samples
+        self.image = numpy.empty( (height, width, 3), numpy.float32 )
+        self.image[:] = background
+        self.pieces = None      # a list to collect painted coverage in rather than painting it
+        self.stamps = {}
+        self.ctm = tuple( transform )     # x scale, y scale, x offset, y offset
+        self._lineWidth = 1
+        self._lineCap = 0
+        self._fillMode = FILL_EVEN_ODD
+        self.fillColor = colors.black
+        self.strokeColor = colors.black
+        self._stateStack = []
+
+    # {{{ Graphics state
+    def setStrokeColor( self, color ):
+        self.strokeColor = color
+
+    def setFillColor( self, color ):
+        self.fillColor = color
+
+    def saveState( self ):
+        self._stateStack.append( (self._lineWidth, self._lineCap, self.fillColor, self.strokeColor, self.ctm) )
+
+    def restoreState( self ):
+        self._lineWidth, self._lineCap, self.fillColor, self.strokeColor, self.ctm = self._stateStack.pop()
+
+    def translate( self, dx, dy ):
+        a, d, e, f = self.ctm
+        self.ctm = ( a, d, e + a*dx, f + d*dy )
+
+    def scale( self, x, y ):
+        a, d, e, f = self.ctm
+        self.ctm = ( a*x, d*y, e, f )
+    # }}}
+    # {{{ Drawing
+    def drawPath( self, path, stroke=1, fill=0, fillMode=None ):
+        if fillMode is None:
+            fillMode = self._fillMode
+        subpaths = self.Flatten( path )
+        if fill:
+            polygons = [ points[None,:,:] for points, closed in subpaths if len(points) > 2 ]
+            if polygons:
+                self.Fill( polygons, fillMode == FILL_EVEN_ODD, self.fillColor )
+        if stroke:
+            self.Stroke( subpaths )
+
+    def Fill( self, polygons, evenOdd, color ):
+        covered = Coverage( polygons, evenOdd, self.width, self.height, self.samples )
+        if covered is not None:
+            self.Paint( color, *covered )
+
+    def Stroke( self, subpaths ):
+        a = self.ctm[0]
+        # zero width lines are as thin as can be shown, one pixel
+        half = max( abs( a ) * self._lineWidth, 1.0 ) * 0.5
+        polygons = []
+        for points, closed in subpaths:
+            polygons += StrokePolygons( points, closed, half, self._lineCap )
+        if polygons:
+            self.Fill( polygons, False, self.strokeColor )
+
+    def Paint( self, color, left, top, coverage ):
+        if self.pieces is not None:
+            self.pieces.append( (color, left, top, coverage) )
+            return
+        # clip to the image, coverage from the stamp cache can reach past it
+        h, w = coverage.shape
+        x0, y0 = max( left, 0 ), max( top, 0 )
+        x1, y1 = min( left + w, self.width ), min( top + h, self.height )
+        if x0 >= x1 or y0 >= y1:
+            return
+        coverage = coverage[y0-top:y1-top,x0-left:x1-left]
+        if getattr( color, 'alpha', 1 ) != 1:
+            coverage = coverage * color.alpha
+        rgb = numpy.array( ( color.red, color.green, color.blue ), numpy.float32 )
+        covered = numpy.flatnonzero( coverage )
+        if len(covered) * 4 > coverage.size:
+            window = self.image[y0:y1,x0:x1]
+            window += (rgb - window) * coverage[:,:,None]
+            return
+        # merged paths spread thinly over large windows, only touch the
+        # pixels they cover
+        w = x1 - x0
+        index = (covered // w + y0) * self.width + covered % w + x0
+        pixels = self.image.reshape( -1, 3 )
+        before = pixels[index]
+        pixels[index] = before + (rgb - before) * coverage.ravel()[covered][:,None]
+    # }}}
+    # {{{ Flatten
+    def Flatten( self, path, tolerance=0.2 ):
+        """
+        The subpaths of a RecordedPath as (points, closed), points being an
+        (n, 2) array of pixel coordinates.  Arcs become polylines within
+        tolerance pixels of the curve.
+        """
+        a, d, e, f = self.ctm
+        scale = max( abs( a ), abs( d ) )
+        subpaths = []
+        points = []
+        closed = False
+
+        def Arc( cx, cy, rx, ry, start, extent ):
+            radius = max( rx, ry ) * scale
+            if radius > tolerance:
+                step = 2.0 * math.acos( 1.0 - tolerance / radius )
+            else:
+                step = math.pi / 2
+            count = min( max( int( math.ceil( math.radians( abs( extent ) ) / step ) ), 1 ), 1024 )
+            t = numpy.radians( numpy.linspace( start, start + extent, count + 1 ) )
+            return zip( cx + rx * numpy.cos( t ), cy + ry * numpy.sin( t ) )
+
+        for name, args in path:
+            if name == 'moveTo':
+                if len(points) > 1:
+                    subpaths.append( (points, closed) )
+                points = [ args ]
+                closed = False
+            elif name == 'lineTo':
+                points.append( args )
+            elif name == 'arcTo':
+                x1, y1, x2, y2, start, extent = args
+                points += Arc( 0.5*(x1+x2), 0.5*(y1+y2), 0.5*abs(x2-x1), 0.5*abs(y2-y1), start, extent )
+            elif name == 'close':
+                closed = True
+                if len(points) > 1:
+                    subpaths.append( (points, closed) )
+                    points = [ points[0] ]
+                    closed = False
+            else:
+                if len(points) > 1:
+                    subpaths.append( (points, closed) )
+                if name == 'circle':
+                    x, y, r = args
+                    outline = Arc( x, y, r, r, 0.0, 360.0 )[:-1]
+                elif name == 'rect':
+                    x, y, w, h = args
+                    outline = [ (x, y), (x+w, y), (x+w, y+h), (x, y+h) ]
+                else:
+                    x, y, w, h, r = args
+                    r = min( r, 0.5*abs(w), 0.5*abs(h) )
+                    x, y, w, h = min( x, x+w ), min( y, y+h ), abs(w), abs(h)
+                    outline = ( Arc( x+w-r, y+r, r, r, -90.0, 90.0 ) + Arc( x+w-r, y+h-r, r, r, 0.0, 90.0 ) +
+                                Arc( x+r, y+h-r, r, r, 90.0, 90.0 ) + Arc( x+r, y+r, r, r, 180.0, 90.0 ) )
+                subpaths.append( (outline, True) )
+                points = []
+                closed = False
+        if len(points) > 1:
+            subpaths.append( (points, closed) )
+
+        result = []
+        for points, closed in subpaths:
+            xy = numpy.array( points, numpy.float64 ).reshape( -1, 2 )
+            xy[:,0] = xy[:,0] * a + e
+            xy[:,1] = xy[:,1] * d + f
+            result.append( (xy, closed) )
+        return result
+    # }}}
+    # {{{ stamp
+    def stamp( self, template, x, y ):
+        b = template.bounds
+        if b is None:
+            return
+        a, d, e, f = self.ctm
+        px, py = a*x + e, d*y + f
+        # leave room for the strokes of the template, which reach out by
+        # half their width past the bounds it was measured with
+        pad = 2
+        xs = sorted( ( a*b[0], a*b[2] ) )
+        ys = sorted( ( d*b[1], d*b[3] ) )
+        if ( px + xs[1] + pad < 0 or py + ys[1] + pad < 0 or
+             px + xs[0] - pad > self.width or py + ys[0] - pad > self.height ):
+            return
+
+        ix, iy = int( math.floor( px ) ), int( math.floor( py ) )
+        # flashes are placed to a quarter pixel, anything bigger (step and
+        # repeat blocks) to a whole one, so that it is rendered only once
+        if xs[1] - xs[0] > 64 or ys[1] - ys[0] > 64:
+            ix, iy = int( round( px ) ), int( round( py ) )
+            phase = ( 0, 0 )
+        else:
+            phase = ( int( round( (px - ix) * 4 ) ), int( round( (py - iy) * 4 ) ) )
+        key = ( template.name, phase, a, d, self._lineWidth, self._lineCap,
+                id( self.fillColor ), id( self.strokeColor ) )
+        if key not in self.stamps:
+            # render the template once into a canvas just big enough for it
+            ox = pad - int( math.floor( xs[0] ) )
+            oy = pad - int( math.floor( ys[0] ) )
+            sub = RasterCanvas( int( math.ceil( xs[1] ) ) + ox + pad, int( math.ceil( ys[1] ) ) + oy + pad,
+                                ( a, d, ox + phase[0] / 4.0, oy + phase[1] / 4.0 ), samples=self.samples )
+            sub.image = None
+            sub.pieces = []
+            sub._lineWidth, sub._lineCap = self._lineWidth, self._lineCap
+            sub.fillColor, sub.strokeColor = self.fillColor, self.strokeColor
+            template.displayList.Replay( sub )
+            # keep the colors alive so that their ids are not reused
+            self.stamps[key] = ( self.fillColor, self.strokeColor,
+                                 [ (color, left - ox, top - oy, coverage)
+                                   for color, left, top, coverage in MergePieces( sub.pieces ) ] )
+        for color, left, top, coverage in self.stamps[key][2]:
+            self.Paint( color, left + ix, top + iy, coverage )
+    # }}}
+
+def MergePieces( pieces ):
+    # painting c1 and then c2 in one opaque color is painting 1-(1-c1)(1-c2),
+    # so runs of pieces in the same color can be stamped as one
+    merged = []
+    run = []
+    for piece in pieces + [ (None, 0, 0, None) ]:
+        if run and ( piece[0] is not run[0][0] or getattr( piece[0], 'alpha', 1 ) != 1 ):
+            if len(run) == 1:
+                merged += run
+            else:
+                left = min( [ l for c, l, t, cov in run ] )
+                top = min( [ t for c, l, t, cov in run ] )
+                right = max( [ l + cov.shape[1] for c, l, t, cov in run ] )
+                bottom = max( [ t + cov.shape[0] for c, l, t, cov in run ] )
+                uncovered = numpy.ones( (bottom - top, right - left) )
+                for c, l, t, cov in run:
+                    uncovered[t-top:t-top+cov.shape[0],l-left:l-left+cov.shape[1]] *= 1.0 - cov
+                merged.append( (run[0][0], left, top, 1.0 - uncovered) )
+            run = []
+        if piece[0] is not None:
+            run.append( piece )
+    return merged
+# }}}
+# {{{ WritePNG
+def WritePNG( fname, image ):
+    """
+    Writes image, a (height, width, 3) array of bytes, as an 8 bit RGB PNG.
+    Each row is stored as its difference to the row above (PNG filter
+    type 2), which boards with their long straight edges compress well with.
+    """
+    height, width = image.shape[:2]
+    rows = image.reshape( height, width * 3 )
+    data = numpy.empty( (height, width * 3 + 1), numpy.uint8 )
+    data[:,0] = 2
+    data[:,1:] = rows
+    data[1:,1:] -= rows[:-1]
+
+    def Chunk( kind, body ):
+        return ( struct.pack( ">I", len(body) ) + kind + body +
+                 struct.pack( ">I", zlib.crc32( kind + body ) & 0xffffffff ) )
+
+    out = open( fname, 'wb' )
+    out.write( "\x89PNG\r\n\x1a\n" )
+    out.write( Chunk( "IHDR", struct.pack( ">IIBBBBB", width, height, 8, 2, 0, 0, 0 ) ) )
+    out.write( Chunk( "IDAT", zlib.compress( data.tostring(), 6 ) ) )
+    out.write( Chunk( "IEND", "" ) )
+    out.close()
+# }}}
+# {{{ RenderPNG
+tileJob = None  # what RenderTile draws from, set in each worker by SetTileJob
+
+def SetTileJob( job ):
+    global tileJob
+    tileJob = job
+
+def RenderTile( tile ):
+    # runs in the worker processes
+    layers, indexes, transform, samples = tileJob
+    left, top, width, height = tile
+    a, d, e, f = transform
+    canv = RasterCanvas( width, height, ( a, d, e - left, f - top ), samples=samples )
+    # the tile in page points, for culling
+    clip = ( (left - e) / a, (top + height - f) / d, (left + width - e) / a, (top - f) / d )
+    for (fname, fgColor, bgColor, lineWidth, recording), index in zip( layers, indexes ):
+        canv.setLineCap( 1 )
+        canv.setLineJoin( 1 )
+        canv.setStrokeColor( fgColor )
+        canv.setFillColor( fgColor )
+        canv.setLineWidth( lineWidth )
+        if index is not None:
+            index.Replay( canv, clip )
+        else:
+            recording[0].Replay( canv )
+    image = numpy.clip( canv.image * 255.0 + 0.5, 0, 255 ).astype( numpy.uint8 )
+    return tile, image.tostring()
+
+def RenderPNG( layers, fname, config=None, dpi=150, tileSize=1024, samples=4 ):
+    """
+    Renders (fname, fgColor, bgColor, lineWidth) layers, the first one at the
+    bottom, into a PNG of their extents at dpi, on white.  Returns the size
+    of the image.
+    """
+    if config is None:
+        config = GerberConfig()
+    layers = [ tuple( layer ) for layer in layers ]
+    recordings = RecordLayers( layers, config )
+    bounds = [ 1e300, 1e300, -1e300, -1e300 ]
+    for recording in recordings:
+        b = recording[2]
+        if b[0] <= b[2]:
+            bounds = [ min( bounds[0], b[0] ), min( bounds[1], b[1] ), max( bounds[2], b[2] ), max( bounds[3], b[3] ) ]
+    if bounds[0] > bounds[2]:
+        raise GerberError( "Nothing to render" )
+
+    scale = dpi / 72.0
+    width = max( int( math.ceil( (bounds[2] - bounds[0]) * scale ) ), 1 )
+    height = max( int( math.ceil( (bounds[3] - bounds[1]) * scale ) ), 1 )
+    transform = ( scale, -scale, -bounds[0] * scale, bounds[3] * scale )
+    tiles = [ (left, top, min( tileSize, width - left ), min( tileSize, height - top ))
+              for top in xrange( 0, height, tileSize ) for left in xrange( 0, width, tileSize ) ]
+    log.info( "Rendering %d x %d pixels in %d tiles", width, height, len(tiles) )
+
+    # each tile only replays what touches it when there are several
+    indexes = [ None ] * len(layers)
+    if len(tiles) > 1:
+        indexes = [ SpatialIndex( recording[0] ) for recording in recordings ]
+    job = ( [ layer + (recording,) for layer, recording in zip( layers, recordings ) ],
+            indexes, transform, samples )
+    processes = min( config.jobs or multiprocessing.cpu_count(), len(tiles) )
+    if processes <= 1:
+        SetTileJob( job )
+        results = map( RenderTile, tiles )
+    else:
+        pool = multiprocessing.Pool( processes, SetTileJob, (job,) )
+        try:
+            results = pool.map( RenderTile, tiles, 1 )
+        finally:
+            pool.terminate()
+            pool.join()
+
+    image = numpy.empty( (height, width, 3), numpy.uint8 )
+    for (left, top, w, h), pixels in results:
+        image[top:top+h,left:left+w] = numpy.fromstring( pixels, numpy.uint8 ).reshape( h, w, 3 )
+    WritePNG( fname, image )
+    return width, height
+# }}}
+# {{{ __MAIN__
+def ParseLayer( arg ):
+    # file[:RRGGBB] -> (fname, fgColor, bgColor, lineWidth)
+    fname, color = arg, "cccccc"
+    if len(arg) > 7 and arg[-7] == ":":
+        fname, color = arg[:-7], arg[-6:]
+    rgb = [ int( color[i:i+2], 16 ) / 255.0 for i in ( 0, 2, 4 ) ]
+    return ( fname, colors.Color( *rgb ), colors.Color( 1, 1, 1 ), 0.0 )
+
+if __name__ == "__main__":
+    import getopt
+
+    usage = "usage: %s [--dpi N] [--output FILE] [--tile N] [--jobs N] [--samples N] [-q|-v] file[:RRGGBB] ..."
+    try:
+        options, args = getopt.gnu_getopt( sys.argv[1:], "qvo:", [ "dpi=", "output=", "tile=", "jobs=", "samples=",
+                                                                   "quiet", "verbose" ] )
+        options = dict( options )
+        dpi = float( options.get( "--dpi", 150 ) )
+        tileSize = int( options.get( "--tile", 1024 ) )
+        samples = int( options.get( "--samples", 4 ) )
+        jobs = int( options.get( "--jobs", 1 ) )
+        layers = [ ParseLayer( arg ) for arg in args ]
+    except ( getopt.GetoptError, ValueError ), message:
+        sys.exit( "%s\n%s" % (message, usage % sys.argv[0]) )
+    if not layers or dpi <= 0 or tileSize <= 0 or samples <= 0 or jobs < 0:
+        sys.exit( usage % sys.argv[0] )
+    level = logging.INFO
+    if "-q" in options or "--quiet" in options:
+        level = logging.WARNING
+    if "-v" in options or "--verbose" in options:
+        level = logging.DEBUG
+    logging.basicConfig( level=level, format="%(message)s" )
+
+    config = GerberConfig()
+    config.jobs = EnvironmentJobs()
+    ReadConfiguration( [ layer[0] for layer in layers ], config )
+    if "--jobs" in options:
+        config.jobs = jobs
+    output = options.get( "--output", options.get( "-o", "preview.png" ) )
+    width, height = RenderPNG( layers, output, config, dpi, tileSize, samples )
+    log.info( "Wrote %s, %d x %d pixels", output, width, height )
+# }}}
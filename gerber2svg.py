@@ -0,0 +1,302 @@
+#!/usr/bin/env python
+# {{{ Top
+"""
+gerber2svg.py - translate Gerber layers to an SVG drawing
+
+Interprets Gerber files with gerber2pdf's GerberMachine straight onto an
+SvgTarget, which writes each path out as the interpreter draws it, so that
+memory stays flat however large the files are: nothing is recorded but the
+names of the apertures already defined.  Each flashed aperture becomes a
+<symbol>, defined where it is first flashed, and every flash a <use> of it.
+Step and repeat blocks are drawn the same way, one symbol per block.
+
+The drawing covers the extents of all the layers, in points, with the y
+axis pointing up as it does in the Gerber files.
+
+Usage:
+
+    python gerber2svg.py [options] file[:RRGGBB] ...
+
+    --output FILE   the SVG to write, - for stdout, drawing.svg by default
+    -q, -v          less or more output
+
+Each layer is drawn in its RRGGBB color (0.8 grey by default), the first
+file at the bottom.  Settings in gerber2pdf.cfg next to the first file
+apply as they do for gerber2pdf.
+"""
+# }}}
+# {{{ Imports
+import sys
+import math
+import logging
+
+from gerber2pdf import GerberConfig, GerberMachine, ReadConfiguration, RenderTarget, \
+                       ExtentsCanvas, FILL_EVEN_ODD
+from reportlab.lib import colors
+
+log = logging.getLogger( "gerber2svg" )
+log.addHandler( logging.NullHandler() )
+
+# room left in the header for the size of the drawing when it is only
+# known at the end
+headerRoom = 120
+# }}}
+# {{{ PathData
+def PathData( path ):
+    """
+    The SVG path data of a RecordedPath.  Arcs are split into pieces of at
+    most half a turn, which the small arc flag always describes.
+    """
+    d = []
+    current = None
+    for name, args in path:
+        if name == 'moveTo':
+            d.append( "M%g %g" % args )
+            current = args
+        elif name == 'lineTo':
+            d.append( "L%g %g" % args )
+            current = args
+        elif name == 'close':
+            d.append( "Z" )
+        elif name == 'arcTo':
+            x1, y1, x2, y2, start, extent = args
+            cx, cy, rx, ry = 0.5*(x1+x2), 0.5*(y1+y2), 0.5*abs(x2-x1), 0.5*abs(y2-y1)
+            a = math.radians( start )
+            first = ( cx + rx*math.cos( a ), cy + ry*math.sin( a ) )
+            d.append( "%s%g %g" % ( "M" if current is None else "L", first[0], first[1] ) )
+            pieces = max( int( math.ceil( abs( extent ) / 180.0 ) ), 1 )
+            for i in xrange( 1, pieces + 1 ):
+                a = math.radians( start + extent * i / pieces )
+                current = ( cx + rx*math.cos( a ), cy + ry*math.sin( a ) )
+                d.append( "A%g %g 0 0 %d %g %g" % ( rx, ry, extent > 0, current[0], current[1] ) )
+        elif name == 'circle':
+            x, y, r = args
+            d.append( "M%g %gA%g %g 0 0 1 %g %gA%g %g 0 0 1 %g %gZ" % ( x+r, y, r, r, x-r, y, r, r, x+r, y ) )
+            current = ( x+r, y )
+        elif name == 'rect':
+            x, y, width, height = args
+            d.append( "M%g %gh%gv%gh%gZ" % ( x, y, width, height, -width ) )
+            current = ( x, y )
+        elif name == 'roundRect':
+            x, y, width, height, r = args
+            if width < 0:
+                x, width = x + width, -width
+            if height < 0:
+                y, height = y + height, -height
+            r = min( r, 0.5*width, 0.5*height )
+            x2, y2 = x + width, y + height
+            d.append( "M%g %gL%g %gA%g %g 0 0 1 %g %gL%g %gA%g %g 0 0 1 %g %g"
+                      "L%g %gA%g %g 0 0 1 %g %gL%g %gA%g %g 0 0 1 %g %gZ" %
+                      ( x+r, y, x2-r, y, r, r, x2, y+r, x2, y2-r, r, r, x2-r, y2,
+                        x+r, y2, r, r, x, y2-r, x, y+r, r, r, x+r, y ) )
+            current = ( x+r, y )
+    return "".join( d )
+# }}}
+# {{{ SvgTarget
+def Paint( color ):
+    # the SVG color and opacity of a reportlab color
+    paint = "#%02x%02x%02x" % tuple( [ int( round( c * 255 ) ) for c in color.rgb() ] )
+    alpha = getattr( color, 'alpha', None )
+    if alpha is None:
+        alpha = 1
+    return paint, alpha
+
+class SvgTarget( RenderTarget ):
+    """
+    Writes what is drawn on it to out as SVG as it comes, one <path> element
+    for each drawPath.  Graphics state is kept on the elements themselves,
+    and transformations become nested <g> elements, closed again by
+    restoreState.  Stamps define a <symbol> the first time a template is
+    stamped in a given pen and <use> it from then on.
+
+    The size of the drawing goes in the header.  If bounds, the page points
+    (x0, y0, x1, y1) to show, are not known up front, out has to be seekable:
+    room is left in the header and filled in by Close.
+    """
+
+    capNames = ( "butt", "round", "square" )
+    joinNames = ( "miter", "round", "bevel" )
+
+    def __init__( self, out, bounds=None ):
+        self.out = out
+        self.fillColor = self.strokeColor = ( "#000000", 1 )
+        self._lineJoin = 0
+        self.groups = 0         # <g> elements opened since the last saveState
+        self._stateStack = []
+        self.symbols = {}       # (template name, pen) -> symbol id
+        out.write( '<?xml version="1.0" encoding="UTF-8"?>\n'
+                   '<svg xmlns="http://www.w3.org/2000/svg" xmlns:xlink="http://www.w3.org/1999/xlink"' )
+        self.header = None
+        if bounds is None:
+            self.header = out.tell()
+            out.write( " " * headerRoom )
+        else:
+            out.write( self.Size( bounds ) )
+        # the Gerber y axis points up
+        out.write( '>\n<g transform="scale(1,-1)">\n' )
+
+    def Size( self, bounds ):
+        x0, y0, x1, y1 = bounds
+        if x0 > x1:
+            x0 = y0 = x1 = y1 = 0
+        return ' width="%gpt" height="%gpt" viewBox="%g %g %g %g"' % ( x1-x0, y1-y0, x0, -y1, x1-x0, y1-y0 )
+
+    def Close( self, bounds=None ):
+        # closes the document, filling in the size left open in the header
+        while self._stateStack:
+            self.restoreState()
+        self.out.write( "</g>\n" * self.groups + "</g>\n</svg>\n" )
+        self.groups = 0
+        if self.header is not None:
+            size = self.Size( bounds or ( 0, 0, 0, 0 ) )
+            if len(size) > headerRoom:
+                raise ValueError( "No room for the size of the drawing in the header" )
+            self.out.seek( self.header )
+            self.out.write( size )
+            self.out.seek( 0, 2 )
+
+    # {{{ Graphics state
+    def setLineJoin( self, mode ):
+        self._lineJoin = mode
+
+    def setStrokeColor( self, color ):
+        self.strokeColor = Paint( color )
+
+    def setFillColor( self, color ):
+        self.fillColor = Paint( color )
+
+    def Pen( self ):
+        return ( self._lineWidth, self._lineCap, self._lineJoin, self.fillColor, self.strokeColor )
+
+    def saveState( self ):
+        self._stateStack.append( self.Pen() + ( self.groups, ) )
+        self.groups = 0
+
+    def restoreState( self ):
+        self.out.write( "</g>" * self.groups )
+        ( self._lineWidth, self._lineCap, self._lineJoin,
+          self.fillColor, self.strokeColor, self.groups ) = self._stateStack.pop()
+
+    def translate( self, dx, dy ):
+        self.out.write( '<g transform="translate(%g,%g)">\n' % ( dx, dy ) )
+        self.groups += 1
+
+    def scale( self, x, y ):
+        self.out.write( '<g transform="scale(%g,%g)">\n' % ( x, y ) )
+        self.groups += 1
+    # }}}
+    # {{{ Drawing
+    def drawPath( self, path, stroke=1, fill=0, fillMode=None ):
+        attributes = [ '<path d="%s"' % PathData( path ) ]
+        if fill:
+            attributes.append( ' fill="%s"' % self.fillColor[0] )
+            if self.fillColor[1] != 1:
+                attributes.append( ' fill-opacity="%g"' % self.fillColor[1] )
+            if fillMode is None or fillMode == FILL_EVEN_ODD:
+                attributes.append( ' fill-rule="evenodd"' )
+        else:
+            attributes.append( ' fill="none"' )
+        if stroke:
+            attributes.append( ' stroke="%s" stroke-linecap="%s" stroke-linejoin="%s"' %
+                               ( self.strokeColor[0], SvgTarget.capNames[self._lineCap],
+                                 SvgTarget.joinNames[self._lineJoin] ) )
+            if self.strokeColor[1] != 1:
+                attributes.append( ' stroke-opacity="%g"' % self.strokeColor[1] )
+            if self._lineWidth:
+                attributes.append( ' stroke-width="%g"' % self._lineWidth )
+            else:
+                # the thinnest line the viewer can draw, as in PDF
+                attributes.append( ' stroke-width="1" vector-effect="non-scaling-stroke"' )
+        attributes.append( '/>\n' )
+        self.out.write( "".join( attributes ) )
+
+    def stamp( self, template, x, y ):
+        key = ( template.name, self.Pen() )
+        symbol = self.symbols.get( key )
+        if symbol is None:
+            symbol = "%s-%d" % ( template.name, len(self.symbols) )
+            self.symbols[key] = symbol
+            self.out.write( '<defs><symbol id="%s" overflow="visible">\n' % symbol )
+            self.saveState()
+            template.displayList.Replay( self )
+            self.restoreState()
+            self.out.write( '</symbol></defs>\n' )
+        self.out.write( '<use xlink:href="#%s" x="%g" y="%g"/>\n' % ( symbol, x, y ) )
+    # }}}
+# }}}
+# {{{ WriteSVG
+def WriteSVG( layers, out, config=None ):
+    """
+    Draws (fname, fgColor, bgColor, lineWidth) layers, the first one at the
+    bottom, to out as one SVG drawing of their extents.  Returns the extents.
+    When out cannot seek, the files are read twice, the first time only to
+    measure them.
+    """
+    if config is None:
+        config = GerberConfig()
+    gm = GerberMachine( "", ExtentsCanvas(), config )
+    bounds = None
+    try:
+        out.tell()
+    except IOError:
+        for fname, fgColor, bgColor, lineWidth in layers:
+            gm.Initialize()
+            gm.canv.setLineWidth( lineWidth )
+            b = gm.MeasureFile( fname )
+            if b[0] <= b[2]:
+                gm.extents.Update( *b )
+        bounds = gm.extents.bounds
+
+    gm.canv = SvgTarget( out, bounds )
+    for fname, fgColor, bgColor, lineWidth in layers:
+        gm.Initialize()
+        if fgColor is not None:
+            gm.setColors( fgColor, bgColor )
+        gm.canv.setLineWidth( lineWidth )
+        log.info( "Processing file: %s", fname )
+        gm.InterpretFile( fname )
+    bounds = gm.extents.bounds
+    gm.canv.Close( bounds )
+    return bounds
+# }}}
+# {{{ __MAIN__
+def ParseLayer( arg ):
+    # file[:RRGGBB] -> (fname, fgColor, bgColor, lineWidth)
+    fname, color = arg, "cccccc"
+    if len(arg) > 7 and arg[-7] == ":":
+        fname, color = arg[:-7], arg[-6:]
+    rgb = [ int( color[i:i+2], 16 ) / 255.0 for i in ( 0, 2, 4 ) ]
+    return ( fname, colors.Color( *rgb ), colors.Color( 1, 1, 1 ), 0.0 )
+
+if __name__ == "__main__":
+    import getopt
+
+    usage = "usage: %s [--output FILE] [-q|-v] file[:RRGGBB] ..."
+    try:
+        options, args = getopt.gnu_getopt( sys.argv[1:], "qvo:", [ "output=", "quiet", "verbose" ] )
+        options = dict( options )
+        layers = [ ParseLayer( arg ) for arg in args ]
+    except ( getopt.GetoptError, ValueError ), message:
+        sys.exit( "%s\n%s" % (message, usage % sys.argv[0]) )
+    if not layers:
+        sys.exit( usage % sys.argv[0] )
+    level = logging.INFO
+    if "-q" in options or "--quiet" in options:
+        level = logging.WARNING
+    if "-v" in options or "--verbose" in options:
+        level = logging.DEBUG
+    logging.basicConfig( level=level, format="%(message)s" )
+
+    config = GerberConfig()
+    ReadConfiguration( [ layer[0] for layer in layers ], config )
+    output = options.get( "--output", options.get( "-o", "drawing.svg" ) )
+    if output == "-":
+        WriteSVG( layers, sys.stdout, config )
+    else:
+        out = open( output, 'w' )
+        try:
+            WriteSVG( layers, out, config )
+        finally:
+            out.close()
+        log.info( "Wrote %s", output )
+# }}}